@@ -0,0 +1,279 @@
+# Quadtree (Barnes-Hut) approximation of inverse-square interactions
+import numpy as np
+
+def pairwise_field(targets,positions,weights,softening=0.):
+    """
+    Exact inverse-square field at each target due to every weighted point:
+
+        E_i = sum_j w_j (p_j - t_i) / (|p_j - t_i|^2 + softening^2)^(3/2)
+
+    Points coinciding with a target contribute nothing. Work is split into
+    chunks so memory stays bounded for large inputs.
+    """
+    targets = np.asarray(targets,float)
+    field = np.zeros_like(targets)
+    if not len(positions):
+        return field
+    eps2 = softening*softening
+    chunk = max(1,(1<<20)//len(positions))
+    for start in range(0,len(targets),chunk):
+        d = positions[None,:,:] - targets[start:start+chunk,None,:]
+        r2 = np.einsum('ijk,ijk->ij',d,d) + eps2
+        with np.errstate(divide='ignore',invalid='ignore'):
+            inverse = np.where(r2 > 0,r2**-1.5,0.)
+        field[start:start+chunk] = np.einsum('ij,ijk->ik',inverse*weights,d)
+    return field
+
+def _spread(v):
+    # Puts a zero bit between each of the low 32 bits of v
+    v = v.astype(np.int64)
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+def _expand(starts,counts):
+    # Concatenation of range(start,start+count) for each pair
+    total = counts.sum()
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts)-counts,counts)
+    return np.repeat(starts,counts) + offsets
+
+def _blocks(positions,weights,starts,ends):
+    """
+    returns:    (positions,weights) of the runs starts[i]:ends[i] as blocks
+                of the longest run's length, padded with weight 0
+    """
+    counts = ends - starts
+    width = max(counts.max() if len(counts) else 0,1)
+    column = np.arange(width)
+    index = np.minimum(starts[:,None] + column,len(positions)-1)
+    blockWeights = np.where(column < counts[:,None],weights[index],0.)
+    return positions[index],blockWeights
+
+class QuadTree(object):
+    """
+    Quadtree over weighted points (masses or charge magnitudes) storing the
+    total weight and weighted centre of each node, for Barnes-Hut
+    approximation of the field from all points.
+
+    The tree is kept in flat arrays. Points are sorted by their Morton
+    (Z-order) code, so the points of every node are a contiguous run, and
+    the nodes of each level are found at once from the shared prefixes of
+    the codes. Nodes are numbered level by level, and the children of a
+    node are a contiguous run of the next level.
+
+    Arguments:
+    --------------------------------------------------------------------
+    positions       | Nx2 point positions
+    weights         | N non-negative weights
+    leafSize        | maximum number of points in a leaf
+    maxDepth        | depth at which nodes become leaves regardless (stops
+                    | coincident points from splitting forever); at most 30
+    --------------------------------------------------------------------
+    """
+    def __init__(self,positions,weights,leafSize=8,maxDepth=20):
+        self.positions = np.asarray(positions,float)
+        self.weights = np.asarray(weights,float)
+        self.leafSize = leafSize
+        self.maxDepth = min(maxDepth,30)
+
+        keep = np.flatnonzero(self.weights > 0)
+        self.order = keep
+        levels = []
+        if len(keep):
+            levels = self._build(keep)
+        if not levels:
+            levels = [(np.zeros((0,2)),np.zeros(0),np.zeros((0,2)),np.zeros(0),
+                       np.zeros(0,int),np.zeros(0,int),np.zeros(0,bool))]
+        (self.centers,self.totals,self.origins,self.sizes,
+         self.starts,self.ends,self.leaf) = [np.concatenate(column) for column in zip(*levels)]
+        # Children of each node, as a range of node numbers
+        self.childStarts = np.zeros(len(self.totals),int)
+        self.childEnds = np.zeros(len(self.totals),int)
+        offset = 0
+        for level,nextLevel in zip(levels,levels[1:]):
+            count = len(level[1])
+            nextOffset = offset + count
+            nextStarts = nextLevel[4]
+            self.childStarts[offset:nextOffset] = nextOffset + np.searchsorted(nextStarts,level[4])
+            self.childEnds[offset:nextOffset] = nextOffset + np.searchsorted(nextStarts,level[5])
+            offset = nextOffset
+        # The points of each leaf, padded with weightless points to the size
+        # of the largest leaf, so leaves can be summed over as blocks
+        leaves = np.flatnonzero(self.leaf)
+        self.leafIndex = np.full(len(self.totals),-1,int)
+        self.leafIndex[leaves] = np.arange(len(leaves))
+        self.leafPositions,self.leafWeights = _blocks(self.positions[self.order],
+                                                      self.weights[self.order],
+                                                      self.starts[leaves],self.ends[leaves])
+        # Single precision copies for the point by point sums, relative to
+        # the root and with the weights divided by the largest one so they
+        # keep their precision and cannot overflow
+        self._origin = self.origins[0] if len(self.totals) else np.zeros(2)
+        self._unit = self.weights.max() if len(self.totals) else 1.
+        self._centers = (self.centers - self._origin).astype(np.float32)
+        self._totals = (self.totals/self._unit).astype(np.float32)
+        self._leafPositions = (self.leafPositions - self._origin).astype(np.float32)
+        self._leafWeights = (self.leafWeights/self._unit).astype(np.float32)
+
+    def __len__(self):
+        return len(self.totals)
+
+    def _build(self,keep):
+        points = self.positions[keep]
+        low = points.min(axis=0)
+        size = max((points.max(axis=0) - low).max(),1e-9)*(1+1e-9)
+        depth = self.maxDepth
+        cells = np.minimum(((points-low)*((1 << depth)/size)).astype(np.int64),(1 << depth)-1)
+        codes = _spread(cells[:,0]) | (_spread(cells[:,1]) << 1)
+        order = np.argsort(codes,kind='mergesort')
+        self.order = keep[order]
+        codes,cells = codes[order],cells[order]
+        weights = self.weights[self.order]
+        points = self.positions[self.order]
+        weighted = weights[:,None]*points
+        n = len(codes)
+
+        levels = []
+        # Points whose ancestors so far are all internal nodes
+        open = np.ones(n,bool)
+        for level in range(depth+1):
+            prefix = codes >> (2*(depth-level))
+            starts = np.flatnonzero(np.concatenate(((True,),prefix[1:] != prefix[:-1])))
+            ends = np.append(starts[1:],n)
+            totals = np.add.reduceat(weights,starts)
+            sums = np.add.reduceat(weighted,starts,axis=0)
+            inTree = open[starts]
+            starts,ends,totals,sums = starts[inTree],ends[inTree],totals[inTree],sums[inTree]
+            nodeSize = size/(1 << level)
+            origins = low + (cells[starts] >> (depth-level))*nodeSize
+            leaf = (ends-starts <= self.leafSize) | (level == depth)
+            levels.append((sums/totals[:,None],totals,origins,np.full(len(starts),nodeSize),
+                           starts,ends,leaf))
+            if leaf.all():
+                break
+            # The points of leaves are not split further
+            change = np.zeros(n+1,int)
+            np.add.at(change,starts[leaf],1)
+            np.add.at(change,ends[leaf],-1)
+            open &= np.cumsum(change[:n]) == 0
+        return levels
+
+    def field(self,targets,theta=0.5,softening=0.,groupSize=8,chunk=1024):
+        """
+        Approximate field at each target (see pairwise_field). A node is
+        treated as a single point when its size divided by its distance
+        from the target is below theta and the target is outside it;
+        theta=0 gives the exact sum.
+
+        Targets are sorted along the same Z-order curve and walked down the
+        tree in groups of groupSize neighbours: the test above is applied
+        to the box around each group, and every (group,node) pair still
+        open at a level is tested at once. The groups then sum the nodes
+        they accepted, and the points of the leaves too close to accept,
+        as dense blocks in single precision. chunk bounds how many groups
+        are walked together.
+        """
+        targets = np.asarray(targets,float)
+        if not len(self.totals) or not len(targets):
+            return np.zeros_like(targets)
+        # Z-order of the targets in the frame of the root
+        cells = np.clip((targets-self._origin)*((1 << 16)/self.sizes[0]),0,(1 << 16)-1)
+        cells = cells.astype(np.int64)
+        order = np.argsort(_spread(cells[:,0]) | (_spread(cells[:,1]) << 1),kind='mergesort')
+        starts = np.arange(0,len(targets),groupSize)
+        ends = np.minimum(starts+groupSize,len(targets))
+        # Padding repeats the last target of a group, so it stays in the box
+        groups,mask = _blocks(targets[order],np.ones(len(targets)),starts,ends)
+        low = groups.min(axis=1)
+        high = groups.max(axis=1)
+        fields = np.zeros_like(groups)
+        for first in range(0,len(starts),chunk):
+            part = slice(first,first+chunk)
+            fields[part] = self._walk(groups[part],low[part],high[part],theta,softening)
+        field = np.zeros_like(targets)
+        field[order] = fields[mask > 0]*self._unit
+        return field
+
+    def _walk(self,groups,low,high,theta,softening):
+        # Field (over the weight unit) at each point of the groups, shaped
+        # like groups
+        eps2 = softening*softening
+        theta2 = theta*theta
+        count,width = groups.shape[:2]
+        far = []
+        near = []
+        group = np.arange(count)
+        node = np.zeros(count,int)
+        while len(group):
+            center = self.centers[node]
+            size = self.sizes[node]
+            origin = self.origins[node]
+            groupLow,groupHigh = low[group],high[group]
+            # Closest the group comes to the node's centre, and whether it
+            # reaches into the node
+            gap = np.maximum(np.maximum(groupLow-center,center-groupHigh),0.)
+            r2 = np.einsum('ij,ij->i',gap,gap) + eps2
+            overlaps = ((groupHigh >= origin) & (groupLow < origin+size[:,None])).all(axis=1)
+            accept = (size*size < theta2*r2) & ~overlaps
+            leaf = self.leaf[node]
+            far.append((group[accept],node[accept]))
+            near.append((group[~accept & leaf],self.leafIndex[node[~accept & leaf]]))
+            group,node = group[~accept & ~leaf],node[~accept & ~leaf]
+            counts = self.childEnds[node] - self.childStarts[node]
+            node = _expand(self.childStarts[node],counts)
+            group = np.repeat(group,counts)
+
+        points = (groups - self._origin).astype(np.float32)
+        eps2 = np.float32(eps2)
+        fieldX,fieldY = np.zeros(count*width),np.zeros(count*width)
+        slots = np.arange(width)
+        # Nodes far enough away act from their centres on each point
+        group = np.concatenate([pair[0] for pair in far])
+        node = np.concatenate([pair[1] for pair in far])
+        for start in range(0,len(group),32768):
+            g,n = group[start:start+32768],node[start:start+32768]
+            targets,centers = points[g],self._centers[n]
+            dx = centers[:,0,None] - targets[:,:,0]
+            dy = centers[:,1,None] - targets[:,:,1]
+            r2 = dx*dx + dy*dy + eps2
+            strength = self._totals[n][:,None]/(r2*np.sqrt(r2))
+            index = (g[:,None]*width + slots).ravel()
+            fieldX += np.bincount(index,(strength*dx).ravel(),len(fieldX))
+            fieldY += np.bincount(index,(strength*dy).ravel(),len(fieldY))
+
+        # Leaves too close to approximate: every point with every point
+        group = np.concatenate([pair[0] for pair in near])
+        leaf = np.concatenate([pair[1] for pair in near])
+        for start in range(0,len(group),4096):
+            g,l = group[start:start+4096],leaf[start:start+4096]
+            targets,sources = points[g],self._leafPositions[l]
+            dx = sources[:,None,:,0] - targets[:,:,0,None]
+            dy = sources[:,None,:,1] - targets[:,:,1,None]
+            r2 = dx*dx + dy*dy + eps2
+            if not eps2:
+                # Points coinciding with the target contribute nothing
+                r2[r2 == 0] = np.inf
+            strength = self._leafWeights[l][:,None,:]/(r2*np.sqrt(r2))
+            index = (g[:,None]*width + slots).ravel()
+            fieldX += np.bincount(index,(strength*dx).sum(axis=2).ravel(),len(fieldX))
+            fieldY += np.bincount(index,(strength*dy).sum(axis=2).ravel(),len(fieldY))
+        return np.dstack((fieldX.reshape(count,width),fieldY.reshape(count,width)))
+
+def inverse_square_field(positions,weights,theta=0.5,softening=0.,exactBelow=256):
+    """
+    Field at every point due to all the others, using a Barnes-Hut quadtree
+    for more than exactBelow points and the exact pairwise sum otherwise.
+    Weights may be negative (charges); positive and negative weights are
+    put in separate trees so node centres stay meaningful.
+    """
+    positions = np.asarray(positions,float)
+    weights = np.asarray(weights,float)
+    if len(positions) < exactBelow or theta <= 0:
+        return pairwise_field(positions,positions,weights,softening)
+    field = QuadTree(positions,np.maximum(weights,0)).field(positions,theta,softening)
+    if (weights < 0).any():
+        field -= QuadTree(positions,np.maximum(-weights,0)).field(positions,theta,softening)
+    return field
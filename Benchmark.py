@@ -0,0 +1,402 @@
+# Benchmarks for the engine hot paths
+"""
+Runs each scenario at a range of entity counts and reports ticks per
+second and the time spent in each phase of a tick. Everything is seeded
+and runs against SDL's dummy video driver, so results are reproducible
+and need no window.
+
+Results are written as JSON; pass --compare with an earlier results file
+to see the speedup for every case.
+
+    python Benchmark.py
+    python Benchmark.py --scenarios collision --sizes 100 1000 --output new.json
+    python Benchmark.py --compare old.json
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+
+import sys
+import json
+import math
+import collections
+import random
+import argparse
+import platform
+import subprocess
+import time
+from timeit import default_timer as timer
+
+import numpy as np
+import pygame
+
+from GameEngine2D import World,NewtonWorld,Entity,ParticleSystem
+from EntityStore import EntityStore
+from PhysicsEngine2D import PhysicsWorld,NewtonianEntity,CollidingEntity,elastic_collision
+from Fields import PlanarGravity,ElectricField,MutualGravity
+from BarnesHut import pairwise_field,inverse_square_field
+from Input import StaticInput
+from Shapes import AABB
+from Camera import Camera
+import Pong
+
+WORLD_SIZE = (1000,700)
+SCALE = 10
+DT = 0.01
+THETA = 0.5
+
+def random_position():
+    return (random.uniform(0,WORLD_SIZE[0]/SCALE),random.uniform(0,WORLD_SIZE[1]/SCALE))
+
+def random_velocity(speed=5.):
+    angle = random.uniform(0,2*math.pi)
+    return (speed*math.cos(angle),speed*math.sin(angle))
+
+def build_integration(n):
+    world = NewtonWorld("integration",None,scale=SCALE,size=WORLD_SIZE)
+    for i in range(n):
+        world.add(NewtonianEntity(world,position=random_position(),
+                                  velocity=random_velocity(),force=random_velocity(1.)))
+    return world
+
+def build_collision(n):
+    # Many balls bouncing around a field of paddles
+    world = PhysicsWorld("collision",None,scale=SCALE,size=WORLD_SIZE,
+                         input=StaticInput((0,WORLD_SIZE[1]/2)))
+    paddleImage = pygame.Surface((20,120))
+    for i in range(max(2,n//50)):
+        x = (i+.5)*WORLD_SIZE[0]/SCALE/max(2,n//50)
+        paddle = Pong.Paddle(world,position=(x,WORLD_SIZE[1]/SCALE/2),image=paddleImage)
+        paddle.set_dof('y',paddle.position[0])
+        world.add(paddle)
+    ballImage = pygame.Surface((31,31))
+    for i in range(n):
+        world.add(Pong.Ball(world,position=random_position(),mass=.05,image=ballImage))
+    return world
+
+def build_static(n):
+    # Fifty balls bouncing around n static blocks (the scenery of a level)
+    world = PhysicsWorld("static",None,scale=SCALE,size=WORLD_SIZE)
+    Pong.add_walls(world,SCALE)
+    blockImage = pygame.Surface((10,10))
+    for i in range(n):
+        world.add(CollidingEntity(world,position=random_position(),image=blockImage,
+                                  shape=AABB((10,10)),static=True))
+    ballImage = pygame.Surface((31,31))
+    for i in range(50):
+        world.add(Pong.Ball(world,position=random_position(),mass=.05,image=ballImage))
+    return world
+
+class Interceptor(Entity):
+    # Works out every tick where the ball will cross its line, as a
+    # computer paddle in hard mode does
+    def __init__(self,world,x,ball):
+        Entity.__init__(self,world)
+        self.type = "Interceptor"
+        self.x = x
+        self.ball = ball
+        self.target = None
+
+    def process(self,dt):
+        crossing = self.world.predict(self.ball,Pong.PREDICTION_HORIZON).crossing(0,self.x)
+        self.target = crossing and crossing[1][1]
+
+def build_predict(n):
+    # Many agents sharing the predicted path of one ball
+    world = PhysicsWorld("predict",None,scale=SCALE,size=WORLD_SIZE)
+    ball = Pong.Ball(world,position=np.array(WORLD_SIZE,float)/SCALE/2,mass=.05,
+                     image=pygame.Surface((31,31)))
+    world.add(ball)
+    for i in range(n):
+        world.add(Interceptor(world,random.uniform(0,WORLD_SIZE[0]),ball))
+    return world
+
+def build_field(n):
+    world = PhysicsWorld("field",None,scale=SCALE,size=WORLD_SIZE)
+    centre = np.array(WORLD_SIZE,float)/SCALE/2
+    source = NewtonianEntity(world,position=centre,charge=1e-3)
+    world.add_field(PlanarGravity(world,centre*SCALE,mass=1e12,G=6.67e-11))
+    world.add_field(ElectricField(world,source))
+    for i in range(n):
+        world.add(NewtonianEntity(world,position=random_position(),
+                                  velocity=random_velocity(),
+                                  charge=random.choice([-1e-6,1e-6])))
+    return world
+
+def build_nbody(n,theta=THETA):
+    world = PhysicsWorld("nbody",None,scale=SCALE,size=WORLD_SIZE)
+    world.add_field(MutualGravity(world,theta=theta))
+    for i in range(n):
+        world.add(NewtonianEntity(world,position=random_position(),
+                                  velocity=random_velocity(.5),mass=random.uniform(1e8,1e9)))
+    return world
+
+def nbody_tradeoff(world):
+    """
+    Compares the Barnes-Hut field used by the nbody scenario with the exact
+    sum, on the initial positions
+    """
+    store = world.store
+    n = store.count
+    positions,masses = store.position[:n],store.mass[:n]
+    field = world.fields[0]
+    theta,softening = field.theta,field.softening
+    start = timer()
+    exact = pairwise_field(positions,positions,masses,softening)
+    exactSeconds = timer()-start
+    start = timer()
+    approx = inverse_square_field(positions,masses,theta,softening,exactBelow=0)
+    approxSeconds = timer()-start
+    error = np.linalg.norm(approx-exact,axis=1).mean()/np.linalg.norm(exact,axis=1).mean()
+    return {'theta':theta,'relativeError':error,
+            'exactSeconds':exactSeconds,'approxSeconds':approxSeconds}
+
+def build_render(n):
+    surface = pygame.display.set_mode(WORLD_SIZE)
+    world = NewtonWorld("render",surface,scale=SCALE)
+    image = pygame.Surface((8,8))
+    image.fill(pygame.Color('red'))
+    for i in range(n):
+        world.add(NewtonianEntity(world,position=random_position(),
+                                  velocity=random_velocity(.05),image=image))
+    return world
+
+def build_camera(n):
+    # A world ten screens wide and high, viewed through a camera at its centre
+    surface = pygame.display.set_mode(WORLD_SIZE)
+    size = (10*WORLD_SIZE[0],10*WORLD_SIZE[1])
+    camera = Camera(WORLD_SIZE)
+    camera.center_on((size[0]/2,size[1]/2))
+    world = NewtonWorld("camera",surface,scale=SCALE,size=size,camera=camera)
+    image = pygame.Surface((8,8))
+    image.fill(pygame.Color('red'))
+    for i in range(n):
+        position = (random.uniform(0,size[0]/SCALE),random.uniform(0,size[1]/SCALE))
+        world.add(NewtonianEntity(world,position=position,
+                                  velocity=random_velocity(.05),image=image))
+    return world
+
+class SpawnWorld(NewtonWorld):
+    # Short lived projectiles: a tenth of them are released and as many
+    # spawned again every tick, through the world's pool
+    def tick(self,dt):
+        for i in range(max(1,len(self.live)//10)):
+            self.release(self.live.popleft())
+            self.live.append(spawn_projectile(self))
+        NewtonWorld.tick(self,dt)
+
+def spawn_projectile(world):
+    return world.spawn(NewtonianEntity,position=random_position(),velocity=random_velocity())
+
+def build_spawn(n):
+    world = SpawnWorld("spawn",None,scale=SCALE,size=WORLD_SIZE)
+    world.live = collections.deque(spawn_projectile(world) for i in range(n))
+    return world
+
+class Fountain(ParticleSystem):
+    # Keeps about `target` particles alive, topping up from the centre
+    def process(self,dt):
+        missing = self.target - self.count
+        if missing > 0:
+            self.burst(missing,np.array(WORLD_SIZE)/2.,200.,lifetime=2.,color='blue')
+        ParticleSystem.process(self,dt)
+
+def build_particles(n):
+    surface = pygame.display.set_mode(WORLD_SIZE)
+    world = PhysicsWorld("particles",surface,scale=SCALE)
+    world.add_field(PlanarGravity(world,(WORLD_SIZE[0]/2.,-2000.),mass=1e14,G=6.67e-11))
+    fountain = Fountain(world,capacity=n)
+    fountain.target = n
+    world.add(fountain)
+    return world
+
+class ElasticBench(object):
+    # Resolves n head-on contacts per tick with elastic_collision
+    def __init__(self,n):
+        self.world = NewtonWorld("elastic",None,scale=SCALE,size=WORLD_SIZE)
+        self.pairs = []
+        for i in range(n):
+            a = NewtonianEntity(self.world,position=random_position(),velocity=(1,0))
+            b = NewtonianEntity(self.world,position=random_position(),velocity=(-1,0))
+            self.world.add(a)
+            self.world.add(b)
+            self.pairs.append((a,b))
+
+SCENARIOS = {
+    'integration':build_integration,
+    'collision':build_collision,
+    'predict':build_predict,
+    'static':build_static,
+    'field':build_field,
+    'render':build_render,
+    'camera':build_camera,
+    'nbody':build_nbody,
+    'elastic':ElasticBench,
+    'spawn':build_spawn,
+    'particles':build_particles,
+    }
+
+# Held by the world or shared between entities, so not counted against them
+_SHARED = (World,Entity,EntityStore,pygame.Surface)
+
+def _deep_size(value,seen):
+    if id(value) in seen or isinstance(value,_SHARED):
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value,(list,tuple,set,frozenset)):
+        size += sum(_deep_size(item,seen) for item in value)
+    elif isinstance(value,dict):
+        size += sum(_deep_size(k,seen)+_deep_size(v,seen) for k,v in value.items())
+    return size
+
+def memory_per_entity(world,count=None):
+    """
+    Average bytes held by each entity: the object, its __dict__ and
+    anything only entities refer to (rects, arrays, lists), plus its share
+    of the entity store. Images are shared and not counted. Pass count to
+    divide by something else, such as the number of particles.
+    """
+    entities = world.get_entities()
+    if not len(entities):
+        return 0.
+    seen = set()
+    total = 0
+    for entity in entities:
+        total += sys.getsizeof(entity)
+        names = []
+        for cls in type(entity).__mro__:
+            slots = cls.__dict__.get('__slots__',())
+            names.extend((slots,) if isinstance(slots,str) else slots)
+        for name in names:
+            if name != '__dict__':
+                total += _deep_size(getattr(entity,name,None),seen)
+        if hasattr(entity,'__dict__'):
+            total += _deep_size(entity.__dict__,seen)
+    store = getattr(world,'store',None)
+    if store is not None:
+        total += sum(getattr(store,name).nbytes
+                     for name in store.VECTORS + store.SCALARS + store.FLAGS)
+        total += sys.getsizeof(store.owners)
+    return float(total)/(count or len(entities))
+
+def run_tick(world):
+    if world.headless:
+        world.step(1)
+    else:
+        world.frame(DT)
+
+def run_elastic_tick(bench):
+    normal = np.array((1.,0.))
+    for a,b in bench.pairs:
+        elastic_collision(a,b,normal)
+
+def run_case(scenario,n,ticks,maxSeconds,seed,theta=THETA):
+    random.seed(seed)
+    np.random.seed(seed)
+    if scenario == 'nbody':
+        world = build_nbody(n,theta)
+    else:
+        world = SCENARIOS[scenario](n)
+    if scenario == 'elastic':
+        tick = run_elastic_tick
+    else:
+        tick = run_tick
+        if world.headless:
+            world.fixedTimestep = DT
+        tick(world)   # warm up
+        profiler = world.enable_profiling(ticks)
+
+    done = 0
+    start = timer()
+    while done < ticks:
+        tick(world)
+        done += 1
+        if timer()-start > maxSeconds and done >= 3:
+            break
+    elapsed = timer()-start
+
+    result = {
+        'scenario':scenario,
+        'entities':n,
+        'ticks':done,
+        'seconds':elapsed,
+        'ticksPerSecond':done/elapsed,
+        }
+    if scenario == 'elastic':
+        result['phases'] = {'collide':elapsed/done}
+        result['types'] = {}
+    else:
+        result['phases'] = dict((name,t) for name,t in profiler.phase_means().items() if t)
+        result['types'] = profiler.type_means()
+        result['p95'] = profiler.percentiles((95,))[95]
+    result['bytesPerEntity'] = memory_per_entity(getattr(world,'world',world),
+                                                 n if scenario == 'particles' else None)
+    if scenario == 'nbody':
+        result['barnesHut'] = nbody_tradeoff(world)
+    return result
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=here).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def compare(results,baseline):
+    old = dict(((r['scenario'],r['entities']),r) for r in baseline['results'])
+    print("%-12s %8s %12s %12s %8s" % ("scenario","entities","old tick/s","new tick/s","speedup"))
+    for r in results:
+        before = old.get((r['scenario'],r['entities']))
+        if before:
+            print("%-12s %8d %12.1f %12.1f %7.2fx" % (r['scenario'],r['entities'],
+                  before['ticksPerSecond'],r['ticksPerSecond'],
+                  r['ticksPerSecond']/before['ticksPerSecond']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the engine hot paths")
+    parser.add_argument('--scenarios',nargs='+',default=sorted(SCENARIOS),choices=sorted(SCENARIOS))
+    parser.add_argument('--sizes',nargs='+',type=int,default=[10,100,1000,10000])
+    parser.add_argument('--ticks',type=int,default=100,help="ticks per case")
+    parser.add_argument('--max-seconds',type=float,default=5.,help="time limit per case")
+    parser.add_argument('--seed',type=int,default=1234)
+    parser.add_argument('--theta',type=float,default=THETA,help="Barnes-Hut opening angle for nbody")
+    parser.add_argument('--output',default='benchmark_results.json')
+    parser.add_argument('--compare',help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    results = []
+    for scenario in args.scenarios:
+        for n in args.sizes:
+            result = run_case(scenario,n,args.ticks,args.max_seconds,args.seed,args.theta)
+            results.append(result)
+            phases = ", ".join("%s %.3fms" % (name,1000*t) for name,t in sorted(result['phases'].items()))
+            print("%-12s %6d entities %10.1f ticks/s %6.0f B/entity  (%s)" % (scenario,n,
+                  result['ticksPerSecond'],result['bytesPerEntity'],phases))
+            if 'barnesHut' in result:
+                tradeoff = result['barnesHut']
+                print("%-12s theta %.2f: error %.2e, exact %.1fms, approximate %.1fms" % ("",
+                      tradeoff['theta'],tradeoff['relativeError'],
+                      1000*tradeoff['exactSeconds'],1000*tradeoff['approxSeconds']))
+            sys.stdout.flush()
+
+    report = {
+        'revision':git_revision(),
+        'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'pygame':pygame.version.ver,
+        'seed':args.seed,
+        'results':results,
+        }
+    with open(args.output,'w') as f:
+        json.dump(report,f,indent=2,sort_keys=True)
+    print("Results written to "+args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+    pygame.quit()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Viewport onto a world larger than the screen
+import pygame
+
+class Camera(object):
+    """
+    Maps world pixel coordinates onto the screen. The camera looks at the
+    part of the world whose top left corner is `position`, magnified by
+    `zoom`, so the view covers screenSize/zoom world pixels.
+
+    Every move or zoom bumps `version`, which tells the world to redraw
+    the whole screen.
+
+    Arguments:
+    --------------------------------------------------------------------
+    screenSize      | size of the surface drawn on, in pixels
+    position        | world position of the top left of the view (pixels)
+    zoom            | screen pixels per world pixel
+    --------------------------------------------------------------------
+    """
+    def __init__(self,screenSize,position=(0,0),zoom=1.):
+        self.screenSize = (int(screenSize[0]),int(screenSize[1]))
+        self.position = (float(position[0]),float(position[1]))
+        self.zoom = float(zoom)
+        self.version = 0
+        self._scaled = {}
+
+    def move_to(self,position):
+        self.position = (float(position[0]),float(position[1]))
+        self.version += 1
+
+    def move_by(self,offset):
+        self.move_to((self.position[0]+offset[0],self.position[1]+offset[1]))
+
+    def center_on(self,point):
+        w,h = self.screenSize
+        self.move_to((point[0]-w/(2*self.zoom),point[1]-h/(2*self.zoom)))
+
+    def set_zoom(self,zoom,center=None):
+        """
+        Changes the zoom, keeping the world point `center` (by default the
+        middle of the view) in the same place on the screen
+        """
+        if center is None:
+            center = self.to_world((self.screenSize[0]/2.,self.screenSize[1]/2.))
+        sx,sy = self.to_screen_point(center)
+        self.zoom = float(zoom)
+        self._scaled = {}
+        self.move_to((center[0]-sx/self.zoom,center[1]-sy/self.zoom))
+
+    def view_rect(self):
+        # World rect covered by the screen
+        w,h = self.screenSize
+        x,y = self.position
+        return pygame.Rect(int(x),int(y),int(w/self.zoom)+2,int(h/self.zoom)+2)
+
+    def to_screen(self,rect):
+        x,y = self.position
+        zoom = self.zoom
+        if zoom == 1.:
+            return pygame.Rect(int(round(rect[0]-x)),int(round(rect[1]-y)),rect[2],rect[3])
+        return pygame.Rect(int(round((rect[0]-x)*zoom)),int(round((rect[1]-y)*zoom)),
+                           int(round(rect[2]*zoom)),int(round(rect[3]*zoom)))
+
+    def to_screen_point(self,point):
+        return ((point[0]-self.position[0])*self.zoom,(point[1]-self.position[1])*self.zoom)
+
+    def to_world(self,point):
+        # World position under a screen point (e.g. the mouse)
+        return (point[0]/self.zoom+self.position[0],point[1]/self.zoom+self.position[1])
+
+    def image(self,image):
+        """
+        returns:    image scaled by the zoom, cached until the zoom changes
+        """
+        if self.zoom == 1.:
+            return image
+        entry = self._scaled.get(id(image))
+        if entry is None or entry[0] is not image:
+            w,h = image.get_size()
+            size = (max(1,int(round(w*self.zoom))),max(1,int(round(h*self.zoom))))
+            entry = self._scaled[id(image)] = (image,pygame.transform.scale(image,size))
+        return entry[1]
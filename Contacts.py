@@ -0,0 +1,140 @@
+# Batched impulse resolution of the contacts found in a tick
+import numpy as np
+
+class ContactSolver(object):
+    """
+    Collects the contacts found during a tick and resolves them together
+    with impulses on the velocities in an EntityStore.
+
+    A contact is a pair of entities and the normal of the first entity's
+    surface where they touch (pointing towards the second). Only contacts
+    that are closing get an impulse; it reverses the closing speed scaled
+    by the coefficient of restitution and removes sliding speed up to the
+    friction limit. Per contact the larger restitution and the geometric
+    mean of the frictions of the two entities are used.
+
+    Each pass runs over batches of contacts that share no entity, one
+    batch after the other (Gauss-Seidel), so a body touching several
+    others sees the impulses already applied and bounces once. More
+    iterations let impulses travel through stacks.
+
+    Contacts that come with a penetration depth (from collision shapes)
+    also push the two bodies apart, in inverse proportion to their mass,
+    so that resting contacts do not sink into each other. A body with
+    several such contacts gets the average of their pushes. Static bodies
+    count as infinitely heavy: only the other body moves.
+
+    Arguments:
+    --------------------------------------------------------------------
+    iterations      | number of solver passes
+    slop            | penetration (pixels) left alone, so resting
+                    | contacts stay touching rather than jitter
+    correction      | fraction of the remaining penetration removed per
+                    | tick
+    --------------------------------------------------------------------
+    """
+    def __init__(self,iterations=1,slop=0.5,correction=0.8):
+        self.iterations = iterations
+        self.slop = slop
+        self.correction = correction
+        self.clear()
+
+    def __len__(self):
+        return len(self.first)
+
+    def clear(self):
+        self.first = []
+        self.second = []
+        self.normals = []
+        self.restitution = []
+        self.friction = []
+        self.depth = []
+        self._seen = set()
+
+    def add(self,entity1,entity2,normalVector,depth=0.):
+        # The same contact reported from either side is only kept once
+        slot1,slot2 = entity1._slot,entity2._slot
+        nx,ny = float(normalVector[0]),float(normalVector[1])
+        key = (slot1,slot2,nx,ny) if slot1 < slot2 else (slot2,slot1,-nx,-ny)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        self.first.append(slot1)
+        self.second.append(slot2)
+        self.normals.append((nx,ny))
+        self.restitution.append(max(entity1.restitution,entity2.restitution))
+        self.friction.append((entity1.friction*entity2.friction)**0.5)
+        self.depth.append(depth)
+
+    def batches(self):
+        """
+        returns:    lists of contact indices in which no slot appears twice,
+                    found greedily in the order the contacts were added
+        """
+        batches = []
+        for i,pair in enumerate(zip(self.first,self.second)):
+            for slots,members in batches:
+                if pair[0] not in slots and pair[1] not in slots:
+                    break
+            else:
+                slots,members = set(),[]
+                batches.append((slots,members))
+            slots.update(pair)
+            members.append(i)
+        return [np.array(members) for slots,members in batches]
+
+    def solve(self,store):
+        """
+        Applies the contact impulses to store.velocity, separates
+        overlapping bodies in store.position and wakes every slot that
+        either changed
+        """
+        if not self.first:
+            return
+        first = np.array(self.first)
+        second = np.array(self.second)
+        normals = np.array(self.normals)
+        tangents = np.column_stack((-normals[:,1],normals[:,0]))
+        restitution = np.array(self.restitution)
+        friction = np.array(self.friction)
+        velocity = store.velocity
+        inverse1 = store.inverse_mass(first)
+        inverse2 = store.inverse_mass(second)
+        effectiveMass = 1./(inverse1 + inverse2)
+
+        # Closing speed to bounce back to, fixed at the start
+        relative = velocity[first] - velocity[second]
+        closing = np.einsum('ij,ij->i',relative,normals)
+        target = -restitution*np.maximum(closing,0.)
+
+        normalImpulse = np.zeros(len(first))
+        tangentImpulse = np.zeros(len(first))
+        batches = self.batches()
+        for iteration in range(self.iterations):
+            for index in batches:
+                a,b = first[index],second[index]
+                relative = velocity[a] - velocity[b]
+                n,t = normals[index],tangents[index]
+                m = effectiveMass[index]
+                total = np.maximum(normalImpulse[index] + (np.einsum('ij,ij->i',relative,n) - target[index])*m,0.)
+                dnormal = total - normalImpulse[index]
+                normalImpulse[index] = total
+                limit = friction[index]*total
+                tangent = np.clip(tangentImpulse[index] + np.einsum('ij,ij->i',relative,t)*m,-limit,limit)
+                dtangent = tangent - tangentImpulse[index]
+                tangentImpulse[index] = tangent
+                impulse = dnormal[:,None]*n + dtangent[:,None]*t
+                np.add.at(velocity,a,-impulse*inverse1[index,None])
+                np.add.at(velocity,b,impulse*inverse2[index,None])
+
+        moved = (normalImpulse > 0) | (tangentImpulse != 0)
+        depth = np.array(self.depth)
+        deep = depth > self.slop
+        if deep.any():
+            a,b = first[deep],second[deep]
+            share = 1./np.maximum(np.bincount(np.concatenate((a,b))),1)
+            push = (self.correction*(depth[deep]-self.slop)*effectiveMass[deep])[:,None]*normals[deep]
+            np.add.at(store.position,a,-push*(inverse1[deep]*share[a])[:,None])
+            np.add.at(store.position,b,push*(inverse2[deep]*share[b])[:,None])
+            moved |= deep
+        store.wake_slots(np.concatenate((first[moved],second[moved])))
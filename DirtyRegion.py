@@ -0,0 +1,135 @@
+# Dirty rectangle bookkeeping for partial display updates
+import pygame
+
+class DirtyRegion(object):
+    """
+    Works out which parts of the display changed during a frame and pushes
+    only those to the screen.
+
+    Sleeping entities, and entities whose rect and image are the same as
+    on the previous frame (unless they are animated), are skipped. The
+    rects of the remaining entities (where they were and where they are
+    now) are merged where they overlap or touch and clipped to the
+    screen. If the result still covers more than fullUpdateFraction of
+    the screen, the whole display is flipped instead.
+
+    After every update, dirtyArea, rectCount and fullUpdate describe the
+    frame that was just shown.
+
+    Arguments:
+    --------------------------------------------------------------------
+    screenRect          | rect of the display surface
+    fullUpdateFraction  | dirty fraction of the screen above which the
+                        | whole display is updated at once
+    --------------------------------------------------------------------
+    """
+    def __init__(self,screenRect,fullUpdateFraction=0.5):
+        self.screenRect = pygame.Rect(screenRect)
+        self.fullUpdateFraction = fullUpdateFraction
+        self.previous = {}
+        self.pending = []
+
+        self.dirtyArea = 0
+        self.rectCount = 0
+        self.fullUpdate = False
+
+    def mark(self,rect):
+        # Force rect to be redrawn on the next update
+        self.pending.append(pygame.Rect(rect))
+
+    def forget(self,entity):
+        # Called when an entity leaves the world: its last area is dirty
+        state = self.previous.pop(entity,None)
+        if state is not None:
+            self.pending.append(state[0])
+
+    def collect(self,entities):
+        """
+        returns:    rects of entities that moved, resized or changed image
+                    since the last call, before and after the change
+        """
+        rects = self.pending
+        self.pending = []
+        previous = self.previous
+        for entity in entities:
+            if entity.asleep:
+                # Anything drawn over a sleeping entity is already dirty;
+                # it only needs pushing if it moved as it fell asleep
+                state = previous.get(entity)
+                if state is not None and state[0] == entity.rect:
+                    continue
+            rect = entity.get_rect()
+            if rect is None:
+                continue
+            image = getattr(entity,'image',None)
+            state = previous.get(entity)
+            if state is not None:
+                oldRect,oldImage = state
+                if oldImage is image and oldRect == rect and not entity.animated:
+                    continue
+                rects.append(oldRect)
+            rects.append(rect)
+            previous[entity] = (rect,image)
+        return rects
+
+    def merge(self,rects):
+        """
+        Unions rects that overlap or touch, as long as the union does not
+        cover more than the two rects did separately
+        """
+        merged = []
+        while rects:
+            changed = False
+            for rect in rects:
+                grown = rect.inflate(2,2)
+                for other in merged:
+                    if grown.colliderect(other):
+                        union = other.union(rect)
+                        if union.w*union.h <= other.w*other.h + rect.w*rect.h:
+                            other.union_ip(rect)
+                            changed = True
+                            break
+                else:
+                    merged.append(rect)
+            if not changed:
+                break
+            rects,merged = merged,[]
+        return merged
+
+    def update(self,entities):
+        """
+        Pushes the changed parts of the display to the screen
+        """
+        screenRect = self.screenRect
+        screenArea = screenRect.w*screenRect.h
+        limit = self.fullUpdateFraction*screenArea
+
+        rects = []
+        area = 0
+        for rect in self.collect(entities):
+            rect = rect.clip(screenRect)
+            if rect.w and rect.h:
+                rects.append(rect)
+                area += rect.w*rect.h
+
+        # Overlaps are counted twice before merging, so there is no point
+        # merging when the area is far over the limit
+        if area <= 2*limit:
+            rects = self.merge(rects)
+            area = sum(rect.w*rect.h for rect in rects)
+
+        if area > limit:
+            self.fullUpdate = True
+            self.dirtyArea = screenArea
+            self.rectCount = 1
+            pygame.display.flip()
+        else:
+            self.fullUpdate = False
+            self.dirtyArea = area
+            self.rectCount = len(rects)
+            if rects:
+                pygame.display.update(rects)
+
+    def stats(self):
+        return {'dirtyArea':self.dirtyArea,'rectCount':self.rectCount,
+                'fullUpdate':self.fullUpdate}
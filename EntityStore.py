@@ -0,0 +1,232 @@
+# Contiguous state storage for NewtonianEntity
+import numpy as np
+
+class EntityStore(object):
+    """
+    Structure-of-arrays store for the state of every NewtonianEntity in a
+    world. Each entity owns one slot (row) of the arrays below, and its
+    position, velocity, etc. attributes are views into that row.
+
+    Removing an entity moves the last slot into the freed one, so the
+    occupied slots are always 0..count-1. A slot index is stable for as
+    long as no other entity is removed.
+
+    Static slots (static bodies) are asleep for good: they are never
+    integrated or woken, and contacts treat them as infinitely heavy.
+
+    Arguments:
+    --------------------------------------------------------------------
+    capacity        | number of slots to preallocate (grows by doubling)
+    --------------------------------------------------------------------
+    """
+    VECTORS = ('position','velocity','acceleration','force','fieldForce',
+               'centerOfMass','previousPosition')
+    SCALARS = ('mass','charge','sleepTime')
+    # Value of each scalar in a fresh slot; NaN charge means no charge
+    DEFAULTS = {'mass':1.,'charge':np.nan,'sleepTime':0.}
+    FLAGS = ('active','batched','canSleep','asleep','static')
+
+    def __init__(self,capacity=64):
+        self.capacity = max(int(capacity),1)
+        self.count = 0
+        self.owners = []
+        for name in self.VECTORS:
+            setattr(self,name,np.zeros((self.capacity,2),float))
+        for name in self.SCALARS:
+            setattr(self,name,np.full(self.capacity,self.DEFAULTS[name]))
+        for name in self.FLAGS:
+            setattr(self,name,np.zeros(self.capacity,bool))
+        self._batchedSlots = None
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        newCapacity = 2*self.capacity
+        for name in self.VECTORS + self.SCALARS + self.FLAGS:
+            old = getattr(self,name)
+            new = np.zeros((newCapacity,)+old.shape[1:],old.dtype)
+            new[:self.capacity] = old
+            setattr(self,name,new)
+        self.capacity = newCapacity
+
+    def allocate(self,owner):
+        """
+        Reserves a slot for owner and returns its index. The slot starts
+        out inactive; call activate() once the owner joins the world.
+        """
+        if self.count == self.capacity:
+            self._grow()
+        slot = self.count
+        self.count += 1
+        self.owners.append(owner)
+        for name in self.VECTORS:
+            getattr(self,name)[slot] = 0.
+        for name in self.SCALARS:
+            getattr(self,name)[slot] = self.DEFAULTS[name]
+        for name in self.FLAGS:
+            getattr(self,name)[slot] = False
+        return slot
+
+    def release(self,slot):
+        """
+        Frees slot, moving the last occupied slot into it. The owner of the
+        moved slot has its _slot attribute updated.
+        """
+        last = self.count - 1
+        if slot != last:
+            for name in self.VECTORS + self.SCALARS + self.FLAGS:
+                array = getattr(self,name)
+                array[slot] = array[last]
+            moved = self.owners[last]
+            self.owners[slot] = moved
+            moved._slot = slot
+        self.owners.pop()
+        self.count = last
+        self._batchedSlots = None
+
+    def copy_slot(self,source,sourceSlot,slot):
+        # Copy one slot's state from another store (used on add/remove)
+        for name in self.VECTORS + self.SCALARS:
+            getattr(self,name)[slot] = getattr(source,name)[sourceSlot]
+
+    def activate(self,slot,batched,canSleep=False,static=False):
+        self.previousPosition[slot] = self.position[slot]
+        self.active[slot] = True
+        self.batched[slot] = batched and not static
+        self.canSleep[slot] = canSleep
+        self.asleep[slot] = static
+        self.static[slot] = static
+        self.sleepTime[slot] = 0.
+        self._batchedSlots = None
+
+    def deactivate(self,slot):
+        self.active[slot] = False
+        self.batched[slot] = False
+        self.asleep[slot] = False
+        self.static[slot] = False
+        self._batchedSlots = None
+
+    def batched_slots(self):
+        """
+        Index array of the active, awake slots advanced by integrate()
+        """
+        if self._batchedSlots is None:
+            n = self.count
+            self._batchedSlots = np.flatnonzero(self.active[:n] & self.batched[:n] & ~self.asleep[:n])
+        return self._batchedSlots
+
+    def wake(self,slot):
+        self.sleepTime[slot] = 0.
+        if self.asleep[slot] and not self.static[slot]:
+            self.asleep[slot] = False
+            self._batchedSlots = None
+
+    def wake_slots(self,slots):
+        slots = slots[~self.static[slots]]
+        self.sleepTime[slots] = 0.
+        if self.asleep[slots].any():
+            self.asleep[slots] = False
+            self._batchedSlots = None
+
+    def update_sleep(self,dt,maxSpeed,maxAcceleration,delay):
+        """
+        Puts to sleep the slots that may sleep and have moved slower than
+        maxSpeed with a net acceleration below maxAcceleration for delay
+        seconds, zeroing their velocity. Sleeping slots whose net force has
+        grown past the threshold (a field changed, say) wake up again.
+        """
+        n = self.count
+        candidates = self.active[:n] & self.canSleep[:n] & ~self.static[:n]
+        if not candidates.any():
+            return
+        velocity = self.velocity[:n]
+        force = self.force[:n] + self.fieldForce[:n]
+        speed2 = np.einsum('ij,ij->i',velocity,velocity)
+        acceleration2 = np.einsum('ij,ij->i',force,force) / self.mass[:n]**2
+        resting = candidates & (speed2 <= maxSpeed*maxSpeed) & (acceleration2 <= maxAcceleration*maxAcceleration)
+        sleepTime = self.sleepTime[:n]
+        sleepTime[:] = np.where(resting,sleepTime+dt,0.)
+        asleep = (resting & (sleepTime >= delay)) | self.static[:n]
+        falling = asleep & ~self.asleep[:n]
+        if falling.any() or (self.asleep[:n] & ~asleep).any():
+            self.velocity[:n][falling] = 0.
+            self.acceleration[:n][falling] = 0.
+            self.asleep[:n] = asleep
+            self._batchedSlots = None
+
+    def inverse_mass(self,slots):
+        # 1/mass of slots, 0 for static ones
+        return np.where(self.static[slots],0.,1./self.mass[slots])
+
+    def get_state(self):
+        # Copies of every column, for World.save_state
+        n = self.count
+        return dict((name,getattr(self,name)[:n].copy())
+                    for name in self.VECTORS + self.SCALARS + self.FLAGS)
+
+    def set_state(self,state):
+        """
+        Overwrites every slot with a state from get_state(). The store must
+        hold as many slots, owned in the same order, as when it was taken.
+        """
+        n = self.count
+        for name in self.VECTORS + self.SCALARS + self.FLAGS:
+            column = state[name]
+            if len(column) != n:
+                raise ValueError("State has %d slots, the store %d" % (len(column),n))
+            getattr(self,name)[:n] = column
+        self._batchedSlots = None
+
+    def save_positions(self):
+        n = self.count
+        self.previousPosition[:n] = self.position[:n]
+
+    def place_rects(self,alpha=None):
+        """
+        Moves every active owner's rect to its current position, or if alpha
+        is given, to that fraction of the way from previousPosition. The
+        spatial hash is deliberately not updated; this is for drawing only.
+        """
+        n = self.count
+        position = self.position[:n]
+        if alpha is not None:
+            previous = self.previousPosition[:n]
+            position = previous + alpha*(position - previous)
+        topLefts = (position - self.centerOfMass[:n]).tolist()
+        active = self.active[:n].tolist()
+        for owner,topLeft,isActive in zip(self.owners,topLefts,active):
+            if isActive:
+                owner.rect.topleft = topLeft
+
+    def integrate(self,dt,integrator,acceleration=None,spatialHash=None):
+        """
+        Advances every batched slot by one step of integrator and moves the
+        owners' rects (keeping spatialHash up to date if given).
+
+        acceleration(slots,positions,velocities), if given, is used when the
+        integrator needs the acceleration at other states than the start;
+        otherwise the starting force is taken as constant over the step.
+        """
+        slots = self.batched_slots()
+        if not len(slots):
+            return
+        force = self.force[slots] + self.fieldForce[slots]
+        a0 = force / self.mass[slots,None]
+        if acceleration is None:
+            trial = lambda x,v: a0
+        else:
+            trial = lambda x,v: acceleration(slots,x,v)
+        position,velocity,a0 = integrator.step(self.position[slots],self.velocity[slots],
+                                               trial,dt,a0)
+        self.position[slots] = position
+        self.velocity[slots] = velocity
+        self.acceleration[slots] = a0
+
+        owners = self.owners
+        topLefts = (position - self.centerOfMass[slots]).tolist()
+        for slot,topLeft in zip(slots.tolist(),topLefts):
+            owner = owners[slot]
+            owner.rect.topleft = topLeft
+            if spatialHash is not None:
+                spatialHash.update(owner)
@@ -1,11 +1,23 @@
 # Standard Fields
 import numpy as np
+from numpy import linalg as LA
 import math
 
+from PhysicsEngine2D import NewtonianEntity
+from BarnesHut import inverse_square_field, pairwise_field
+
 class Field(object):
 	""" All parameters or physical constants should be given in SI
 	units unless there is no equivalent
+	
+	Subclasses give the force on one entity in get_vector, and can also
+	implement get_forces to compute the force on every entity at once,
+	which the world prefers when it is available.
 	"""
+	# True for fields the entities exert on each other (n-body), which
+	# only make sense over the entities in the world's store
+	mutual = False
+	
 	def __init__(self,name,world):
 		self.name = name
 		self.world = world
@@ -13,18 +25,36 @@ class Field(object):
 	def get_vector(self,entity):
 		pass
 		
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		"""
+		Arguments are arrays over all entities (Nx2 positions, velocities
+		and applied forces in pixel units, N masses, N charges with NaN for
+		uncharged entities). Returns an Nx2 array of forces in the same
+		units as get_vector, or None to fall back to apply_all. The arrays
+		must not be changed.
+		"""
+		return None
+		
+	def adjust_velocities(self,velocities,forces,movable):
+		"""
+		Called by the world after get_forces, with the store's Nx2
+		velocities and applied forces, for fields that change velocities
+		directly. Only entities where movable (active and not static) is
+		True may be changed.
+		"""
+		pass
+		
 	def apply(self,entity):
 		force = self.get_vector(entity)
-		entity.add_force(force)
+		entity.add_field_force(force)
 		
 	def apply_all(self):
-		for entity in self.world.get_entities():
-			if isinstance(entity,NewtonianEntity):
-				self.apply(entity)
+		for entity in self.world.get_instances(NewtonianEntity):
+			self.apply(entity)
 			
 class Gravity(Field):
 	def __init__(self,world,g):
-		Field.__init__("Gravity",world)
+		Field.__init__(self,"Gravity",world)
 		self.g = g * world.scale
 		
 	def get_vector(self,entity):
@@ -32,11 +62,11 @@ class Gravity(Field):
 		
 	def apply(self,entity):
 		if len(entity.position) == 3:
-			entity.add_force(self.get_vector(entity.position))
+			entity.add_field_force(self.get_vector(entity.position))
 			
 class PlanarGravity(Field):
 	def __init__(self,world,sourcePosition,mass,G):
-		Field.__init__("PlanarGravity",world)
+		Field.__init__(self,"PlanarGravity",world)
 		self.sourcePosition = np.array(sourcePosition)
 		
 		# Convert from m^3/(kg*s) to pixels^3/(kg*s)
@@ -44,9 +74,16 @@ class PlanarGravity(Field):
 		
 	def get_vector(self,entity):
 		d = self.sourcePosition - entity.position
-		force = self.GM*entity.mass/p.dot(d,d)*d/LA.norm(d)
+		force = self.GM*entity.mass/np.dot(d,d)*d/LA.norm(d)
 		return force
 		
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		d = self.sourcePosition - positions
+		r = np.sqrt(np.einsum('ij,ij->i',d,d))
+		with np.errstate(divide='ignore',invalid='ignore'):
+			magnitude = np.where(r > 0,self.GM*masses/r**3,0.)
+		return magnitude[:,None]*d
+		
 class ElectricField(Field):
 	"""
 	Arguments:
@@ -56,7 +93,7 @@ class ElectricField(Field):
 	--------------------------------------------------------------------
 	"""
 	def __init__(self,world,source,E0=8.85e-12):
-		Field.__init__("PlanarGravity",world)
+		Field.__init__(self,"ElectricField",world)
 		self.source = source
 		
 		# Convert from m^3/(kg*s) to pixels^3/(kg*s)
@@ -66,12 +103,95 @@ class ElectricField(Field):
 		
 	def get_vector(self,entity):
 		if entity.charge:
-			r = source.position - entity.position
+			r = self.source.position - entity.position
 			rSquared = np.dot(r,r)
 			force = entity.charge*self.source.charge/(self.FourPiE0*rSquared) / LA.norm(r) * r 
 			return force
 		return np.array((0,0))
 		
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		r = self.source.position - positions
+		distance = np.sqrt(np.einsum('ij,ij->i',r,r))
+		charges = np.nan_to_num(charges)
+		with np.errstate(divide='ignore',invalid='ignore'):
+			magnitude = np.where(distance > 0,
+								 charges*self.source.charge/(self.FourPiE0*distance**3),0.)
+		return magnitude[:,None]*r
+		
+		
+class MutualGravity(Field):
+	"""
+	Every entity attracts every other one (n-body gravity). Above
+	exactBelow entities the forces come from a Barnes-Hut quadtree rebuilt
+	every tick, which is O(N log N) instead of O(N^2).
+	
+	Arguments:
+	--------------------------------------------------------------------    
+	G			| gravitational constant (6.67E-11 m^3/(kg*s^2))
+	theta		| opening angle; larger is faster but less accurate, and
+				| 0 always uses the exact sum
+	softening	| length (m) added to every distance so close encounters
+				| stay finite
+	exactBelow	| entity count below which the exact sum is used
+	--------------------------------------------------------------------
+	"""
+	mutual = True
+	
+	def __init__(self,world,G=6.67e-11,theta=0.5,softening=0.1,exactBelow=256):
+		Field.__init__(self,"MutualGravity",world)
+		# Positions are in pixels, so G*m1*m2/r^2 gives newtons with G in
+		# pixels^2*m/(kg*s^2); the world scales the force to pixels
+		self.G = G * world.scale**2
+		self.theta = theta
+		self.softening = softening * world.scale
+		self.exactBelow = exactBelow
+		
+	def _sources(self,n,weights):
+		# Entities that are not in the world exert no force
+		return np.where(self.world.store.active[:n],weights,0.)
+		
+	def get_vector(self,entity):
+		store = self.world.store
+		n = store.count
+		field = pairwise_field(entity.position[None,:],store.position[:n],
+							   self._sources(n,store.mass[:n]),self.softening)
+		return self.G*entity.mass*field[0]
+		
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		field = inverse_square_field(positions,self._sources(len(positions),masses),
+									 self.theta,self.softening,self.exactBelow)
+		return (self.G*masses)[:,None]*field
+		
+class MutualElectricField(MutualGravity):
+	"""
+	Coulomb forces between every pair of charged entities, approximated
+	the same way as MutualGravity. Like charges repel.
+	
+	Arguments:
+	--------------------------------------------------------------------    
+	E0			| permittivity of free space (8.85E-12 C^2/(N*m^2))
+	theta, softening, exactBelow as for MutualGravity
+	--------------------------------------------------------------------
+	"""
+	def __init__(self,world,E0=8.85e-12,theta=0.5,softening=0.1,exactBelow=256):
+		MutualGravity.__init__(self,world,0.,theta,softening,exactBelow)
+		self.name = "MutualElectricField"
+		self.FourPiE0 = 4*math.pi*E0 / world.scale**2
+		
+	def get_vector(self,entity):
+		if not entity.charge:
+			return np.array((0.,0.))
+		store = self.world.store
+		n = store.count
+		field = pairwise_field(entity.position[None,:],store.position[:n],
+							   self._sources(n,np.nan_to_num(store.charge[:n])),self.softening)
+		return -entity.charge*field[0]/self.FourPiE0
+		
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		charges = np.nan_to_num(charges)
+		field = inverse_square_field(positions,self._sources(len(positions),charges),
+									 self.theta,self.softening,self.exactBelow)
+		return (-charges/self.FourPiE0)[:,None]*field
 			
 class Friction(Field):
 	"""
@@ -79,22 +199,43 @@ class Friction(Field):
 	class to implement friction
 	"""
 	def __init__(self,world,muS,muK):
-		Field.__init__("Friction",world)
+		Field.__init__(self,"Friction",world)
 		self.muS = muS
 		self.muK = muK
 		
 	def apply(self,entity):
 		if LA.norm(entity.velocity) <= 0.01:
 			if LA.norm(entity.force) > 0:
-				staticFriction = -min(self.muS*entity.mass*self.gravity/LA.norm(entity.force),1)*entity.force
+				staticFriction = -min(self.muS*entity.mass*self.world.gravity/LA.norm(entity.force),1)*entity.force
 				#print "static friction:",staticFriction
-				entity.add_force(staticFriction)
+				entity.add_field_force(staticFriction)
 				return
 			else:
 				entity.velocity = np.array((0.,0.))
 		else:
-			kineticFriction = -self.muK*entity.mass*self.gravity*entity.velocity/LA.norm(entity.velocity)
+			kineticFriction = -self.muK*entity.mass*self.world.gravity*entity.velocity/LA.norm(entity.velocity)
 			#print "kinitec friction:",kineticFriction, "velocity:",entity.velocity
-			entity.add_force(kineticFriction)
+			entity.add_field_force(kineticFriction)
 			return
+			
+	def get_forces(self,positions,velocities,masses,charges,forces):
+		g = self.world.gravity
+		speed = np.sqrt(np.einsum('ij,ij->i',velocities,velocities))
+		applied = np.sqrt(np.einsum('ij,ij->i',forces,forces))
+		resting = speed <= 0.01
+		friction = np.zeros_like(velocities)
+		
+		moving = ~resting
+		friction[moving] = -(self.muK*masses[moving]*g/speed[moving])[:,None]*velocities[moving]
+		
+		pushed = resting & (applied > 0)
+		scale = np.minimum(self.muS*masses[pushed]*g/applied[pushed],1)
+		friction[pushed] = -scale[:,None]*forces[pushed]
+		return friction
+		
+	def adjust_velocities(self,velocities,forces,movable):
+		# Entities at rest with nothing pushing them stop completely
+		speed = np.sqrt(np.einsum('ij,ij->i',velocities,velocities))
+		stopped = movable & (speed <= 0.01) & ~forces.any(axis=1)
+		velocities[stopped] = 0.
 		
@@ -1,38 +1,247 @@
 import pygame
 from pygame.locals import *
+import math
+import random
 import numpy as np
 from numpy import linalg as LA
+
+from EntityStore import EntityStore
+from SpatialHash import SpatialHash,StaticGrid
+from DirtyRegion import DirtyRegion
+from Input import PygameInput,StaticInput
+from Profiler import FrameProfiler
+from Integrators import get_integrator
+from ImageCache import images as sharedImages
+from TextCache import text_cache
+from timeit import default_timer as timer
  
 DEBUG = True
+
+def _call(phase,function,*args):
+    # Stands in for FrameProfiler.phase when profiling is off
+    return function(*args)
+
+_inherited = {}
+
+def _inherits(cls,name,function):
+    # True if cls uses function as its method `name` (cached per class)
+    key = (cls,name)
+    result = _inherited.get(key)
+    if result is None:
+        method = getattr(cls,name)
+        result = _inherited[key] = getattr(method,'__func__',method) is function
+    return result
+
+class EntityGroup(list):
+    """
+    List of entities with constant time membership tests and removal.
+    Removing an entity moves the last one into its place, so insertion
+    order is not preserved.
+    """
+    def __init__(self,entities=()):
+        list.__init__(self)
+        self._index = {}
+        for entity in entities:
+            self.append(entity)
+
+    def __contains__(self,entity):
+        return entity in self._index
+
+    def append(self,entity):
+        self._index[entity] = len(self)
+        list.append(self,entity)
+
+    def remove(self,entity):
+        try:
+            i = self._index.pop(entity)
+        except KeyError:
+            raise ValueError("entity not in group")
+        last = list.pop(self)
+        if last is not entity:
+            self[i] = last
+            self._index[last] = i
  
 class World(object):
-    def __init__(self,name,surface,background=None,framesPerSecond=40):
+    """
+    Arguments:
+    --------------------------------------------------------------------
+    surface         | display surface, or None for a headless world that
+                    | never touches pygame.display
+    framesPerSecond | target frame rate of main_loop
+    cellSize        | cell size of the spatial hash (and of the static
+                    | grid of static entities), in pixels
+    size            | world size in pixels (defaults to the surface size;
+                    | required when headless)
+    fixedTimestep   | if set, physics advances in ticks of exactly this
+                    | many seconds, however long a frame takes
+    interpolation   | with a fixed timestep, draw entities between their
+                    | last two tick positions for smooth motion
+    input           | InputProvider entities read the mouse and keys from
+                    | (defaults to live pygame input, or a StaticInput
+                    | when headless)
+    images          | ImageCache entity images are shared through
+                    | (defaults to the one shared by all worlds)
+    camera          | Camera onto a world larger than the screen. Only
+                    | entities in view are erased, drawn and pushed to
+                    | the display, in screen coordinates; entities with
+                    | their own render method must use world.camera too.
+                    | The background stays fixed to the screen.
+    seed            | seed of world.random, the generator entities should
+                    | draw random numbers from (None: taken from the
+                    | random module, so seeding that seeds the world)
+    --------------------------------------------------------------------
+    """
+    # Longest frame the fixed timestep accumulator will catch up on
+    maxFrameTime = 0.25
+
+    def __init__(self,name,surface,background=None,framesPerSecond=40,cellSize=64,
+                 size=None,fixedTimestep=None,interpolation=False,input=None,images=None,
+                 camera=None,seed=None):
         self.name = name
         self.surface = surface
         self.background = background
         self.entities = {}
+        self._allEntities = EntityGroup()
+        # All but the static entities: the ones looked at every tick
+        self._dynamic = EntityGroup()
+        self._instances = {}
+        self._pools = {}
+        self.spatialHash = SpatialHash(cellSize)
+        self.staticGrid = StaticGrid(cellSize)
         self.framesPerSecond = framesPerSecond
         self.clock = pygame.time.Clock()
         self.isPaused = True
-        self.size = np.array(surface.get_size())
+        self.headless = surface is None
+        if size is None:
+            size = surface.get_size()
+        self.size = np.array(size)
+        self.fixedTimestep = fixedTimestep
+        self.interpolation = interpolation
+        self.accumulator = 0.
+        self.tickCount = 0
+        # Changes whenever entities are added or removed
+        self.version = 0
+        if input is None:
+            input = StaticInput() if self.headless else PygameInput()
+        self.input = input
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.recorder = None
+        self.images = sharedImages if images is None else images
+        self.profiler = None
+        self.publisher = None
+        self._erased = []
+        # Areas to erase and redraw at the next render: where static
+        # entities were added, moved from or removed
+        self._uncovered = []
+        self._layered = False
+        self._drawLists = None
+        self.camera = camera
+        self._cameraVersion = None
+        self._drawn = []
+
+        self.dirtyRegion = None
+        if self.headless:
+            return
+        self.dirtyRegion = DirtyRegion(surface.get_rect())
  
         if not self.background:
-            self.background = pygame.Surface(self.size)
+            self.background = pygame.Surface(surface.get_size())
             self.background.fill(pygame.Color('white'))
+        # Erasing blits from the background every frame
+        if pygame.display.get_surface() is not None:
+            self.background = self.background.convert()
  
  
     def add(self,entity):
         if entity.type in self.entities:
             self.entities[entity.type].append(entity)
         else:
-            self.entities[entity.type] = [entity]
- 
+            self.entities[entity.type] = EntityGroup([entity])
+        self._allEntities.append(entity)
+        if not entity.static:
+            self._dynamic.append(entity)
+        if entity.layer:
+            self._layered = True
+        self._drawLists = None
+        self.version += 1
+        for cls,group in self._instances.items():
+            if isinstance(entity,cls):
+                group.append(entity)
+        if entity.rect is not None:
+            if entity.static:
+                self.staticGrid.insert(entity)
+                if not self.headless:
+                    self._uncovered.append(entity.rect.copy())
+            else:
+                self.spatialHash.insert(entity)
+        entity.attach()
+
     def remove(self,entity):
+        if self._unlink(entity):
+            entity.detach()
+
+    def spawn(self,cls,*args,**kwargs):
+        """
+        Adds cls(world,*args,**kwargs) to the world, reusing an entity of
+        that class given to release() if there is one: it is initialized
+        again in place, along with its slot in the entity store.
+        returns:    the entity
+        """
+        pool = self._pools.get(cls)
+        if pool:
+            entity = pool.pop()
+            entity.__init__(self,*args,**kwargs)
+        else:
+            entity = cls(self,*args,**kwargs)
+        self.add(entity)
+        return entity
+
+    def release(self,entity):
+        """
+        Removes entity from the world and keeps it for spawn() to reuse.
+        Unlike remove(), its state is thrown away; do not use it again.
+        """
+        if self._unlink(entity):
+            entity.recycle()
+            self._pools.setdefault(type(entity),[]).append(entity)
+
+    def _unlink(self,entity):
+        # Everything remove() and release() share
         try:
             self.entities[entity.type].remove(entity)
-        except ValueError:
+        except (KeyError,ValueError):
             print "Entity does not exist in the world "+self.name
             print "Not removed."
+            return False
+        self._allEntities.remove(entity)
+        if entity in self._dynamic:
+            self._dynamic.remove(entity)
+        for group in self._instances.values():
+            if entity in group:
+                group.remove(entity)
+        self.spatialHash.remove(entity)
+        self.staticGrid.remove(entity)
+        self._drawLists = None
+        self.version += 1
+        if self.dirtyRegion:
+            self.dirtyRegion.forget(entity)
+            # Sleeping and static entities are not erased every frame
+            if (entity.asleep or entity.static) and entity.rect is not None:
+                self._uncovered.append(entity.rect.copy())
+        return True
+
+    def update_static(self,entity):
+        """
+        Call after moving or changing a static entity (set_position does
+        for static bodies): it is rebucketed in the static grid, and it and
+        the area it left are redrawn at the next render
+        """
+        old = self.staticGrid.update(entity)
+        if not self.headless and old is not None:
+            self._uncovered.extend((old,entity.rect.copy()))
  
     def get_group(self,identifier):
         """
@@ -49,26 +258,194 @@ class World(object):
         return []
  
     def get_entities(self):
-        entitiesList = []
-        for group in self.entities.values():
-            for entity in group:
-                entitiesList.append(entity)
+        """
+        returns:    every entity in the world. The list is maintained by the
+                    world; do not modify it
+        """
+        return self._allEntities
+
+    def get_instances(self,cls):
+        """
+        @param cls:     entity class (or tuple of classes)
+ 
+        returns:    entities that are instances of cls. The list is built on
+                    the first request and kept up to date afterwards; do not
+                    modify it
+        """
+        group = self._instances.get(cls)
+        if group is None:
+            group = EntityGroup(entity for entity in self._allEntities
+                                if isinstance(entity,cls))
+            self._instances[cls] = group
+        return group
  
-        return entitiesList
+    def query_rect(self,rect):
+        """
+        returns:    list of entities whose rect intersects rect, static ones
+                    included
+        """
+        found = self.spatialHash.query_rect(rect)
+        if len(self.staticGrid):
+            found += self.staticGrid.query_rect(rect)
+        return found
+
+    def query_point(self,point):
+        """
+        returns:    list of entities whose rect contains point (in pixels)
+        """
+        found = self.spatialHash.query_point(point)
+        if len(self.staticGrid):
+            found += self.staticGrid.query_point(point)
+        return found
  
     def process(self,dt):
-        for group in self.entities.values():
-            for entity in group:
+        if self.profiler:
+            self.profiler.process_entities(self._dynamic,dt)
+            return
+        for entity in self._dynamic:
+            if not entity.asleep:
                 entity.process(dt)
  
+    def draw_order(self):
+        # Entities from the lowest layer up; add order within a layer
+        if self._layered:
+            return sorted(self._allEntities,key=lambda entity: entity.layer)
+        return list(self._allEntities)
+
+    def _draw_lists(self):
+        """
+        returns:    (runs,plain,custom) where runs is the draw order split
+                    into lists of entities drawn with GraphicEntity.render
+                    and single entities with their own render, and plain
+                    and custom split the entities that are not static by
+                    erase method. Rebuilt when entities are added or
+                    removed.
+        """
+        if self._drawLists is None:
+            runs = []
+            for entity in self.draw_order():
+                if _inherits(type(entity),'render',_graphicRender):
+                    if not runs or not isinstance(runs[-1],list):
+                        runs.append([])
+                    runs[-1].append(entity)
+                else:
+                    runs.append(entity)
+            plain,custom = [],[]
+            for entity in self._dynamic:
+                if _inherits(type(entity),'erase',_graphicErase):
+                    plain.append(entity)
+                else:
+                    custom.append(entity)
+            self._drawLists = (runs,plain,custom)
+        return self._drawLists
+
+    def has_sleepers(self):
+        return False
+
     def render(self,surface):
-        for group in self.entities.values():
-            for entity in group:
-                entity.render(surface)
+        """
+        Draws every entity in layer order. Entities that draw their image at
+        their rect (GraphicEntity.render) are culled against the surface
+        and blitted together; any other render method is called in turn.
+        """
+        uncovered,self._uncovered = self._uncovered,[]
+        if self.camera:
+            # Everything in view is redrawn anyway
+            return self.render_view(surface)
+        screen = surface.get_rect()
+        blits = getattr(surface,'fblits',None) or surface.blits
+        if uncovered:
+            # fblits only takes (source,dest) pairs
+            surface.blits([(self.background,rect,rect) for rect in uncovered],False)
+            self._erased.extend(uncovered)
+            for rect in uncovered:
+                self.dirtyRegion.mark(rect)
+        # Sleeping entities are only redrawn where something was erased
+        # over them
+        redraw = None
+        if self.has_sleepers():
+            redraw = set()
+            for rect in self._erased:
+                redraw.update(self.query_rect(rect))
+        for run in self._draw_lists()[0]:
+            if not isinstance(run,list):
+                if redraw is None or not run.asleep or run in redraw:
+                    run.render(surface)
+                continue
+            if redraw is not None:
+                run = [entity for entity in run if not entity.asleep or entity in redraw]
+            visible = screen.collidelistall([entity.rect for entity in run])
+            if len(visible) < len(run):
+                run = [run[i] for i in visible]
+            blits([(entity.image,entity.rect) for entity in run],False)
  
+    def render_view(self,surface):
+        """
+        Draws the entities the camera can see, found through the spatial
+        hash, at their screen positions
+        """
+        camera = self.camera
+        index = self._allEntities._index
+        visible = sorted(self.query_rect(camera.view_rect()),
+                         key=lambda entity: (entity.layer,index[entity]))
+        blits = getattr(surface,'fblits',None) or surface.blits
+        draws = []
+        drawn = self._drawn
+        for entity in visible:
+            if _inherits(type(entity),'render',_graphicRender):
+                rect = camera.to_screen(entity.rect)
+                draws.append((camera.image(entity.image),rect))
+                drawn.append(rect)
+            else:
+                if draws:
+                    blits(draws,False)
+                    draws = []
+                entity.render(surface)
+        if draws:
+            blits(draws,False)
+
+    def clean_view(self):
+        # Erase what was drawn last frame, or everything if the camera moved
+        camera = self.camera
+        background = self.background
+        if camera.version != self._cameraVersion:
+            self._cameraVersion = camera.version
+            self.surface.blit(background,(0,0))
+            self.dirtyRegion.mark(self.surface.get_rect())
+        else:
+            self.surface.blits([(background,rect,rect) for rect in self._drawn],False)
+        for rect in self._drawn:
+            self.dirtyRegion.mark(rect)
+        for entity in self._draw_lists()[2]:
+            entity.erase()
+        self._drawn = []
+
+    def display(self):
+        # Push the parts of the screen that changed
+        if self.camera:
+            for rect in self._drawn:
+                self.dirtyRegion.mark(rect)
+            self.dirtyRegion.update(())
+        else:
+            # Static entities only change where they uncovered something
+            self.dirtyRegion.update(self._dynamic)
+
     def clean(self):
-        for entity in self.get_entities():
+        if self.camera:
+            return self.clean_view()
+        # Remember what was erased: entities that fall asleep before the
+        # next render still have to be drawn back
+        runs,plain,custom = self._draw_lists()
+        if self.has_sleepers():
+            plain = [entity for entity in plain if not entity.asleep]
+            custom = [entity for entity in custom if not entity.asleep]
+        erased = self._erased = [entity.rect.copy() for entity in plain]
+        background = self.background
+        self.surface.blits([(background,rect,rect) for rect in erased],False)
+        for entity in custom:
             entity.erase()
+            if entity.rect is not None:
+                erased.append(entity.rect.copy())
  
     def get_rects(self):
         rects = []
@@ -80,7 +457,9 @@ class World(object):
     def run_main_loop(self):
         while True:
             self.main_loop()
-           
+            # A headless server loop has no window to close
+            if not pygame.display.get_init():
+                continue
             for event in pygame.event.get():
                 if event.type == QUIT:
                     return
@@ -91,25 +470,180 @@ class World(object):
     def main_loop(self):
         dtInMilliseconds = self.clock.tick(self.framesPerSecond)
         dt = dtInMilliseconds/1000.
-        # Store previous rects...
-        dirtyRects = self.get_rects()
-        self.clean()
-        self.process(dt)
-        self.render(self.surface)
-        # ...and new rects for efficient updating display
-        dirtyRects.extend(self.get_rects())
- 
-        pygame.display.update(dirtyRects)
+        self.frame(dt)
+
+    def frame(self,dt):
+        # Simulate dt seconds and draw the result (headless worlds only
+        # simulate)
+        profiler = self.profiler
+        phase = _call
+        if profiler:
+            profiler.begin_frame()
+            phase = profiler.phase
+        if not self.headless:
+            phase('clean',self.clean)
+        if self.fixedTimestep:
+            self.advance(dt)
+        else:
+            self.tick(dt)
+            self.tickCount += 1
+        if not self.headless:
+            phase('render',self.render,self.surface)
+            phase('display',self.display)
+        if self.publisher:
+            self.publisher.publish()
+        if profiler:
+            profiler.end_frame()
+
+    def tick(self,dt):
+        # One simulation step, with no rendering
+        phase = self.profiler.phase if self.profiler else _call
+        phase('input',self.read_input,dt)
+        phase('process',self.process,dt)
+
+    def read_input(self,dt):
+        # Polls the input provider at the start of a tick of dt seconds
+        self.input.update()
+        if self.recorder:
+            self.recorder.record(dt)
+
+    def advance(self,frameTime):
+        """
+        Runs as many fixed timestep ticks as fit in the time accumulated so
+        far, carrying the remainder over to the next frame
+        """
+        h = self.fixedTimestep
+        self.restore_positions()
+        self.accumulator += min(frameTime,self.maxFrameTime)
+        while self.accumulator >= h:
+            if self.interpolation:
+                self.save_positions()
+            self.tick(h)
+            self.tickCount += 1
+            self.accumulator -= h
+        if self.interpolation:
+            self.interpolate(self.accumulator/h)
+
+    def step(self,n=1,dt=None):
+        """
+        Runs n ticks of dt seconds as fast as possible without rendering.
+        dt defaults to the fixed timestep if there is one, otherwise
+        1/framesPerSecond
+        """
+        if dt is None:
+            dt = self.fixedTimestep or 1./self.framesPerSecond
+        self.restore_positions()
+        profiler = self.profiler
+        for i in range(n):
+            if profiler:
+                profiler.begin_frame()
+            self.tick(dt)
+            self.tickCount += 1
+            if self.publisher:
+                self.publisher.publish()
+            if profiler:
+                profiler.end_frame()
+
+    def enable_profiling(self,capacity=600):
+        """
+        Starts recording per-phase timings of the last `capacity` frames.
+        returns:    the FrameProfiler, also available as world.profiler
+        """
+        if self.profiler is None:
+            self.profiler = FrameProfiler(self,capacity)
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def enable_publishing(self,name,capacity=1024):
+        """
+        Starts publishing every entity's state to the shared memory block
+        `name` after each tick, for Snapshot.StateReader in other processes.
+        returns:    the Snapshot.StatePublisher, also world.publisher
+        """
+        from Snapshot import StatePublisher
+        if self.publisher is None:
+            self.publisher = StatePublisher(self,name,capacity)
+        return self.publisher
+
+    def disable_publishing(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def start_recording(self,path,factory,config=None,keyframeEvery=500):
+        """
+        Starts logging every tick's input to the file at path, with a
+        keyframe of the whole simulation every keyframeEvery ticks, so that
+        Replay.Replayer can re-run it headless from any tick. factory is
+        the module level function that builds this world (called with
+        **config and no surface when replaying).
+        returns:    the Replay.Recorder, also world.recorder
+        """
+        from Replay import Recorder
+        if self.recorder is None:
+            self.recorder = Recorder(self,path,factory,config,keyframeEvery)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def save_state(self):
+        """
+        returns:    a picklable record of the simulation: the tick count,
+                    world.random and every entity's get_state(), in
+                    get_entities() order
+        """
+        self.restore_positions()
+        entities = self._allEntities
+        return {'tick':self.tickCount,'accumulator':self.accumulator,
+                'random':self.random.getstate(),
+                'types':[entity.type for entity in entities],
+                'entities':[entity.get_state() for entity in entities]}
+
+    def load_state(self,state):
+        """
+        Puts the simulation back to a state from save_state(). The world
+        must hold the same entities, added in the same order, as the one
+        that saved it (a world built by the same factory).
+        """
+        entities = self._allEntities
+        if state['types'] != [entity.type for entity in entities]:
+            raise ValueError("State does not match the entities of world "+self.name)
+        self.restore_positions()
+        self.tickCount = state['tick']
+        self.accumulator = state['accumulator']
+        self.random.setstate(state['random'])
+        for entity,entityState in zip(entities,state['entities']):
+            entity.set_state(entityState)
+
+    def save_positions(self):
+        # Remember where entities are before a tick, for interpolation
+        pass
+
+    def interpolate(self,alpha):
+        """
+        Moves entity rects a fraction alpha of the way from their position
+        before the last tick to their current one, for drawing only
+        """
+        pass
+
+    def restore_positions(self):
+        # Undo interpolate() before the simulation runs again
+        pass
  
     def display_message(self,message):
         # This function will eventually show the message in the GUI
         print message
        
     def get_height(self):
-        return self.surface.get_height()
+        return int(self.size[1])
  
     def get_width(self):
-        return self.surface.get_width()
+        return int(self.size[0])
  
     def pause(self):
         self.isPaused = True
@@ -118,6 +652,27 @@ class World(object):
         self.isPaused = False
            
 class Entity(object):
+    # The engine's entity classes keep their attributes in slots rather
+    # than a __dict__, so hosting many small entities is cheap. Subclasses
+    # that do not declare __slots__ get a __dict__ as usual.
+    __slots__ = ('world','type','rect')
+    # True while the world advances this entity in a batch instead of
+    # calling its process method
+    batched = False
+    # Sleeping entities are not processed, redrawn or collision checked
+    asleep = False
+    # Drawn over entities in lower layers; set before adding the entity
+    # (on the class, or on instances of subclasses with a __dict__)
+    layer = 0
+    # True while the entity looks different every frame without a new
+    # image or rect, so it is pushed to the display every frame
+    animated = False
+    # Static entities stay where they are put: they are kept in the
+    # world's static grid instead of its spatial hash, and static bodies
+    # (NewtonianEntity) are never integrated, woken or redrawn unless
+    # moved. Set before adding the entity.
+    static = False
+
     def __init__(self,world):
         self.world = world
         self.type = "Entity"
@@ -134,14 +689,42 @@ class Entity(object):
  
     def get_rect(self):
         return None
+
+    def get_state(self):
+        """
+        returns:    anything besides the world's own records needed to put
+                    this entity back as it is now (see World.save_state);
+                    must be picklable
+        """
+        return None
+
+    def set_state(self,state):
+        # Restores what get_state returned
+        pass
+
+    def attach(self):
+        # Called by the world after the entity has been added
+        pass
+
+    def detach(self):
+        # Called by the world after the entity has been removed
+        pass
+
+    def recycle(self):
+        # Called instead of detach() when the entity is released to the
+        # world's pool: drop what the next __init__ will set up again
+        pass
  
 class GraphicEntity(Entity):
+    __slots__ = ('position','image','size')
+
     def __init__(self,world,position,image=None):
         self.world = world
         self.position = np.array(position)
-        self.image = image
         if not image:
-            self.image = pygame.Surface((1,1))
+            self.image = self.world.images.solid((1,1))
+        else:
+            self.image = self.world.images.get(image)
  
         self.size = np.array(self.image.get_size())
         self.type = "GraphicEntity"
@@ -155,10 +738,294 @@ class GraphicEntity(Entity):
  
     def get_rect(self):
         return self.rect.copy()
+
+    def get_state(self):
+        return tuple(self.position)
+
+    def set_state(self,position):
+        self.move_to(position)
  
     def move_to(self,position):
         self.position = np.array(position)
         self.rect.center = self.position
+        self.rect_changed()
+
+    def rect_changed(self):
+        # Call after moving or resizing the rect; static entities are also
+        # redrawn, and erased where they were
+        if self.static:
+            self.world.update_static(self)
+        else:
+            self.world.spatialHash.update(self)
+
+_graphicRender = getattr(GraphicEntity.render,'__func__',GraphicEntity.render)
+_graphicErase = getattr(GraphicEntity.erase,'__func__',GraphicEntity.erase)
+
+class TextEntity(GraphicEntity):
+    """
+    A line of text centred on position. Rendered strings come from a
+    TextCache, so showing a string seen recently (or made of digits)
+    costs no font rendering.
+
+    Arguments:
+    --------------------------------------------------------------------
+    position        | centre of the text in pixels
+    text            | string to show
+    fontName        | font file, or None for pygame's default font
+    size            | font size
+    color           | text colour
+    cache           | TextCache to render with (defaults to the one shared
+                    | by everything using this font, size and colour)
+    --------------------------------------------------------------------
+    """
+    __slots__ = ('cache','text')
+
+    def __init__(self,world,position,text="",fontName=None,size=30,color='black',cache=None):
+        GraphicEntity.__init__(self,world,position)
+        self.type = "TextEntity"
+        if cache is None:
+            cache = text_cache(fontName,size,color)
+        self.cache = cache
+        self.text = None
+        self.set_text(text)
+
+    def get_state(self):
+        return (tuple(self.position),self.text)
+
+    def set_state(self,state):
+        position,text = state
+        self.position = np.array(position)
+        self.set_text(text)
+        self.rect.center = self.position
+        self.rect_changed()
+
+    def set_text(self,text):
+        if text == self.text:
+            return
+        self.text = text
+        self.image = self.cache.get(text)
+        self.size = np.array(self.image.get_size())
+        self.rect = pygame.Rect(self.position - self.size/2,self.size)
+        self.rect_changed()
+
+
+class ParticleSystem(Entity):
+    """
+    Many short lived particles handled as one entity. Their state is kept
+    in NumPy arrays: every tick they age, dead ones are dropped by
+    compacting the arrays and the rest move together under the world's
+    fields. They are drawn in one pass straight into the surface's pixels
+    and take up one rect, their bounding box, in the spatial hash and the
+    dirty region.
+
+    The particles' positions and velocities arrays are in pixels and pixels
+    per second. They are named apart from the position attribute of other
+    entities, which is a single point.
+
+    Arguments:
+    --------------------------------------------------------------------
+    capacity        | most particles alive at once; particles emitted
+                    | beyond it are dropped
+    particleSize    | side of each particle's square, in pixels
+    mass            | mass of every particle (kg), for fields
+    charge          | charge of every particle (C), or None
+    acceleration    | constant acceleration of every particle (pixels/s^2)
+    fields          | fields acting on the particles (defaults to the
+                    | world's). Only fields with get_forces are used, and
+                    | not mutual ones: particles do not attract each other
+    --------------------------------------------------------------------
+    """
+    __slots__ = ('capacity','count','particleSize','mass','charge','acceleration','fields',
+                 'positions','velocities','age','lifetime','color')
+
+    def __init__(self,world,capacity=4096,particleSize=2,mass=1e-3,charge=None,
+                 acceleration=(0,0),fields=None):
+        self.world = world
+        self.type = "ParticleSystem"
+        self.capacity = capacity
+        self.count = 0
+        self.particleSize = particleSize
+        self.mass = mass
+        self.charge = charge
+        self.acceleration = np.array(acceleration,float)
+        self.fields = fields
+        self.positions = np.zeros((capacity,2))
+        self.velocities = np.zeros((capacity,2))
+        self.age = np.zeros(capacity)
+        self.lifetime = np.zeros(capacity)
+        self.color = np.zeros((capacity,3),np.uint8)
+        self.rect = pygame.Rect(0,0,0,0)
+
+    @property
+    def animated(self):
+        return self.count > 0
+
+    def __len__(self):
+        return self.count
+
+    def emit(self,position,velocity=(0,0),lifetime=1.,color='black'):
+        """
+        Adds particles. Each argument is either one value for all of them
+        or an array with a row per particle; there are as many particles
+        as the longest argument has rows.
+        returns:    the number of particles added (fewer if full)
+        """
+        if isinstance(color,str):
+            color = pygame.Color(color)
+        color = np.asarray(tuple(color) if isinstance(color,pygame.Color) else color)
+        color = color[:3] if color.ndim == 1 else color[:,:3]
+        columns = (np.asarray(position,float).reshape(-1,2),
+                   np.asarray(velocity,float).reshape(-1,2),
+                   np.asarray(lifetime,float).reshape(-1),
+                   color.reshape(-1,3))
+        n = max(len(column) for column in columns)
+        start = self.count
+        k = min(n,self.capacity-start)
+        end = start + k
+        for array,column in zip((self.positions,self.velocities,self.lifetime,self.color),columns):
+            array[start:end] = np.broadcast_to(column,(n,)+array.shape[1:])[:k]
+        self.age[start:end] = 0.
+        self.count = end
+        return k
+
+    def burst(self,n,position,speed,lifetime=1.,color='black',velocity=(0,0),
+              direction=0.,spread=2*math.pi):
+        """
+        Emits n particles from position, flying off at up to speed
+        (pixels/s) in directions within spread radians of direction, on
+        top of velocity, and living between half and all of lifetime.
+        Random numbers come from world.random, so bursts replay exactly.
+        """
+        generator = np.random.RandomState(self.world.random.getrandbits(32))
+        angle = direction + spread*(generator.random_sample(n) - .5)
+        speeds = speed*generator.random_sample(n)
+        velocities = np.array(velocity,float) + speeds[:,None]*np.column_stack((np.cos(angle),np.sin(angle)))
+        lifetimes = lifetime*(.5 + .5*generator.random_sample(n))
+        return self.emit(position,velocities,lifetimes,color)
+
+    def process(self,dt):
+        n = self.count
+        if n:
+            age = self.age[:n]
+            age += dt
+            alive = age < self.lifetime[:n]
+            if not alive.all():
+                n = self.compact(np.flatnonzero(alive))
+        if n:
+            acceleration = self.acceleration
+            forces = self.field_forces(n)
+            if forces is not None:
+                acceleration = acceleration + forces/self.mass
+            velocity = self.velocities[:n]
+            velocity += acceleration*dt
+            self.positions[:n] += velocity*dt
+        self.update_rect()
+
+    def compact(self,keep):
+        """
+        Keeps only the particles at the indices keep, moving them to the
+        front of the arrays in order.
+        returns:    the new count
+        """
+        k = len(keep)
+        for array in (self.positions,self.velocities,self.age,self.lifetime,self.color):
+            array[:k] = array[keep]
+        self.count = k
+        return k
+
+    def field_forces(self,n):
+        # Sum of the fields' forces on the first n particles, or None
+        fields = getattr(self.world,'fields',()) if self.fields is None else self.fields
+        total = None
+        for field in fields:
+            if getattr(field,'mutual',False):
+                continue
+            if total is None:
+                masses = np.full(n,float(self.mass))
+                charges = np.full(n,np.nan if self.charge is None else float(self.charge))
+                applied = np.zeros((n,2))
+            forces = field.get_forces(self.positions[:n],self.velocities[:n],masses,charges,applied)
+            if forces is not None:
+                total = forces if total is None else total + forces
+        if total is None:
+            return None
+        return total * getattr(self.world,'scale',1.)
+
+    def update_rect(self):
+        # Bounding box of the particles, clipped to the world
+        n = self.count
+        if n:
+            position = self.positions[:n]
+            limit = np.array(self.world.size,float)
+            low = np.clip(np.floor(position.min(axis=0)),0,limit)
+            high = np.clip(np.floor(position.max(axis=0))+self.particleSize,0,limit)
+            rect = pygame.Rect(int(low[0]),int(low[1]),int(high[0]-low[0]),int(high[1]-low[1]))
+        else:
+            rect = pygame.Rect(0,0,0,0)
+        if rect != self.rect:
+            self.rect = rect
+            self.world.spatialHash.update(self)
+
+    def get_rect(self):
+        return self.rect.copy()
+
+    def render(self,surface):
+        n = self.count
+        if not n:
+            return
+        position = self.positions[:n]
+        size = self.particleSize
+        camera = self.world.camera
+        if camera:
+            position = (position - camera.position)*camera.zoom
+            size = max(1,int(round(size*camera.zoom)))
+        x = np.floor(position[:,0]).astype(int)
+        y = np.floor(position[:,1]).astype(int)
+        w,h = surface.get_size()
+        inside = np.flatnonzero((x >= 0) & (y >= 0) & (x <= w-size) & (y <= h-size))
+        if not len(inside):
+            return
+        x,y,color = x[inside],y[inside],self.color[:n][inside]
+        if camera:
+            drawn = pygame.Rect(x.min(),y.min(),x.max()-x.min()+size,y.max()-y.min()+size)
+            self.world._drawn.append(drawn)
+        if surface.get_bitsize() == 32:
+            mapped = self.map_colors(surface,color)
+            pixels = pygame.surfarray.pixels2d(surface)
+            for dx in range(size):
+                for dy in range(size):
+                    pixels[x+dx,y+dy] = mapped
+            del pixels
+        else:
+            for left,top,rgb in zip(x.tolist(),y.tolist(),color.tolist()):
+                surface.fill(rgb,(left,top,size,size))
+
+    def map_colors(self,surface,color):
+        # Pixel values of RGB colours on a 32 bit surface, all at once
+        color = color.astype(np.uint32)
+        shifts = surface.get_shifts()
+        losses = surface.get_losses()
+        mapped = np.uint32(surface.get_masks()[3])
+        for i in range(3):
+            mapped = mapped | ((color[:,i] >> losses[i]) << shifts[i])
+        return mapped
+
+    def erase(self):
+        # Under a camera the world erases what render() reported drawing
+        if not self.world.camera:
+            self.world.surface.blit(self.world.background,self.rect,self.rect)
+
+    def get_state(self):
+        n = self.count
+        return tuple(array[:n].copy() for array in
+                     (self.positions,self.velocities,self.age,self.lifetime,self.color))
+
+    def set_state(self,state):
+        n = len(state[0])
+        for array,column in zip((self.positions,self.velocities,self.age,self.lifetime,self.color),state):
+            array[:n] = column
+        self.count = n
+        self.update_rect()
              
  
 class NewtonWorld(World):
@@ -166,22 +1033,160 @@ class NewtonWorld(World):
     Arguments:
     --------------------------------------------------------------------    
     scale           | pixels per meter (to set physical constants appropriately)
+    integrator      | 'semi-implicit', 'verlet', 'rk4', 'euler' or an
+                    | Integrators.Integrator instance
+    maxStepSize     | longest physics step in seconds; longer ticks are
+                    | split into equal substeps (None: never split)
+    sleepDelay      | seconds an entity must rest before it is put to
+                    | sleep (None: never sleep)
+    sleepVelocity   | speed below which an entity is resting (m/s)
+    sleepAcceleration | net acceleration below which an entity is
+                    | resting (m/s^2)
+    options         | passed on to World (size, fixedTimestep, input, ...)
     --------------------------------------------------------------------
     """
-    def __init__(self,name,surface,background=None,framesPerSecond=40,scale=10,muS=0.3,muK=0.2):
-        World.__init__(self,name,surface,background,framesPerSecond)
+    def __init__(self,name,surface,background=None,framesPerSecond=40,scale=10,muS=0.3,muK=0.2,
+                 integrator='semi-implicit',maxStepSize=None,sleepDelay=0.5,
+                 sleepVelocity=0.01,sleepAcceleration=0.01,**options):
+        World.__init__(self,name,surface,background,framesPerSecond,**options)
         self.scale = scale
+        self.store = EntityStore()
+        self.integrator = get_integrator(integrator)
+        self.maxStepSize = maxStepSize
+        self.sleepDelay = sleepDelay
+        self.sleepVelocity = sleepVelocity
+        self.sleepAcceleration = sleepAcceleration
+        self._interpolated = False
+        self._batchedFields = []
+        self._otherFieldForce = None
+        self.predictor = None
        
         # Define Physical Constants
         self.fields = []
         self.gravity = 9.8 * scale  # Gravitational force into the screen
+
+    def process(self,dt):
+        # Entities with custom behaviour are processed one at a time; the
+        # rest are integrated together from the entity store
+        profiler = self.profiler
+        if profiler:
+            profiler.process_entities([entity for entity in self._dynamic
+                                       if not (entity.batched or entity.asleep)],dt)
+            start = timer()
+            self.store.integrate(dt,self.integrator,self.acceleration,self.spatialHash)
+            profiler.add_type_time("(batched)",timer()-start)
+        else:
+            for entity in self._dynamic:
+                if not (entity.batched or entity.asleep):
+                    entity.process(dt)
+            self.store.integrate(dt,self.integrator,self.acceleration,self.spatialHash)
+        if self.sleepDelay is not None:
+            self.store.update_sleep(dt,self.sleepVelocity*self.scale,
+                                    self.sleepAcceleration*self.scale,self.sleepDelay)
+
+    def acceleration(self,slots,positions,velocities):
+        """
+        Acceleration of the store slots `slots` if they were at the given
+        positions and velocities, re-evaluating the fields that support
+        get_forces there. Used by integrators that sample the acceleration
+        part way through a step.
+        """
+        store = self.store
+        n = store.count
+        if not self._batchedFields:
+            fieldForce = store.fieldForce[slots]
+        else:
+            trialPositions = store.position[:n].copy()
+            trialPositions[slots] = positions
+            trialVelocities = store.velocity[:n].copy()
+            trialVelocities[slots] = velocities
+            active = store.active[:n,None]
+            fieldForce = self._otherFieldForce.copy()
+            for field in self._batchedFields:
+                forces = field.get_forces(trialPositions,trialVelocities,store.mass[:n],
+                                          store.charge[:n],store.force[:n])
+                fieldForce += np.where(active,forces,0.) * self.scale
+            fieldForce = fieldForce[slots]
+        return (store.force[slots] + fieldForce) / store.mass[slots,None]
+
+    def tick(self,dt):
+        phase = self.profiler.phase if self.profiler else _call
+        phase('input',self.read_input,dt)
+        substeps = 1
+        if self.maxStepSize:
+            substeps = max(1,int(math.ceil(dt/self.maxStepSize - 1e-9)))
+        h = dt/substeps
+        for i in range(substeps):
+            phase('apply_fields',self.apply_fields)
+            phase('collide',self.collide)
+            phase('process',self.process,h)
+
+    def collide(self):
+        # Resolve contacts before entities move; see PhysicsWorld
+        pass
+
+    def predict(self,entity,horizon):
+        """
+        Projects the path of entity over the next horizon seconds, going
+        straight and bouncing off the edges of the world and any solid
+        colliders at rest (see Trajectory.py). Paths are kept until the
+        entity's velocity changes, so any number of agents can ask for the
+        same entity every tick.
+        returns:    a Trajectory.Trajectory
+        """
+        if self.predictor is None:
+            from Trajectory import Predictor
+            self.predictor = Predictor(self)
+        return self.predictor.predict(entity,horizon)
+
+    def save_state(self):
+        state = World.save_state(self)
+        state['store'] = self.store.get_state()
+        # Cached paths steer agents, so they are part of the simulation
+        if self.predictor is not None:
+            state['predictions'] = self.predictor.get_state()
+        return state
+
+    def load_state(self,state):
+        World.load_state(self,state)
+        store = self.store
+        store.set_state(state['store'])
+        store.place_rects()
+        for owner in store.owners:
+            if owner.static:
+                self.update_static(owner)
+            else:
+                self.spatialHash.update(owner)
+        if 'predictions' in state:
+            if self.predictor is None:
+                from Trajectory import Predictor
+                self.predictor = Predictor(self)
+            self.predictor.set_state(state['predictions'])
+        elif self.predictor is not None:
+            self.predictor.set_state([])
+
+    def has_sleepers(self):
+        store = self.store
+        return bool(store.asleep[:store.count].any())
+
+    def save_positions(self):
+        self.store.save_positions()
+
+    def interpolate(self,alpha):
+        self.store.place_rects(alpha)
+        self._interpolated = True
+
+    def restore_positions(self):
+        if self._interpolated:
+            self.store.place_rects()
+            self._interpolated = False
        
     def run_main_loop(self):
         while True:
             if DEBUG:
 			    soleEntity = self.get_entities()[0]
 			    soleEntity.set_force((0.,0.))
-			    keysPressed = pygame.key.get_pressed()
+			    keysPressed = self.input.get_pressed()
 			    if keysPressed[K_UP]:
 			        soleEntity.add_force((0.,-30.))
 			    if keysPressed[K_DOWN]:
@@ -191,9 +1196,10 @@ class NewtonWorld(World):
 			    if keysPressed[K_LEFT]:
 			        soleEntity.add_force((-30.,0.))
 								   
-            self.apply_fields()
             self.main_loop()
-           
+            # A headless server loop has no window to close
+            if not pygame.display.get_init():
+                continue
             for event in pygame.event.get():
                 if event.type == QUIT:
                     return
@@ -202,8 +1208,36 @@ class NewtonWorld(World):
                         return
  
     def apply_fields(self):
+        """
+        Sums the force of every field on every entity into the store's
+        fieldForce buffer, which the next integration step adds to the
+        entities' own forces. Fields that implement get_forces are
+        evaluated for all entities at once; the rest one entity at a time.
+        """
+        store = self.store
+        n = store.count
+        store.fieldForce[:n] = 0.
+        self._batchedFields = []
+        if not self.fields:
+            return
+        active = store.active[:n,None]
+        batched = []
+        self._batchedFields = []
         for field in self.fields:
-            field.apply_all()
+            forces = field.get_forces(store.position[:n],store.velocity[:n],
+                                      store.mass[:n],store.charge[:n],store.force[:n])
+            if forces is None:
+                field.apply_all()
+            else:
+                batched.append(forces)
+                self._batchedFields.append(field)
+        # Keep the forces that cannot be re-evaluated for acceleration()
+        self._otherFieldForce = store.fieldForce[:n].copy()
+        for forces in batched:
+            store.fieldForce[:n] += np.where(active,forces,0.) * self.scale
+        movable = store.active[:n] & ~store.static[:n]
+        for field in self._batchedFields:
+            field.adjust_velocities(store.velocity[:n],store.force[:n],movable)
 
 
 def main():
@@ -0,0 +1,97 @@
+# Shared, display-converted entity images
+import hashlib
+import weakref
+
+import pygame
+
+class ImageCache(object):
+    """
+    Registry of the images entities are drawn with. Every image passed
+    through get() is converted to the display's pixel format once (with
+    convert_alpha() if it has per-pixel alpha), and images with identical
+    pixels share one converted surface, so thousands of sprites blit on
+    the fast path and hold a reference rather than a copy each.
+
+    Until a display mode is set images are deduplicated but not
+    converted; they are converted the next time they are asked for once
+    there is a display. Images handed out are shared and must be treated
+    as read-only: draw on a copy instead. Only the first surface seen with
+    given pixels is kept; others are remembered weakly, so they can be
+    freed once whoever made them lets go.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self._byContent)
+
+    def clear(self):
+        self._bySurface = weakref.WeakKeyDictionary()
+        self._byContent = {}
+        self._converted = set()
+        self._solids = {}
+        self._paths = {}
+
+    def key(self,image):
+        # Everything that affects how the image blits
+        digest = hashlib.sha1(pygame.image.tostring(image,'RGBA')).hexdigest()
+        alpha = bool(image.get_flags() & pygame.SRCALPHA)
+        return (image.get_size(),alpha,image.get_colorkey(),image.get_alpha(),digest)
+
+    def get(self,image):
+        """
+        returns:    the shared, converted surface with the same pixels as
+                    image
+        """
+        key = self._bySurface.get(image)
+        if key is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            key = self.key(image)
+            self._byContent.setdefault(key,image)
+            self._bySurface[image] = key
+        if key not in self._converted and pygame.display.get_surface() is not None:
+            image = self._byContent[key]
+            if image.get_flags() & pygame.SRCALPHA:
+                converted = image.convert_alpha()
+            else:
+                converted = image.convert()
+            self._byContent[key] = converted
+            self._bySurface[converted] = key
+            self._converted.add(key)
+        return self._byContent[key]
+
+    def solid(self,size,color=None):
+        """
+        returns:    a shared surface of the given size, filled with color
+                    (black if None)
+        """
+        solidKey = (tuple(size),color)
+        image = self._solids.get(solidKey)
+        if image is None:
+            image = self._solids[solidKey] = pygame.Surface(size)
+            if color is not None:
+                image.fill(pygame.Color(color) if isinstance(color,str) else color)
+        return self.get(image)
+
+    def load(self,path):
+        # Images loaded from disk are cached by path as well as by content
+        image = self._paths.get(path)
+        if image is None:
+            image = self._paths[path] = pygame.image.load(path)
+        return self.get(image)
+
+    def memory(self):
+        # Bytes of pixel data held by the distinct images
+        return sum(image.get_width()*image.get_height()*image.get_bytesize()
+                   for image in self._byContent.values())
+
+    def stats(self):
+        return {'images':len(self),'hits':self.hits,'misses':self.misses,
+                'bytes':self.memory()}
+
+# Shared by every world unless it is given its own
+images = ImageCache()
@@ -0,0 +1,95 @@
+# Input providers: where entities read the mouse and keyboard from
+import bisect
+
+import pygame
+
+class PressedKeys(object):
+    """
+    Stands in for the sequence returned by pygame.key.get_pressed():
+    indexing with a key constant gives True if that key is down
+    """
+    def __init__(self,keys=()):
+        self.keys = frozenset(keys)
+
+    def __getitem__(self,key):
+        return key in self.keys
+
+class InputProvider(object):
+    """
+    Base class for input sources. Entities should read input through
+    world.input rather than pygame.mouse/pygame.key so that worlds can run
+    without a display.
+    """
+    def get_mouse_pos(self):
+        return (0,0)
+
+    def get_pressed(self):
+        return PressedKeys()
+
+    def update(self):
+        # Called by the world once per tick, before entities are processed
+        pass
+
+class PygameInput(InputProvider):
+    # Live input from the pygame display
+    def get_mouse_pos(self):
+        return pygame.mouse.get_pos()
+
+    def get_pressed(self):
+        return pygame.key.get_pressed()
+
+class StaticInput(InputProvider):
+    """
+    Input that only changes when told to; the default for headless worlds.
+
+    Arguments:
+    --------------------------------------------------------------------
+    mousePos        | mouse position in pixels
+    keys            | key constants that are held down
+    --------------------------------------------------------------------
+    """
+    def __init__(self,mousePos=(0,0),keys=()):
+        self.mousePos = tuple(mousePos)
+        self.keys = PressedKeys(keys)
+
+    def set_mouse_pos(self,mousePos):
+        self.mousePos = tuple(mousePos)
+
+    def set_pressed(self,keys):
+        self.keys = PressedKeys(keys)
+
+    def get_mouse_pos(self):
+        return self.mousePos
+
+    def get_pressed(self):
+        return self.keys
+
+class ReplayInput(InputProvider):
+    """
+    Plays back input recorded by Replay.Recorder. `tick` is the tick the
+    next update() is for; whoever runs the world keeps it in step.
+
+    Arguments:
+    --------------------------------------------------------------------
+    changes         | list of (tick,mousePos,keys) giving the input from
+                    | each tick on, sorted by tick
+    --------------------------------------------------------------------
+    """
+    def __init__(self,changes,tick=0):
+        self.ticks = [change[0] for change in changes]
+        self.inputs = [(tuple(mousePos),PressedKeys(keys)) for t,mousePos,keys in changes]
+        self.tick = tick
+        self.mousePos = (0,0)
+        self.keys = PressedKeys()
+
+    def update(self):
+        i = bisect.bisect_right(self.ticks,self.tick) - 1
+        if i >= 0:
+            self.mousePos,self.keys = self.inputs[i]
+        self.tick += 1
+
+    def get_mouse_pos(self):
+        return self.mousePos
+
+    def get_pressed(self):
+        return self.keys
@@ -0,0 +1,67 @@
+# Numerical integrators for NewtonianEntity kinematics
+"""
+Each integrator advances positions x and velocities v (single 2-vectors
+or Nx2 arrays) by dt given a function acceleration(x,v), and the
+acceleration a0 at the starting state. step() returns the new position,
+velocity and a0.
+"""
+
+class Integrator(object):
+    name = None
+
+    def step(self,x,v,acceleration,dt,a0):
+        raise NotImplementedError
+
+class ExplicitEuler(Integrator):
+    # First order; position uses the old velocity. Unstable for springs
+    name = 'euler'
+
+    def step(self,x,v,acceleration,dt,a0):
+        return x + v*dt, v + a0*dt, a0
+
+class SemiImplicitEuler(Integrator):
+    # First order, but symplectic: stable for stiff controllers and orbits
+    name = 'semi-implicit'
+
+    def step(self,x,v,acceleration,dt,a0):
+        v = v + a0*dt
+        return x + v*dt, v, a0
+
+class VelocityVerlet(Integrator):
+    # Second order and symplectic; evaluates the acceleration once more
+    name = 'verlet'
+
+    def step(self,x,v,acceleration,dt,a0):
+        x1 = x + v*dt + 0.5*a0*dt*dt
+        a1 = acceleration(x1,v + a0*dt)
+        return x1, v + 0.5*(a0 + a1)*dt, a0
+
+class RungeKutta4(Integrator):
+    # Fourth order; three more acceleration evaluations per step
+    name = 'rk4'
+
+    def step(self,x,v,acceleration,dt,a0):
+        h = 0.5*dt
+        x2,v2 = x + v*h, v + a0*h
+        a2 = acceleration(x2,v2)
+        x3,v3 = x + v2*h, v + a2*h
+        a3 = acceleration(x3,v3)
+        x4,v4 = x + v3*dt, v + a3*dt
+        a4 = acceleration(x4,v4)
+        x = x + (v + 2*v2 + 2*v3 + v4)*(dt/6.)
+        v = v + (a0 + 2*a2 + 2*a3 + a4)*(dt/6.)
+        return x, v, a0
+
+INTEGRATORS = dict((cls.name,cls) for cls in (ExplicitEuler,SemiImplicitEuler,VelocityVerlet,RungeKutta4))
+
+def get_integrator(integrator):
+    """
+    @param integrator:  Integrator instance, or one of the names 'euler',
+                        'semi-implicit', 'verlet', 'rk4'
+    """
+    if isinstance(integrator,Integrator):
+        return integrator
+    try:
+        return INTEGRATORS[integrator]()
+    except KeyError:
+        raise ValueError("Unknown integrator %r; choose from %s" % (integrator,", ".join(sorted(INTEGRATORS))))
@@ -6,7 +6,7 @@ from GameEngine2D import NewtonWorld
 from PhysicsEngine2D import NewtonianEntity
  
 kp = 20
-kv = 150
+kv = 3.75
  
 class MouseTracker(NewtonianEntity):
     def init(self):
@@ -20,7 +20,7 @@ class MouseTracker(NewtonianEntity):
     def process(self,dt):
  
         # These values are in pixels or pixels/second
-        positionDesired = pygame.mouse.get_pos()
+        positionDesired = self.world.input.get_mouse_pos()
         velocityDesired = np.array((0,0),float)
        
         # self.position and self.velocity are also stored in pixel units
@@ -44,7 +44,7 @@ class MouseTracker1DOF(MouseTracker):
        
     def process(self,dt):
         # These values are in pixels or pixels/second
-        positionDesired = pygame.mouse.get_pos()[self.degreeOfFreedom]
+        positionDesired = self.world.input.get_mouse_pos()[self.degreeOfFreedom]
         velocityDesired = 0
        
         # self.position and self.velocity are also stored in pixel units
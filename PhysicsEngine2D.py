@@ -4,18 +4,64 @@ import pygame
 from pygame.locals import *
  
 from GameEngine2D import NewtonWorld,GraphicEntity
+from EntityStore import EntityStore
+from Contacts import ContactSolver
+from Shapes import collide
+from SpatialHash import overlapping_pairs
  
 def elastic_collision(entity1,entity2,normalVector):
-    #print "ELASTIC COLLISION"
-    normalVector = np.array(normalVector)
-    m1,m2 = entity1.mass,entity2.mass
-    u1 = np.dot(entity1.get_velocity(units="PIX"),normalVector)
-    u2 = np.dot(entity2.get_velocity(units="PIX"),normalVector)
-    v1 = (u1*(m1-m2)+2*m2*u2)/(m1+m2)
-    v2 = (u2*(m2-m1)+2*m1*u1)/(m1+m2)
-   
-    entity1.add_velocity((v1-u1)*normalVector,units="PIX")
-    entity2.add_velocity((v2-u2)*normalVector,units="PIX")
+    # Exchanges momentum along normalVector as in a perfectly elastic,
+    # frictionless collision, working on the velocity views in place. As
+    # before the solver, the exchange happens whichever way the pair is
+    # moving. Static bodies are infinitely heavy and stay asleep, as in
+    # the ContactSolver (see EntityStore.inverse_mass and wake).
+    nx,ny = normalVector
+    w1 = 0. if entity1.static else 1./entity1.mass
+    w2 = 0. if entity2.static else 1./entity2.mass
+    v1,v2 = entity1.velocity,entity2.velocity
+    u = (v1[0]-v2[0])*nx + (v1[1]-v2[1])*ny
+    if not u or not w1+w2:
+        return
+    j = 2*u/(w1+w2)
+    v1[0] -= j*w1*nx
+    v1[1] -= j*w1*ny
+    v2[0] += j*w2*nx
+    v2[1] += j*w2*ny
+    entity1.wake()
+    entity2.wake()
+
+def swept_aabb(box,displacement,other):
+    """
+    Time of impact of a box moving by displacement against a stationary
+    box, both given as (left,top,right,bottom).
+
+    returns:    (t,normalVector) with t in [0,1] the fraction of the
+                displacement travelled before touching and normalVector the
+                face of the moving box that hits, or None if they do not
+                meet (or already overlap) during the move
+    """
+    entry,exit = -np.inf,np.inf
+    normalVector = None
+    for axis in (0,1):
+        low,high = box[axis],box[axis+2]
+        otherLow,otherHigh = other[axis],other[axis+2]
+        d = displacement[axis]
+        if d > 0:
+            t0,t1,sign = (otherLow-high)/d,(otherHigh-low)/d,1.
+        elif d < 0:
+            t0,t1,sign = (otherHigh-low)/d,(otherLow-high)/d,-1.
+        elif high <= otherLow or low >= otherHigh:
+            return None
+        else:
+            continue
+        if t0 > entry:
+            entry = t0
+            normalVector = np.zeros(2)
+            normalVector[axis] = sign
+        exit = min(exit,t1)
+    if normalVector is None or entry > exit or entry < 0 or entry > 1:
+        return None
+    return entry,normalVector
    
 class NewtonianEntity(GraphicEntity):
     """
@@ -29,19 +75,43 @@ class NewtonianEntity(GraphicEntity):
     acceleration    | in meters per second per second (m/s^2)
     force           | in Newtons (kg * m/s^2)
     image           | entity's image
+    charge          | electric charge in Coulombs, or None
    
     *Note that 'force' and 'inertia' values need to be scaled appropriately
+    
+    The vector state and mass live in a slot of the world's EntityStore;
+    the attributes below are views into that slot, so in-place updates
+    (self.velocity += ...) write straight into the store.
+
+    An entity that rests for the world's sleepDelay is put to sleep until
+    a collision, a field or one of the set_/add_ methods below disturbs it.
+    Writing the attributes directly does not wake it; call wake() first.
+    Entities that keep the standard process, and CollidingEntity and its
+    subclasses, sleep unless they set canSleep = False. Others override
+    process and may be driving themselves, so they only sleep if they set
+    canSleep = True.
+
+    Static bodies (static = True) are asleep for good: they are not
+    integrated, woken by contacts or redrawn every frame, and contacts
+    treat them as infinitely heavy. set_position still moves them.
     ----------------------------------------------------------------
     """
+    __slots__ = ('scale','_store','_slot','batched')
+    # None: sleep only if batched
+    canSleep = None
+
     def __init__(self,world,mass=1,centerOfMass=None,inertia=1,position=(0,0),velocity=(0,0),acceleration=(0,0),force=(0,0),image=None,charge=None):
         self.world = world
         self.type = "NewtonianEntity"
         self.scale = self.world.scale
+        self.batched = False
+        self._store = self.world.store
+        self._slot = self._store.allocate(self)
  
-        self.image = image
         if not image:
-            self.image = pygame.Surface((20,20))
-            self.image.fill(pygame.Color('red'))
+            self.image = self.world.images.solid((20,20),'red')
+        else:
+            self.image = self.world.images.get(image)
         self.size = np.array(self.image.get_size())
                
         self.position = np.array(position,float)*self.world.scale
@@ -59,33 +129,128 @@ class NewtonianEntity(GraphicEntity):
     def init(self):
         # Initialize any non-standard parameters here
         pass
+
+    def _state(name):
+        def get(self):
+            return getattr(self._store,name)[self._slot]
+        def set(self,value):
+            getattr(self._store,name)[self._slot] = value
+        return property(get,set)
+
+    position = _state('position')
+    velocity = _state('velocity')
+    acceleration = _state('acceleration')
+    force = _state('force')
+    fieldForce = _state('fieldForce')
+    centerOfMass = _state('centerOfMass')
+    mass = _state('mass')
+    del _state
+
+    def _get_charge(self):
+        charge = self._store.charge[self._slot]
+        return None if np.isnan(charge) else charge
+
+    def _set_charge(self,charge):
+        self._store.charge[self._slot] = np.nan if charge is None else charge
+
+    charge = property(_get_charge,_set_charge)
+
+    @property
+    def asleep(self):
+        return bool(self._store.asleep[self._slot])
+
+    def wake(self):
+        self._store.wake(self._slot)
+
+    def get_state(self):
+        # Everything is in the store, which the world saves as a whole
+        return None
+
+    def set_state(self,state):
+        pass
+
+    def attach(self):
+        store = self.world.store
+        if self._store is not store:
+            slot = store.allocate(self)
+            store.copy_slot(self._store,self._slot,slot)
+            self._store,self._slot = store,slot
+        # Entities that keep the standard kinematics are integrated in a
+        # batch by the world; anything overriding process runs on its own
+        process = getattr(type(self).process,'__func__',type(self).process)
+        self.batched = process is _newtonianProcess and not self.static
+        canSleep = self.batched if self.canSleep is None else self.canSleep
+        store.activate(self._slot,self.batched,canSleep,self.static)
+
+    def detach(self):
+        # Move the state out of the world's store into a private one so the
+        # entity keeps it until it is added again
+        store = EntityStore(1)
+        slot = store.allocate(self)
+        store.copy_slot(self._store,self._slot,slot)
+        self._store.release(self._slot)
+        self._store,self._slot = store,slot
+        self.batched = False
+
+    def recycle(self):
+        # The slot goes back to the store; spawn() allocates a new one
+        self._store.release(self._slot)
+        self._store = self._slot = None
+        self.batched = False
    
     def process(self,dt):
         # TODO: Collision detection
-        # Kinematics
-        self.acceleration = self.force * dt / self.mass
-        self.velocity += self.acceleration * dt
-        self.position += self.velocity
+        self.integrate(dt)
+
+    def integrate(self,dt):
+        # Kinematics, using the world's integrator with the force held
+        # constant over the step
+        acceleration = (self.force + self.fieldForce) / self.mass
+        self.position,self.velocity,self.acceleration = self.world.integrator.step(
+            self.position,self.velocity,lambda x,v: acceleration,dt,acceleration)
        
+        self.update_rect()
+
+    def update_rect(self):
+        # Keep the rect (and the world's broadphase) in step with position
         self.rect.topleft = self.position - self.centerOfMass
+        self.world.spatialHash.update(self)
        
     def set_force(self,force):
         # Force argument is in N, force attribute is in kg * pixels/s^2
         self.force = np.array(force,float) * self.scale
+        self.wake()
        
     def add_force(self,force):
-        self.force += np.array(force) * self.scale
+        force = np.array(force) * self.scale
+        if force.any():
+            self.force += force
+            self.wake()
+
+    def add_field_force(self,force):
+        # Field forces only last for the current tick
+        self.fieldForce += np.array(force) * self.scale
        
     def set_velocity(self,velocity,units="SI"):
         # Velocity argument in m/s
         self.velocity = np.array(velocity,float) * (self.scale if units=="SI" else 1.)
+        self.wake()
         #print "Set velocity at",self.velocity
    
     def add_velocity(self,velocity,units="SI"):
-        self.velocity += np.array(velocity) * (self.scale if units=="SI" else 1.)
+        # Collisions wake the entities they change the velocity of
+        velocity = np.array(velocity) * (self.scale if units=="SI" else 1.)
+        if velocity.any():
+            self.velocity += velocity
+            self.wake()
         
     def set_position(self,position,units="SI"):
 		self.position = np.array(position) * (self.scale if units=="SI" else 1.)
+		self.wake()
+		if self.static:
+			# Static bodies are not integrated, so move the rect now
+			self.update_rect()
+			self.world.update_static(self)
        
     def get_position(self,units='SI'):
         if units == 'SI':
@@ -104,66 +269,226 @@ class NewtonianEntity(GraphicEntity):
             return self.acceleration/self.scale
         else:
             return self.acceleration
+
+_newtonianProcess = getattr(NewtonianEntity.process,'__func__',NewtonianEntity.process)
    
 class CollidingEntity(NewtonianEntity):
+    shape = None
+    # Entities that are not solid pass through each other, though they
+    # still collide with solid ones
+    solid = True
+    continuous = True
+    maxSweeps = 4
+    restitution = 1.
+    friction = 0.
+    # Resting bodies sleep until something hits them; subclasses steered
+    # by their own process set this to False
+    canSleep = True
+
     def __init__(self,world,mass=1,centerOfMass=None,inertia=1,position=(0,0),
                  velocity=(0,0),acceleration=(0,0),force=(0,0),image=None,charge=None,
-                 collisionPoints=[]):
+                 collisionPoints=[],restitution=None,friction=None,shape=None,static=None):
         """
         Arguments
         ----------------------------------------------------------------
-        collisionPoints     | a list of tuples of the form
+        shape               | Shapes.AABB, Circle or Polygon around the
+                            | position; entities with shapes collide by
+                            | one shape test per pair, with the contact
+                            | normal and depth, and are pushed apart when
+                            | they overlap
+        collisionPoints     | for entities without a shape, a list of
+                            | tuples of the form
                             | (collisionPoint,normalVector @ that point)
+        restitution         | fraction of the closing speed kept after a
+                            | contact (1: elastic, 0: no bounce)
+        friction            | coefficient of friction at contacts
+        static              | True for a static body (see NewtonianEntity)
+                            | such as a wall
         ----------------------------------------------------------------
+
+        Entities moving more than half their size in one step are swept
+        against the bounds of the entities in their path (continuous
+        collision detection), so they cannot tunnel through them at low
+        tick rates. Set continuous = False to only test collisionPoints.
         """
         self.collisionPoints = collisionPoints
+        if shape is not None:
+            self.shape = shape
+        if restitution is not None:
+            self.restitution = restitution
+        if friction is not None:
+            self.friction = friction
+        if static is not None:
+            self.static = static
         NewtonianEntity.__init__(self,world,mass=mass,centerOfMass=centerOfMass,
                                  inertia=inertia,position=position,velocity=velocity,
                                  acceleration=acceleration,force=force,image=image,charge=charge)
         
        
     def process(self,dt):
-        # Collision detection
-        self.check_collisions()
+        # A PhysicsWorld resolves the contacts of all its entities together
+        # before processing them; elsewhere each entity resolves its own
+        if not isinstance(self.world,PhysicsWorld):
+            if self.world.profiler:
+                self.world.profiler.phase('collide',self.check_collisions)
+            else:
+                self.check_collisions()
        
-        # Kinematics
-        self.acceleration = self.force * dt / self.mass
-        self.velocity += self.acceleration * dt
-        self.position += self.velocity * dt
-       
-        self.rect.topleft = self.position - self.centerOfMass
-        
+        self.integrate(dt)
         self.stabilize()
+
+    def integrate(self,dt):
+        x0,y0 = self.position.tolist()
+        NewtonianEntity.integrate(self,dt)
+        if self.continuous:
+            # Fast bodies can pass through thin ones between two ticks
+            x1,y1 = self.position.tolist()
+            width,height = self.size.tolist()
+            if abs(x1-x0) > width/2. or abs(y1-y0) > height/2.:
+                self.sweep(np.array((x0,y0)),np.array((x1-x0,y1-y0)),dt)
+
+    def sweep(self,start,displacement,dt):
+        """
+        Replays the move from start, stopping at the earliest contact with
+        a solid entity (see get_bounds), resolving it and carrying on with
+        the new velocity for the rest of the step
+        """
+        position = start
+        for i in range(self.maxSweeps):
+            impact = self.first_impact(position,displacement,dt)
+            if impact is None:
+                position = position + displacement
+                break
+            t,normalVector,entity = impact
+            position = position + t*displacement
+            contacts = ContactSolver()
+            contacts.add(self,entity,normalVector)
+            contacts.solve(self._store)
+            dt *= 1-t
+            displacement = self.velocity*dt
+        self.position = position
+        self.update_rect()
+
+    def first_impact(self,position,displacement,dt):
+        """
+        returns:    (t,normalVector,entity) for the first solid entity hit
+                    moving by displacement from position, or None
+        """
+        left,top = position - self.centerOfMass
+        box = (left,top,left+self.size[0],top+self.size[1])
+        swept = pygame.Rect(int(min(left,left+displacement[0]))-1,
+                            int(min(top,top+displacement[1]))-1,
+                            int(abs(displacement[0])+self.size[0])+3,
+                            int(abs(displacement[1])+self.size[1])+3)
+        first = None
+        for entity in self.world.query_rect(swept):
+            if entity is self or not isinstance(entity,CollidingEntity):
+                continue
+            if not (self.solid or entity.solid):
+                continue
+            bounds = entity.get_bounds()
+            if bounds is None:
+                continue
+            # Work in the frame of the other entity
+            relative = displacement - entity.velocity*dt
+            impact = swept_aabb(box,relative,(bounds.left,bounds.top,bounds.right,bounds.bottom))
+            if impact is not None and (first is None or impact[0] < first[0]):
+                first = impact + (entity,)
+        return first
        
     def check_collisions(self):
-        #print "Checking...",self.world.get_entities()
-        for entity in self.world.get_entities():
-            if isinstance(entity,CollidingEntity) and entity != self:
-                for point,normalVector in self.collisionPoints:
-                    if np.dot(normalVector,self.velocity) >= 0:
-						#print "Point:",point, "in",entity.type,"?"
-						if entity.collides_with(point+self.rect.topleft):
-							elastic_collision(self,entity,normalVector)
+        contacts = ContactSolver()
+        self.find_contacts(contacts)
+        contacts.solve(self._store)
+
+    def find_contacts(self,contacts):
+        if self.shape is not None:
+            return self.find_shape_contacts(contacts)
+        # Only the points moving into something, and entities near them,
+        # can be hit
+        left,top = self.rect.topleft
+        velocity = self.velocity
+        points = [((left+point[0],top+point[1]),normalVector)
+                  for point,normalVector in self.collisionPoints
+                  if np.dot(normalVector,velocity) >= 0]
+        if not points:
+            return
+        for entity in self.world.query_rect(self.get_probe_rect()):
+            if isinstance(entity,CollidingEntity) and entity is not self:
+                for point,normalVector in points:
+                    if entity.collides_with(point):
+                        contacts.add(self,entity,normalVector)
+
+    def find_shape_contacts(self,contacts,entities=None):
+        """
+        Tests the shape against the shapes of entities, by default the ones
+        around it. A PhysicsWorld pairs up its moving entities itself and
+        only passes in the static ones.
+        """
+        shape = self.shape
+        position = self.position.tolist()
+        if entities is None:
+            entities = self.world.query_rect(shape.bounds(position))
+        for entity in entities:
+            if entity is self or not isinstance(entity,CollidingEntity) or entity.shape is None:
+                continue
+            if not (self.solid or entity.solid):
+                continue
+            hit = collide(shape,position,entity.shape,entity.position.tolist())
+            if hit is not None:
+                contacts.add(self,entity,hit[0],hit[1])
+
+    def get_probe_rect(self):
+        # Bounding rect of the entity and its collision points
+        probe = self.rect.copy()
+        left,top = probe.topleft
+        for point,normalVector in self.collisionPoints:
+            probe.union_ip((left+int(point[0]),top+int(point[1]),1,1))
+        return probe
                         
     def collides_with(self,point):
-		# Implement for each custom game object
+		# Tests the shape if there is one; otherwise implement for each
+		# custom game object
+		if self.shape is not None:
+			position = self.position
+			return self.shape.contains((point[0]-position[0],point[1]-position[1]))
 		return False
+
+    def get_bounds(self):
+        # Rect that fast moving entities are swept against, or None to let
+        # them pass: the shape's bounds, or implement alongside collides_with
+        if self.shape is not None:
+            return self.shape.bounds(self.position)
+        return None
                         
     def stabilize(self):
-		for i in range(2):
-			if abs(self.velocity[i]) < 0.0001:
-				self.velocity[i] = 0.
+		velocity = self.velocity
+		vx,vy = velocity.tolist()
+		if abs(vx) < 0.0001:
+			velocity[0] = 0.
+		if abs(vy) < 0.0001:
+			velocity[1] = 0.
        
 class PhysicsWorld(NewtonWorld):
     """
     Arguments:
     --------------------------------------------------------------------    
     scale           | pixels per meter (to set physical constants appropriately)
+    solverIterations| passes of the contact solver; more than one resolves
+                    | stacks and multi-body contacts better
+    options         | passed on to NewtonWorld (size, fixedTimestep,
+                    | integrator, input, ...)
     --------------------------------------------------------------------
     """
-    def __init__(self,name,surface,background=None,framesPerSecond=40,scale=10,muS=0.3,muK=0.2):
-        NewtonWorld.__init__(self,name,surface,background,framesPerSecond)
+    def __init__(self,name,surface,background=None,framesPerSecond=40,scale=10,muS=0.3,muK=0.2,
+                 solverIterations=1,**options):
+        NewtonWorld.__init__(self,name,surface,background,framesPerSecond,scale,**options)
         self.scale = scale
+        self.contacts = ContactSolver(solverIterations)
+        # CollidingEntities that are not static, rebuilt as entities come
+        # and go
+        self._colliders = None
+        self._collidersVersion = None
        
         # Define Physical Constants
         self.fields = []
@@ -171,9 +496,10 @@ class PhysicsWorld(NewtonWorld):
    
     def run_main_loop(self):
         while True:            
-            self.apply_fields()
             self.main_loop()
-           
+            # A headless server loop has no window to close
+            if not pygame.display.get_init():
+                continue
             for event in pygame.event.get():
                 if event.type == QUIT:
                     return
@@ -181,10 +507,64 @@ class PhysicsWorld(NewtonWorld):
                     if event.key == K_ESCAPE:
                         return
  
-    def apply_fields(self):
-        for field in self.fields:
-            field.apply_all()
- 
+    def collide(self):
+        """
+        Finds the contacts of every awake CollidingEntity and resolves them
+        in one pass of the contact solver. Entities with shapes are paired
+        up all at once (see find_pair_contacts) and tested against the
+        static grid; the others look for their own contacts.
+        """
+        contacts = self.contacts
+        contacts.clear()
+        if self._collidersVersion != self.version:
+            self._colliders = [entity for entity in self.get_instances(CollidingEntity)
+                               if not entity.static]
+            self._collidersVersion = self.version
+        shaped = []
+        for entity in self._colliders:
+            if entity.shape is not None:
+                shaped.append(entity)
+            elif not entity.asleep:
+                entity.find_contacts(contacts)
+        self.find_pair_contacts(shaped,contacts)
+        if len(self.staticGrid):
+            staticGrid = self.staticGrid
+            for entity in shaped:
+                if not entity.asleep:
+                    bounds = entity.shape.bounds(entity.position)
+                    entity.find_shape_contacts(contacts,staticGrid.query_rect(bounds))
+        contacts.solve(self.store)
+
+    def find_pair_contacts(self,entities,contacts):
+        """
+        Tests the shapes of entities against each other, at least one of
+        each pair awake and solid. Candidate pairs come from a sweep over
+        the bounds of the shapes, so only overlapping ones reach collide().
+        """
+        if len(entities) < 2:
+            return
+        store = self.store
+        slots = np.array([entity._slot for entity in entities])
+        positions = store.position[slots]
+        extents = np.array([entity.shape.extent for entity in entities])
+        first,second = overlapping_pairs(positions+extents[:,:2],positions+extents[:,2:])
+        solid = np.array([entity.solid for entity in entities])
+        awake = ~store.asleep[slots]
+        keep = (solid[first] | solid[second]) & (awake[first] | awake[second])
+        first,second = first[keep],second[keep]
+        # Test each pair from its awake entity, or the earlier one if both
+        # are, in the order of entities
+        swap = ~awake[first] | (awake[second] & (second < first))
+        first,second = np.where(swap,second,first),np.where(swap,first,second)
+        order = np.lexsort((second,first))
+        positions = positions.tolist()
+        for i,j in zip(first[order].tolist(),second[order].tolist()):
+            entity,other = entities[i],entities[j]
+            hit = collide(entity.shape,positions[i],other.shape,positions[j])
+            if hit is not None:
+                contacts.add(entity,other,hit[0],hit[1])
+
     def add_field(self,field):
+        from Fields import Field
         assert(isinstance(field,Field))
-        self.fields.append(Field)
+        self.fields.append(field)
@@ -4,82 +4,106 @@ import numpy.linalg as LA
 import pygame
 from pygame.locals import *
 import math
-import random
+import argparse
  
 from PhysicsEngine2D import PhysicsWorld, CollidingEntity
-from GameEngine2D import GraphicEntity
+from GameEngine2D import TextEntity
+from Shapes import AABB, Circle
  
-kp = 2000
-kv = 500
+kp = 20
+kv = 5
 BALL_SPEED = 40. # meters per second
 DIFFICULTY = "easy" #"medium" #"hard"
+PREDICTION_HORIZON = 3. # seconds the hard computer paddle looks ahead
+WALL_THICKNESS = 50 # pixels
 
-class Score(GraphicEntity):
+class Score(TextEntity):
 	def __init__(self,world,side):
 		if side == "left": position = (world.size[0]/4,50)
 		elif side == "right": position = (3*world.size[0]/4,50)
 		else: raise ValueError("Score side must be left or right")
 		self.value = 0
-		self.font = pygame.font.Font(None,30)
 		
-		GraphicEntity.__init__(self,world,position,image=self.font.render(str(self.value),True,pygame.Color("black")))
+		TextEntity.__init__(self,world,position,str(self.value),size=30,color="black")
 		self.type="Score"
 		self.side=side
 		
 	def update_score(self,newScore):
 		self.value = newScore
-		self.image = self.font.render(str(self.value),True,pygame.Color("black"))
-		self.size = np.array(self.image.get_size())
-		self.rect = pygame.Rect(self.position - self.size/2,self.size)
+		self.set_text(str(self.value))
 		
 	def increment(self):
 		self.update_score(self.value+1)
+
+	def get_state(self):
+		return (tuple(self.position),self.value)
+
+	def set_state(self,state):
+		position,value = state
+		TextEntity.set_state(self,(position,str(value)))
+		self.value = value
 		
 		
 
 class Ball(CollidingEntity):
+	# Driven by its own process, so it never comes to rest
+	canSleep = False
+	# Balls pass through each other
+	solid = False
+
 	def init(self):
 		self.type = "Ball"
-		angle = 0.3*math.pi*random.random()+random.choice([0,math.pi])
+		angle = 0.3*math.pi*self.world.random.random()+self.world.random.choice([0,math.pi])
 		self.set_velocity(BALL_SPEED*np.array((math.cos(angle),math.sin(angle)))) 
-		self.collisionPoints = [
-								(np.array([0,15]),np.array([-1,0])),
-								(np.array([30,15]),np.array([1,0])),
-								(np.array([15,0]),np.array([0,-1])),
-								(np.array([15,30]),np.array([0,1]))
-							   ]
+		self.shape = Circle(self.size[0]/2.)
 							   
 	def process(self,dt):
 		if self.position[0] < -15:
 			self.set_position(self.world.size/2,units="PIX")
-			angle = 0.3*math.pi*random.random()+random.choice([0,math.pi])
+			angle = 0.3*math.pi*self.world.random.random()+self.world.random.choice([0,math.pi])
 			self.set_velocity(BALL_SPEED*np.array((math.cos(angle),math.sin(angle))))
 			for score in self.world.get_group("Score"):
 				if score.side == "right":
 					score.increment()
 		if self.position[0] > self.world.size[0]-15:
 			self.set_position(self.world.size/2,units="PIX")
-			angle = 0.3*math.pi*random.random()+random.choice([0,math.pi])
+			angle = 0.3*math.pi*self.world.random.random()+self.world.random.choice([0,math.pi])
 			self.set_velocity(30*np.array((math.cos(angle),math.sin(angle))))
 			for score in self.world.get_group("Score"):
 				if score.side == "left":
 					score.increment()
-		if self.position[1] < 15:
-			self.set_velocity((self.velocity[0],abs(self.velocity[1])),units="PIX")
-		if self.position[1] > self.world.size[1]-15:
-			self.set_velocity((self.velocity[0],-abs(self.velocity[1])),units="PIX")
 		if self.velocity[0] == 0:
-			self.velocity[0] = random.choice([.01,-.01])
+			self.velocity[0] = self.world.random.choice([.01,-.01])
 		CollidingEntity.process(self,dt)
 
+
+class Wall(CollidingEntity):
+	# Top and bottom edges of the table, just off the screen. Static
+	# bodies: the balls bounce off them, but they are never moved.
+	static = True
+
+	def init(self):
+		self.type = "Wall"
+		self.shape = AABB(self.size)
+
+def add_walls(world,scale):
+    # Static walls along the top and bottom edges of the world
+    width,height = world.size
+    wallImage = pygame.Surface((width,WALL_THICKNESS))
+    for y in (-WALL_THICKNESS/2.,height+WALL_THICKNESS/2.):
+        world.add(Wall(world,position=(width/2./scale,y/scale),image=wallImage))
      
 class Paddle(CollidingEntity):
+    # Driven by its own process, so it never comes to rest
+    canSleep = False
+
     def init(self):
         # Zero corresponds to x-axis
         self.degreeOfFreedom = 0
         self.kp = kp
         self.kv = kv
         self.type = "Paddle"
+        self.shape = AABB(self.size)
        
     def set_dof(self,dof,fixedCoordinate):
         self.degreeOfFreedom = 0 if dof == 'x' else 1
@@ -88,7 +112,7 @@ class Paddle(CollidingEntity):
     def process(self,dt):
         # These values are in pixels or pixels/second
         positionDesired = np.array((0.,0.))
-        positionDesired[self.degreeOfFreedom] = pygame.mouse.get_pos()[self.degreeOfFreedom]
+        positionDesired[self.degreeOfFreedom] = self.world.input.get_mouse_pos()[self.degreeOfFreedom]
         positionDesired[1-self.degreeOfFreedom] = self.fixedCoordinate
         velocityDesired = np.array((0.,0.))
        
@@ -101,28 +125,31 @@ class Paddle(CollidingEntity):
         self.set_force(forceCommanded)
        
         #print "velocity:", self.velocity
-        if pygame.key.get_pressed()[K_SPACE]:
-            self.add_force((-7000.,0.))
+        if self.world.input.get_pressed()[K_SPACE]:
+            self.add_force((-70.,0.))
        
         CollidingEntity.process(self,dt)
-        
-    def collides_with(self,point):
-		return self.rect.collidepoint(point)
 		
 class ComputerPaddle(Paddle):
+	def init(self):
+		Paddle.init(self)
+		self.difficulty = DIFFICULTY
+
 	def process(self,dt):
 		self.ball = self.world.get_group("Ball")[0]
 		# These values are in pixels or pixels/second
 		positionDesired = np.array((0.,0.))
-		if DIFFICULTY in ("easy","medium"):
+		if self.difficulty in ("easy","medium"):
 			positionDesired[self.degreeOfFreedom] = self.ball.position[self.degreeOfFreedom]
-		elif DIFFICULTY == "hard":
-			expectedYPos = (self.fixedCoordinate - self.ball.position[0])/self.ball.velocity[0]*self.ball.velocity[1]+self.ball.position[1]
-			if expectedYPos < 0:
-				expectedYPos = -expectedYPos
-			elif expectedYPos > self.world.size[1]:
-				expectedYPos = self.world.size[1] - (expectedYPos-self.world.size[1])
-			positionDesired[self.degreeOfFreedom] = expectedYPos
+		elif self.difficulty == "hard":
+			# Head for where the ball will cross this paddle's line, after
+			# any number of bounces; the world shares the prediction
+			fixedAxis = 1-self.degreeOfFreedom
+			crossing = self.world.predict(self.ball,PREDICTION_HORIZON).crossing(fixedAxis,self.fixedCoordinate)
+			if crossing is not None:
+				positionDesired[self.degreeOfFreedom] = crossing[1][self.degreeOfFreedom]
+			else:
+				positionDesired[self.degreeOfFreedom] = self.ball.position[self.degreeOfFreedom]
 		positionDesired[1-self.degreeOfFreedom] = self.fixedCoordinate
 		velocityDesired = np.array((0.,0.))
 
@@ -134,24 +161,27 @@ class ComputerPaddle(Paddle):
 
 		self.set_force(forceCommanded)
 		
-		if DIFFICULTY in ("medium", "hard"):
+		if self.difficulty in ("medium", "hard"):
 			if self.ball.position[0] > self.fixedCoordinate - 300 and self.ball.position[0] < self.fixedCoordinate-150:
-				self.add_force((7000.,0.))	
+				self.add_force((70.,0.))	
 
 		CollidingEntity.process(self,dt)
 		   
        
-def main():
+def build_world(surface=None,size=(1000,700),**options):
+    """
+    Sets up a Pong match. With surface=None the world is headless and can
+    be advanced with world.step(n); options are passed on to PhysicsWorld
+    (fixedTimestep, input, ...)
+    """
     SCALE = 10 # pixels per meter
-    pygame.init()
-    screen = pygame.display.set_mode((1000,700))
-    screenWidth,screenHeight = screen.get_size()
-    worldSize = np.array(screen.get_size())/SCALE
-    pygame.display.set_caption("Newton World")
-    screen.fill((255,255,255))
-    pygame.display.flip()
+    if surface is not None:
+        size = surface.get_size()
+    worldSize = np.array(size)/SCALE
+    pygame.font.init()
    
-    world = PhysicsWorld("Pong",screen,framesPerSecond=100,scale=SCALE)
+    world = PhysicsWorld("Pong",surface,framesPerSecond=100,scale=SCALE,size=size,**options)
+    add_walls(world,SCALE)
    
     #square = MouseTracker(world,position=worldSize/2,mass=1)
     #world.add(square)
@@ -177,11 +207,49 @@ def main():
     world.add(score1)
     score2 = Score(world,"right")
     world.add(score2)
+    return world
+
+def evaluation_world(kp=None,kv=None,difficulty=None,fixedTimestep=0.01,**options):
+    """
+    Headless match for Runner.run_worlds: the computer paddle plays with
+    the given gains and difficulty (the module defaults if None) against a
+    paddle holding still
+    """
+    world = build_world(fixedTimestep=fixedTimestep,**options)
+    for paddle in world.get_instances(ComputerPaddle):
+        if kp is not None:
+            paddle.kp = kp
+        if kv is not None:
+            paddle.kv = kv
+        if difficulty is not None:
+            paddle.difficulty = difficulty
+    return world
+
+def match_result(world):
+    # Scores of a match, for Runner.run_worlds
+    scores = dict((score.side,score.value) for score in world.get_group("Score"))
+    return {'left':scores.get('left',0),'right':scores.get('right',0)}
+       
+def main(record=None):
+    # With record set, the match is saved there for Replay.py
+    pygame.init()
+    screen = pygame.display.set_mode((1000,700))
+    pygame.display.set_caption("Newton World")
+    screen.fill((255,255,255))
+    pygame.display.flip()
+   
+    world = build_world(screen)
+    paddle1 = world.get_group("Paddle")[0]
+    if record:
+        world.start_recording(record,build_world,{'size':screen.get_size()})
    
     pygame.mouse.set_pos(paddle1.get_position(units="PIX"))
     world.unpause()
     world.run_main_loop()
+    world.stop_recording()
     pygame.quit()
        
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Play Pong against the computer")
+    parser.add_argument('--record',metavar='PATH',help="save the match for Replay.py")
+    main(parser.parse_args().record)
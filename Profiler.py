@@ -0,0 +1,139 @@
+# Per-phase frame timing for World
+from timeit import default_timer as timer
+
+import numpy as np
+
+class FrameProfiler(object):
+    """
+    Records how long each phase of a frame takes, and how much of the
+    process phase each entity type accounts for, over the last `capacity`
+    frames. Created by World.enable_profiling(); while a world has no
+    profiler none of this code runs.
+
+    A frame is one call to World.frame(), or one tick of World.step().
+    Phases can nest: collision checks made from inside an entity's process
+    count towards both 'collide' and 'process'.
+
+    Hooks registered with add_hook are called as hook(world,phase) before
+    a phase and hook(world,phase,seconds) after it.
+
+    Arguments:
+    --------------------------------------------------------------------
+    world           | the world being profiled
+    capacity        | number of frames kept in the ring buffer
+    --------------------------------------------------------------------
+    """
+    PHASES = ('input','apply_fields','collide','process','clean','render','display')
+
+    def __init__(self,world,capacity=600):
+        self.world = world
+        self.capacity = capacity
+        self.phaseIndex = dict((name,i) for i,name in enumerate(self.PHASES))
+        self.frameTimes = np.zeros(capacity)
+        self.phaseTimes = np.zeros((capacity,len(self.PHASES)))
+        self.typeTimes = {}
+        self.frames = 0
+        self.missedFrames = 0
+        self.before = dict((name,[]) for name in self.PHASES)
+        self.after = dict((name,[]) for name in self.PHASES)
+        self._row = 0
+        self._frameStart = None
+
+    def add_hook(self,phase,before=None,after=None):
+        if before is not None:
+            self.before[phase].append(before)
+        if after is not None:
+            self.after[phase].append(after)
+
+    def remove_hook(self,phase,hook):
+        for hooks in (self.before[phase],self.after[phase]):
+            if hook in hooks:
+                hooks.remove(hook)
+
+    def begin_frame(self):
+        self._row = self.frames % self.capacity
+        self.phaseTimes[self._row] = 0.
+        for times in self.typeTimes.values():
+            times[self._row] = 0.
+        self._frameStart = timer()
+
+    def end_frame(self):
+        elapsed = timer() - self._frameStart
+        self.frameTimes[self._row] = elapsed
+        self.frames += 1
+        if elapsed > 1./self.world.framesPerSecond:
+            self.missedFrames += 1
+
+    def phase(self,name,function,*args):
+        """
+        Calls function(*args) as phase `name`, running its hooks and adding
+        the time taken to the current frame
+        """
+        for hook in self.before[name]:
+            hook(self.world,name)
+        start = timer()
+        result = function(*args)
+        elapsed = timer() - start
+        self.phaseTimes[self._row,self.phaseIndex[name]] += elapsed
+        for hook in self.after[name]:
+            hook(self.world,name,elapsed)
+        return result
+
+    def add_type_time(self,entityType,seconds):
+        times = self.typeTimes.get(entityType)
+        if times is None:
+            times = self.typeTimes[entityType] = np.zeros(self.capacity)
+        times[self._row] += seconds
+
+    def process_entities(self,entities,dt):
+        # Process entities one at a time, charging each to its type
+        for entity in entities:
+            start = timer()
+            entity.process(dt)
+            self.add_type_time(entity.type,timer()-start)
+
+    def _recorded(self):
+        return min(self.frames,self.capacity)
+
+    def percentiles(self,q=(50,95,99)):
+        """
+        returns:    frame time percentiles in seconds over the buffered frames
+        """
+        n = self._recorded()
+        if not n:
+            return dict((p,0.) for p in q)
+        return dict(zip(q,np.percentile(self.frameTimes[:n],q)))
+
+    def missed_budget(self):
+        """
+        returns:    number of buffered frames that took longer than the
+                    world's frame budget (1/framesPerSecond)
+        """
+        n = self._recorded()
+        return int(np.sum(self.frameTimes[:n] > 1./self.world.framesPerSecond))
+
+    def phase_means(self):
+        n = self._recorded()
+        if not n:
+            return {}
+        means = self.phaseTimes[:n].mean(axis=0)
+        return dict((name,means[i]) for name,i in self.phaseIndex.items())
+
+    def type_means(self):
+        n = self._recorded()
+        if not n:
+            return {}
+        return dict((entityType,times[:n].mean()) for entityType,times in self.typeTimes.items())
+
+    def summary(self):
+        percentiles = self.percentiles()
+        return {
+            'frames':self.frames,
+            'p50':percentiles[50],
+            'p95':percentiles[95],
+            'p99':percentiles[99],
+            'missedBudget':self.missed_budget(),
+            'missedFrames':self.missedFrames,
+            'phases':self.phase_means(),
+            'types':self.type_means(),
+            }
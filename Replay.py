@@ -0,0 +1,329 @@
+# Deterministic recording and replay of simulations
+"""
+A Recorder logs what a world reads from outside each tick (the input
+and the tick length) to a compact binary file, with a keyframe of the
+whole simulation every so many ticks. A Replayer rebuilds the world
+headless from the same factory and re-runs it from the recording as fast
+as it can; to reach any tick it loads the last keyframe before it and
+replays only the ticks since.
+
+Replays are exact as long as entities draw random numbers from
+world.random (saved in every keyframe), read input through world.input
+and keep any state of their own in get_state()/set_state().
+
+    python Replay.py match.rec --tick 1200
+    python Replay.py match.rec --verify
+
+File layout (little endian): MAGIC, uint32 header length, JSON header,
+then records, each starting with one byte saying what it is:
+    D   uint32 tick, float64 dt             tick length from tick on
+    I   uint32 tick, float64 x, float64 y,  input from tick on
+        uint16 n, uint32 keys[n]
+    K   uint32 tick, uint32 length, pickle  World.save_state() at the
+                                            start of tick
+    E   uint32 tick                         end of the recording
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+
+import sys
+import json
+import struct
+import bisect
+import argparse
+import importlib
+import cPickle as pickle
+from timeit import default_timer as timer
+
+import numpy as np
+import pygame
+import pygame.locals
+
+from Input import PressedKeys,ReplayInput
+
+MAGIC = b'WRLDREC1'
+FORMAT = 1
+_LENGTH = struct.Struct('<I')
+_TIMESTEP = struct.Struct('<cId')
+_INPUT = struct.Struct('<cIddH')
+_KEYFRAME = struct.Struct('<cII')
+_END = struct.Struct('<cI')
+
+# Keys recorded from live pygame input; PressedKeys record their own
+KEYS = sorted(set(value for name,value in vars(pygame.locals).items() if name.startswith('K_')))
+
+def factory_name(factory):
+    # "module:function" that resolve() finds factory by in another process
+    module = factory.__module__
+    if module == '__main__':
+        module = os.path.splitext(os.path.basename(sys.modules['__main__'].__file__))[0]
+    return '%s:%s' % (module,factory.__name__)
+
+def resolve(name):
+    module,function = name.split(':')
+    return getattr(importlib.import_module(module),function)
+
+class Recorder(object):
+    """
+    Records a world's input to the file at path. Made by
+    World.start_recording(), which calls record() at the start of every
+    tick; close() (World.stop_recording) finishes the file.
+
+    Arguments:
+    --------------------------------------------------------------------
+    world           | the world to record
+    path            | file to write
+    factory         | module level function that builds the world
+    config          | JSON-able keyword arguments for factory
+    keyframeEvery   | ticks between keyframes
+    keys            | key constants recorded from live pygame input
+    --------------------------------------------------------------------
+    """
+    def __init__(self,world,path,factory,config=None,keyframeEvery=500,keys=None):
+        self.world = world
+        self.path = path
+        self.keyframeEvery = keyframeEvery
+        self.keys = KEYS if keys is None else keys
+        self.file = open(path,'wb')
+        header = json.dumps({'format':FORMAT,'factory':factory_name(factory),
+                             'config':config or {},'seed':world.seed,
+                             'keyframeEvery':keyframeEvery}).encode('utf-8')
+        self.file.write(MAGIC + _LENGTH.pack(len(header)) + header)
+        self._dt = None
+        self._input = None
+        self._lastKeyframe = None
+        self.keyframes = 0
+
+    def record(self,dt):
+        tick = self.world.tickCount
+        if self._lastKeyframe is None or tick - self._lastKeyframe >= self.keyframeEvery:
+            self.keyframe()
+        write = self.file.write
+        if dt != self._dt:
+            write(_TIMESTEP.pack(b'D',tick,dt))
+            self._dt = dt
+        source = self.world.input
+        x,y = source.get_mouse_pos()
+        pressed = source.get_pressed()
+        if isinstance(pressed,PressedKeys):
+            keys = sorted(pressed.keys)
+        else:
+            keys = [key for key in self.keys if pressed[key]]
+        current = (float(x),float(y),keys)
+        if current != self._input:
+            write(_INPUT.pack(b'I',tick,current[0],current[1],len(keys)))
+            write(struct.pack('<%dI' % len(keys),*keys))
+            self._input = current
+
+    def keyframe(self):
+        # Saves the whole simulation as it is at the start of this tick
+        tick = self.world.tickCount
+        data = pickle.dumps(self.world.save_state(),pickle.HIGHEST_PROTOCOL)
+        self.file.write(_KEYFRAME.pack(b'K',tick,len(data)))
+        self.file.write(data)
+        self.file.flush()
+        self._lastKeyframe = tick
+        self.keyframes += 1
+
+    def close(self):
+        self.file.write(_END.pack(b'E',self.world.tickCount))
+        self.file.close()
+
+class Recording(object):
+    """
+    Contents of a file written by a Recorder: the header fields, the
+    input changes and tick lengths, and where the keyframes are. The
+    keyframes themselves are only read when asked for.
+    """
+    def __init__(self,path):
+        self.path = path
+        with open(path,'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a recording" % path)
+        offset = len(MAGIC)
+        length, = _LENGTH.unpack_from(data,offset)
+        offset += _LENGTH.size
+        header = json.loads(data[offset:offset+length].decode('utf-8'))
+        offset += length
+        if header['format'] != FORMAT:
+            raise ValueError("%s has an unknown format" % path)
+        self.factory = header['factory']
+        self.config = header['config']
+        self.seed = header['seed']
+        self.changes = []
+        self.timesteps = []
+        self.keyframes = []
+        self.end = None
+        while offset < len(data):
+            kind = data[offset:offset+1]
+            if kind == b'D':
+                kind,tick,dt = _TIMESTEP.unpack_from(data,offset)
+                self.timesteps.append((tick,dt))
+                offset += _TIMESTEP.size
+            elif kind == b'I':
+                kind,tick,x,y,n = _INPUT.unpack_from(data,offset)
+                offset += _INPUT.size
+                keys = struct.unpack_from('<%dI' % n,data,offset)
+                self.changes.append((tick,(x,y),keys))
+                offset += 4*n
+            elif kind == b'K':
+                kind,tick,length = _KEYFRAME.unpack_from(data,offset)
+                offset += _KEYFRAME.size
+                self.keyframes.append((tick,offset,length))
+                offset += length
+            elif kind == b'E':
+                kind,self.end = _END.unpack_from(data,offset)
+                break
+            else:
+                raise ValueError("%s is corrupt at byte %d" % (path,offset))
+        if not self.keyframes:
+            raise ValueError("%s has no keyframes" % path)
+        if self.end is None:
+            # Not closed (the game crashed, say): keep up to the last tick
+            # anything was recorded for
+            self.end = max([t for t,dt in self.timesteps] + [change[0] for change in self.changes] +
+                           [self.keyframes[-1][0]])
+        self.start = self.keyframes[0][0]
+        self._keyframeTicks = [keyframe[0] for keyframe in self.keyframes]
+        self._timestepTicks = [timestep[0] for timestep in self.timesteps]
+
+    def _keyframe_index(self,tick):
+        i = bisect.bisect_right(self._keyframeTicks,tick) - 1
+        if i < 0:
+            raise ValueError("No keyframe before tick %d" % tick)
+        return i
+
+    def keyframe_tick(self,tick):
+        # Tick of the last keyframe at or before tick
+        return self._keyframeTicks[self._keyframe_index(tick)]
+
+    def keyframe(self,tick):
+        """
+        returns:    (keyframeTick,state) for the last keyframe at or before
+                    tick
+        """
+        keyframeTick,offset,length = self.keyframes[self._keyframe_index(tick)]
+        with open(self.path,'rb') as f:
+            f.seek(offset)
+            return keyframeTick,pickle.loads(f.read(length))
+
+    def timestep(self,tick):
+        """
+        returns:    (dt,until): the length of tick and the tick at which
+                    it next changes (None if it does not)
+        """
+        i = bisect.bisect_right(self._timestepTicks,tick) - 1
+        until = self._timestepTicks[i+1] if i+1 < len(self.timesteps) else None
+        return self.timesteps[max(i,0)][1],until
+
+def same_state(a,b):
+    # True if two World.save_state() results are identical
+    if isinstance(a,dict):
+        return isinstance(b,dict) and sorted(a) == sorted(b) and all(same_state(a[k],b[k]) for k in a)
+    if isinstance(a,(list,tuple)):
+        return (isinstance(b,(list,tuple)) and len(a) == len(b) and
+                all(same_state(x,y) for x,y in zip(a,b)))
+    if isinstance(a,np.ndarray):
+        # NaN (no charge) counts as equal to itself
+        return (isinstance(b,np.ndarray) and a.shape == b.shape and
+                bool(((a == b) | ((a != a) & (b != b))).all()))
+    return a == b
+
+class Replayer(object):
+    """
+    Re-runs a recording in a headless world built by the recorded factory
+    (or the one given). The world starts at the first keyframe.
+
+    Arguments:
+    --------------------------------------------------------------------
+    recording       | path of a recording, or a Recording
+    factory         | function building the world, called with the
+                    | recorded config (defaults to the recorded factory)
+    --------------------------------------------------------------------
+    """
+    def __init__(self,recording,factory=None):
+        if not isinstance(recording,Recording):
+            recording = Recording(recording)
+        self.recording = recording
+        if factory is None:
+            factory = resolve(recording.factory)
+        self.world = factory(**recording.config)
+        self.input = ReplayInput(recording.changes)
+        self.world.input = self.input
+        self.load(recording.start)
+
+    def load(self,tick):
+        # Puts the world at the last keyframe at or before tick
+        keyframeTick,state = self.recording.keyframe(tick)
+        self.world.load_state(state)
+        return keyframeTick
+
+    def seek(self,tick):
+        """
+        Takes the world to the start of tick, replaying forward from where
+        it is if that is nearer than the last keyframe
+        """
+        recording = self.recording
+        if not recording.start <= tick <= recording.end:
+            raise ValueError("Tick %d is outside the recording (%d to %d)" %
+                             (tick,recording.start,recording.end))
+        keyframeTick = recording.keyframe_tick(tick)
+        if not keyframeTick <= self.world.tickCount <= tick:
+            self.load(tick)
+        self.run_to(tick)
+
+    def run_to(self,tick):
+        # Replays forward to the start of tick
+        world = self.world
+        while world.tickCount < tick:
+            dt,until = self.recording.timestep(world.tickCount)
+            n = (tick if until is None else min(tick,until)) - world.tickCount
+            self.input.tick = world.tickCount
+            world.step(n,dt)
+
+    def run(self):
+        # Replays to the end of the recording
+        self.run_to(self.recording.end)
+
+    def verify(self):
+        """
+        Replays the whole recording from its first keyframe, comparing the
+        simulation with each later keyframe on the way.
+        returns:    the tick of the first keyframe the replay differs from,
+                    or None if it matches them all
+        """
+        recording = self.recording
+        self.load(recording.start)
+        for tick,offset,length in recording.keyframes[1:]:
+            self.run_to(tick)
+            if not same_state(self.world.save_state(),recording.keyframe(tick)[1]):
+                return tick
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded simulation headless")
+    parser.add_argument('path')
+    parser.add_argument('--tick',type=int,default=None,help="tick to stop at (default: the end)")
+    parser.add_argument('--verify',action='store_true',
+                        help="check the replay against every keyframe")
+    args = parser.parse_args(argv)
+
+    start = timer()
+    replayer = Replayer(args.path)
+    recording = replayer.recording
+    result = {'start':recording.start,'end':recording.end,'keyframes':len(recording.keyframes)}
+    if args.verify:
+        divergence = replayer.verify()
+        result['divergedAt'] = divergence
+    else:
+        replayer.seek(recording.end if args.tick is None else args.tick)
+    world = replayer.world
+    result['tick'] = world.tickCount
+    result['seconds'] = timer()-start
+    result['entities'] = [[entity.type]+(list(entity.rect.center) if entity.rect else [])
+                          for entity in world.get_entities()]
+    print json.dumps(result,sort_keys=True)
+
+if __name__ == "__main__":
+    main()
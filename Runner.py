@@ -0,0 +1,121 @@
+# Runs many independent headless worlds across a process pool
+"""
+Each world is built by a factory from a dict of keyword arguments, run
+headless for a number of ticks and summarised by a metrics function.
+Worlds are independent, so they are spread over a multiprocessing pool
+one per task and their results are yielded as soon as each finishes.
+
+The factory, metrics and until functions are sent to the worker
+processes, so they must be module level functions (not lambdas). Every
+world gets its own seed for `random` and numpy, derived from the run's
+seed and the world's index, so a run gives the same results whatever the
+number of processes.
+
+    python Runner.py --kp 10 20 40 --difficulty easy hard --ticks 3000
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+
+import sys
+import json
+import random
+import argparse
+import itertools
+import multiprocessing
+from timeit import default_timer as timer
+
+import numpy as np
+
+def world_seed(seed,index):
+    # Seed of the index-th world of a run; does not depend on the process
+    return (seed*1000003 + index) % (1 << 32)
+
+def run_world(factory,config,ticks,seed,metrics=None,until=None,checkEvery=100,profile=False):
+    """
+    Builds factory(**config) with `random` and numpy seeded and steps it
+    for `ticks` ticks, or until until(world) is true (checked every
+    checkEvery ticks).
+
+    returns:    dict of the ticks run, the seconds taken and the seed, plus
+                metrics(world) and, if profile is set, the profiler summary
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    start = timer()
+    world = factory(**config)
+    if profile:
+        world.enable_profiling()
+    done = 0
+    while done < ticks:
+        n = min(checkEvery,ticks-done) if until else ticks-done
+        world.step(n)
+        done += n
+        if until and until(world):
+            break
+    result = {'ticks':done,'seconds':timer()-start,'seed':seed}
+    if metrics is not None:
+        result.update(metrics(world))
+    if profile:
+        result['profile'] = world.profiler.summary()
+    return result
+
+def _run_job(job):
+    index,args = job
+    return index,run_world(*args)
+
+def _init_worker():
+    # Workers only simulate; keep SIGINT for the parent to handle
+    import signal
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+def run_worlds(factory,configs,ticks,metrics=None,processes=None,seed=0,until=None,
+               checkEvery=100,profile=False):
+    """
+    Runs one world per config, yielding (index,config,result) in the order
+    the worlds finish (see run_world for result). processes=1 runs them
+    one after the other in this process; None uses every core.
+    """
+    configs = list(configs)
+    jobs = [(i,(factory,config,ticks,world_seed(seed,i),metrics,until,checkEvery,profile))
+            for i,config in enumerate(configs)]
+    if processes == 1:
+        for job in jobs:
+            index,result = _run_job(job)
+            yield index,configs[index],result
+        return
+    pool = multiprocessing.Pool(processes,_init_worker)
+    try:
+        for index,result in pool.imap_unordered(_run_job,jobs):
+            yield index,configs[index],result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    import Pong
+    parser = argparse.ArgumentParser(description="Run a sweep of headless Pong matches")
+    parser.add_argument('--kp',nargs='+',type=float,default=[Pong.kp])
+    parser.add_argument('--kv',nargs='+',type=float,default=[Pong.kv])
+    parser.add_argument('--difficulty',nargs='+',default=[Pong.DIFFICULTY],
+                        choices=['easy','medium','hard'])
+    parser.add_argument('--repeats',type=int,default=1,help="matches per setting")
+    parser.add_argument('--ticks',type=int,default=3000)
+    parser.add_argument('--processes',type=int,default=None)
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args(argv)
+
+    configs = [{'kp':kp,'kv':kv,'difficulty':difficulty}
+               for kp,kv,difficulty,repeat in itertools.product(args.kp,args.kv,args.difficulty,
+                                                                range(args.repeats))]
+    start = timer()
+    for index,config,result in run_worlds(Pong.evaluation_world,configs,args.ticks,
+                                          Pong.match_result,args.processes,args.seed):
+        result.update(config)
+        result['index'] = index
+        print(json.dumps(result,sort_keys=True))
+        sys.stdout.flush()
+    sys.stderr.write("%d matches in %.1fs\n" % (len(configs),timer()-start))
+
+if __name__ == "__main__":
+    main()
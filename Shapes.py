@@ -0,0 +1,285 @@
+# Collision shapes and the narrowphase tests between them
+"""
+Shapes are given relative to an entity's position (its centre of mass, in
+pixels) and do not rotate, as entities have no orientation. collide()
+tests two placed shapes and gives the contact normal, pointing from the
+first shape into the second, and how deep they overlap along it.
+
+Boxes and circles against each other have their own closed form tests;
+anything involving a polygon uses the separating axis theorem (SAT). As
+shapes do not rotate, their extents along the candidate axes are worked
+out once, and a test only shifts them by the distance between the
+shapes, stopping at the first axis that separates them.
+"""
+import math
+
+import numpy as np
+import pygame
+
+class Shape(object):
+    # Name collide() dispatches on
+    kind = None
+    # (left,top,right,bottom) of the shape relative to the position
+    extent = None
+
+    def _prepare(self,vertices):
+        """
+        Keeps what SAT needs from the corners (relative to the position):
+        the unit outward edge normals, one per direction up to sign, with
+        the extent of the shape along each
+        """
+        vertices = np.array(vertices,float)
+        edges = np.roll(vertices,-1,axis=0) - vertices
+        normals = np.column_stack((edges[:,1],-edges[:,0]))
+        normals /= np.sqrt(np.einsum('ij,ij->i',normals,normals))[:,None]
+        # Make the normals point out of the shape whatever the winding
+        centre = vertices.mean(axis=0)
+        if np.dot(normals[0],vertices[0]-centre) < 0:
+            normals = -normals
+        self._vertices = vertices
+        self._axes = normals
+        # The shape is every point p with p.axis <= limit for all axes
+        self._limits = np.einsum('ij,ij->i',normals,vertices)
+        self._vertexList = [tuple(vertex) for vertex in vertices.tolist()]
+        self._centre = tuple(centre.tolist())
+        self._rows = []
+        for axis in _distinct(normals):
+            projections = vertices.dot(axis)
+            self._rows.append((axis[0],axis[1],projections.min(),projections.max()))
+
+    def bounds(self,position):
+        """
+        returns:    the pygame.Rect covering the shape placed at position
+        """
+        raise NotImplementedError
+
+    def contains(self,point):
+        # True if point, relative to the shape's position, is inside it
+        raise NotImplementedError
+
+class AABB(Shape):
+    """
+    Axis aligned box of the given size, centred offset from the position
+    """
+    kind = 'aabb'
+
+    def __init__(self,size,offset=(0,0)):
+        self.halfWidth = size[0]/2.
+        self.halfHeight = size[1]/2.
+        self.offset = (float(offset[0]),float(offset[1]))
+        hw,hh = self.halfWidth,self.halfHeight
+        ox,oy = self.offset
+        self.key = (self.kind,hw,hh,ox,oy)
+        self.extent = (ox-hw,oy-hh,ox+hw,oy+hh)
+        self._prepare(((ox-hw,oy-hh),(ox+hw,oy-hh),(ox+hw,oy+hh),(ox-hw,oy+hh)))
+
+    def bounds(self,position):
+        x = position[0] + self.offset[0]
+        y = position[1] + self.offset[1]
+        left = int(math.floor(x - self.halfWidth))
+        top = int(math.floor(y - self.halfHeight))
+        return pygame.Rect(left,top,int(math.ceil(x + self.halfWidth)) - left,
+                           int(math.ceil(y + self.halfHeight)) - top)
+
+    def contains(self,point):
+        return (abs(point[0]-self.offset[0]) <= self.halfWidth and
+                abs(point[1]-self.offset[1]) <= self.halfHeight)
+
+class Circle(Shape):
+    """
+    Circle of the given radius, centred offset from the position
+    """
+    kind = 'circle'
+
+    def __init__(self,radius,offset=(0,0)):
+        self.radius = float(radius)
+        self.offset = (float(offset[0]),float(offset[1]))
+        self.key = (self.kind,self.radius) + self.offset
+        r = self.radius
+        self.extent = (self.offset[0]-r,self.offset[1]-r,self.offset[0]+r,self.offset[1]+r)
+
+    def bounds(self,position):
+        x = position[0] + self.offset[0]
+        y = position[1] + self.offset[1]
+        r = self.radius
+        left,top = int(math.floor(x - r)),int(math.floor(y - r))
+        return pygame.Rect(left,top,int(math.ceil(x + r)) - left,int(math.ceil(y + r)) - top)
+
+    def contains(self,point):
+        dx = point[0] - self.offset[0]
+        dy = point[1] - self.offset[1]
+        return dx*dx + dy*dy <= self.radius*self.radius
+
+class Polygon(Shape):
+    """
+    Convex polygon with the given corners, relative to the position, in
+    either winding order
+    """
+    kind = 'polygon'
+
+    def __init__(self,vertices):
+        if len(vertices) < 3:
+            raise ValueError("A polygon needs at least three vertices")
+        self._prepare(vertices)
+        self.key = (self.kind,tuple(self._vertexList))
+        self.extent = tuple(self._vertices.min(axis=0).tolist() + self._vertices.max(axis=0).tolist())
+
+    def bounds(self,position):
+        low = np.floor(self._vertices.min(axis=0) + position)
+        high = np.ceil(self._vertices.max(axis=0) + position)
+        return pygame.Rect(int(low[0]),int(low[1]),int(high[0]-low[0]),int(high[1]-low[1]))
+
+    def contains(self,point):
+        return bool((self._axes.dot((point[0],point[1])) <= self._limits).all())
+
+def _distinct(axes):
+    # Axes with the same direction up to sign give the same test
+    seen = set()
+    distinct = []
+    for x,y in axes.tolist():
+        key = (round(x,12),round(y,12)) if (x,y) > (0.,0.) else (round(-x,12),round(-y,12))
+        if key not in seen:
+            seen.add(key)
+            distinct.append((x,y))
+    return distinct
+
+def _sign(x):
+    return -1. if x < 0 else 1.
+
+def aabb_aabb(a,position1,b,position2):
+    dx = (position2[0]+b.offset[0]) - (position1[0]+a.offset[0])
+    dy = (position2[1]+b.offset[1]) - (position1[1]+a.offset[1])
+    overlapX = a.halfWidth + b.halfWidth - abs(dx)
+    if overlapX <= 0:
+        return None
+    overlapY = a.halfHeight + b.halfHeight - abs(dy)
+    if overlapY <= 0:
+        return None
+    if overlapX < overlapY:
+        return (_sign(dx),0.),overlapX
+    return (0.,_sign(dy)),overlapY
+
+def circle_circle(a,position1,b,position2):
+    dx = (position2[0]+b.offset[0]) - (position1[0]+a.offset[0])
+    dy = (position2[1]+b.offset[1]) - (position1[1]+a.offset[1])
+    r = a.radius + b.radius
+    distance2 = dx*dx + dy*dy
+    if distance2 >= r*r:
+        return None
+    distance = math.sqrt(distance2)
+    if distance == 0:
+        return (1.,0.),r
+    return (dx/distance,dy/distance),r - distance
+
+def aabb_circle(box,position1,circle,position2):
+    bx = position1[0] + box.offset[0]
+    by = position1[1] + box.offset[1]
+    cx = position2[0] + circle.offset[0]
+    cy = position2[1] + circle.offset[1]
+    hw,hh,r = box.halfWidth,box.halfHeight,circle.radius
+    # Closest point of the box to the centre of the circle
+    qx = min(max(cx,bx-hw),bx+hw)
+    qy = min(max(cy,by-hh),by+hh)
+    dx,dy = cx-qx,cy-qy
+    distance2 = dx*dx + dy*dy
+    if distance2 >= r*r:
+        return None
+    if distance2 > 0:
+        distance = math.sqrt(distance2)
+        return (dx/distance,dy/distance),r - distance
+    # The centre is inside the box: push out through the nearest face
+    overlapX = hw - abs(cx-bx)
+    overlapY = hh - abs(cy-by)
+    if overlapX < overlapY:
+        return (_sign(cx-bx),0.),overlapX + r
+    return (0.,_sign(cy-by)),overlapY + r
+
+# Extents of pairs of polygons along the axes of both, by shape geometry
+_pairs = {}
+
+def _pair_rows(a,b):
+    key = (a.key,b.key)
+    rows = _pairs.get(key)
+    if rows is None:
+        axes = np.concatenate((a._axes,b._axes))
+        rows = []
+        for ax,ay in _distinct(axes):
+            projections1 = a._vertices.dot((ax,ay))
+            projections2 = b._vertices.dot((ax,ay))
+            rows.append((ax,ay,projections1.min(),projections1.max(),
+                         projections2.min(),projections2.max()))
+        rows = _pairs[key] = (rows,b._centre[0]-a._centre[0],b._centre[1]-a._centre[1])
+    return rows
+
+def polygon_polygon(a,position1,b,position2):
+    rows,cx,cy = _pair_rows(a,b)
+    dx = position2[0] - position1[0]
+    dy = position2[1] - position1[1]
+    depth = None
+    for ax,ay,low1,high1,low2,high2 in rows:
+        shift = ax*dx + ay*dy
+        overlap = min(high1,high2+shift) - max(low1,low2+shift)
+        if overlap <= 0:
+            return None
+        if depth is None or overlap < depth:
+            depth,nx,ny = overlap,ax,ay
+    # Point the normal from the first shape towards the second
+    if nx*(cx+dx) + ny*(cy+dy) < 0:
+        nx,ny = -nx,-ny
+    return (nx,ny),depth
+
+def polygon_circle(polygon,position1,circle,position2):
+    # Work relative to the polygon's position
+    qx = position2[0] + circle.offset[0] - position1[0]
+    qy = position2[1] + circle.offset[1] - position1[1]
+    r = circle.radius
+    depth = None
+    for ax,ay,low,high in polygon._rows:
+        middle = ax*qx + ay*qy
+        overlap = min(high,middle+r) - max(low,middle-r)
+        if overlap <= 0:
+            return None
+        if depth is None or overlap < depth:
+            depth,nx,ny = overlap,ax,ay
+    # The axis through the corner nearest the centre of the circle
+    vx,vy = min(polygon._vertexList,key=lambda v: (v[0]-qx)*(v[0]-qx) + (v[1]-qy)*(v[1]-qy))
+    length = math.sqrt((qx-vx)*(qx-vx) + (qy-vy)*(qy-vy))
+    if length > 0:
+        ax,ay = (qx-vx)/length,(qy-vy)/length
+        projections = [x*ax + y*ay for x,y in polygon._vertexList]
+        middle = ax*qx + ay*qy
+        overlap = min(max(projections),middle+r) - max(min(projections),middle-r)
+        if overlap <= 0:
+            return None
+        if overlap < depth:
+            depth,nx,ny = overlap,ax,ay
+    cx,cy = polygon._centre
+    if nx*(qx-cx) + ny*(qy-cy) < 0:
+        nx,ny = -nx,-ny
+    return (nx,ny),depth
+
+_TESTS = {
+    ('aabb','aabb'):aabb_aabb,
+    ('circle','circle'):circle_circle,
+    ('aabb','circle'):aabb_circle,
+    ('aabb','polygon'):polygon_polygon,
+    ('polygon','polygon'):polygon_polygon,
+    ('polygon','circle'):polygon_circle,
+    }
+
+def collide(shape1,position1,shape2,position2):
+    """
+    Tests shape1 placed at position1 against shape2 at position2.
+
+    returns:    (normalVector,depth) with normalVector the unit normal
+                pointing from shape1 into shape2 and depth how far they
+                overlap along it, or None if they do not overlap
+    """
+    test = _TESTS.get((shape1.kind,shape2.kind))
+    if test is not None:
+        return test(shape1,position1,shape2,position2)
+    hit = _TESTS[(shape2.kind,shape1.kind)](shape2,position2,shape1,position1)
+    if hit is None:
+        return None
+    (nx,ny),depth = hit
+    return (-nx,-ny),depth
@@ -0,0 +1,303 @@
+# Publishing world state to other processes through shared memory
+"""
+A StatePublisher writes the id, type, position, velocity and rect of
+every entity in a world into a named block of shared memory after each
+tick; a StateReader in any other process maps the same block and gets
+NumPy views of the latest complete frame without copying or pickling.
+
+The block holds two buffers. The writer fills the one readers are not
+pointed at, then flips the `latest` index, so it never waits for
+readers. Each buffer carries a sequence number that is odd while the
+buffer is being written (a seqlock): a reader that sees the number change
+while it looks at a buffer knows the frame was overwritten and retries.
+A frame's views stay valid until two more frames have been published;
+Frame.valid() says whether that has happened.
+
+multiprocessing.shared_memory is used where it exists (Python 3.8+);
+otherwise the block is a file in /dev/shm (or the temporary directory)
+mapped with mmap, which behaves the same.
+
+Layout (all little endian, offsets in bytes):
+    header      8 x uint64: magic, format, capacity, latest, stale, 0, 0, 0
+    buffer x 2  meta 4 x uint64: sequence, tick, count, typesLength
+                types JSON list of type names (TYPES_BYTES)
+                ids int64[capacity], typeCodes int32[capacity] (padded),
+                position float64[capacity,2], velocity float64[capacity,2],
+                rect int32[capacity,4]
+"""
+import os
+import json
+import mmap
+import tempfile
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+MAGIC = 0x57524c4453544154
+FORMAT = 1
+HEADER_BYTES = 64
+META_BYTES = 32
+TYPES_BYTES = 4096
+# Header fields
+CAPACITY,LATEST,STALE = 2,3,4
+# Buffer meta fields
+SEQUENCE,TICK,COUNT,TYPES_LENGTH = 0,1,2,3
+
+def _pad(n):
+    return (n + 7) & ~7
+
+def buffer_bytes(capacity):
+    return (META_BYTES + TYPES_BYTES + 8*capacity + _pad(4*capacity) +
+            16*capacity + 16*capacity + 16*capacity)
+
+def block_bytes(capacity):
+    return HEADER_BYTES + 2*buffer_bytes(capacity)
+
+class _Block(object):
+    # A named block of shared memory, created or attached to
+    def __init__(self,name,size=None):
+        self.name = name
+        self.created = size is not None
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(name,create=self.created,size=size or 0)
+            self.buf = self._shm.buf
+            return
+        self._shm = None
+        self.path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                 'pygame-engine-'+name)
+        if self.created:
+            with open(self.path,'wb') as f:
+                f.truncate(size)
+        with open(self.path,'r+b') as f:
+            self.buf = mmap.mmap(f.fileno(),0)
+
+    def close(self):
+        self.buf = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # Frames handed out still view the block; it is unmapped
+                # when they are gone
+                pass
+
+    def unlink(self):
+        if self._shm is not None:
+            self._shm.unlink()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+class _Views(object):
+    # NumPy views of one buffer of a block
+    def __init__(self,buf,offset,capacity):
+        def view(dtype,shape):
+            array = np.ndarray(shape,dtype,buf,self._offset)
+            self._offset += _pad(array.nbytes)
+            return array
+        self._offset = offset
+        self.meta = view('<u8',(4,))
+        self.types = view('u1',(TYPES_BYTES,))
+        self.ids = view('<i8',(capacity,))
+        self.typeCodes = view('<i4',(capacity,))
+        self.position = view('<f8',(capacity,2))
+        self.velocity = view('<f8',(capacity,2))
+        self.rect = view('<i4',(capacity,4))
+
+def _layout(buf,capacity):
+    header = np.ndarray((8,),'<u8',buf,0)
+    size = buffer_bytes(capacity)
+    return header,[_Views(buf,HEADER_BYTES+i*size,capacity) for i in range(2)]
+
+class StatePublisher(object):
+    """
+    Publishes a world's entity state to the shared memory block `name`.
+    Made by World.enable_publishing(), which calls publish() after every
+    tick. If the world outgrows capacity, a block twice the size replaces
+    the old one and readers reattach to it by themselves.
+
+    Arguments:
+    --------------------------------------------------------------------
+    world           | the world to publish
+    name            | name readers open the block by
+    capacity        | number of entities the block has room for
+    --------------------------------------------------------------------
+    """
+    def __init__(self,world,name,capacity=1024):
+        self.world = world
+        self.name = name
+        self.block = None
+        self._ids = {}
+        self._nextId = 1
+        self._entities = None
+        self._create(capacity)
+
+    def _create(self,capacity):
+        old = self.block
+        if old is not None:
+            # Tell readers of the old block to reattach, then replace it
+            self.header[STALE] = 1
+            old.unlink()
+        self.capacity = capacity
+        self.block = _Block(self.name,block_bytes(capacity))
+        self.header,self.buffers = _layout(self.block.buf,capacity)
+        self.header[:] = (MAGIC,FORMAT,capacity,0,0,0,0,0)
+        self._writtenTypes = [None,None]
+        if old is not None:
+            old.close()
+
+    def _index(self):
+        # Per entity columns that only change when entities come and go
+        entities = list(self.world.get_entities())
+        ids = self._ids
+        self._ids = dict((entity,ids.get(entity) or self._new_id()) for entity in entities)
+        typeNames = sorted(set(entity.type for entity in entities))
+        codes = dict((name,i) for i,name in enumerate(typeNames))
+        store = getattr(self.world,'store',None)
+        stored = [store is not None and getattr(entity,'_store',None) is store for entity in entities]
+        self._entities = entities
+        self._idColumn = np.array([self._ids[entity] for entity in entities],np.int64)
+        self._typeColumn = np.array([codes[entity.type] for entity in entities],np.int32)
+        self._typeNames = json.dumps(typeNames).encode('utf-8')
+        self._stored = np.flatnonzero(stored)
+        self._slots = np.array([entities[i]._slot for i in self._stored],int)
+        self._sizes = np.array([entities[i].size for i in self._stored],float).reshape(-1,2)
+        self._others = np.flatnonzero(np.logical_not(stored))
+        self._version = self.world.version
+
+    def _new_id(self):
+        self._nextId += 1
+        return self._nextId - 1
+
+    def publish(self):
+        world = self.world
+        if self._entities is None or self._version != world.version:
+            self._index()
+        entities = self._entities
+        n = len(entities)
+        if n > self.capacity:
+            self._create(max(n,2*self.capacity))
+        b = 1 - int(self.header[LATEST])
+        views = self.buffers[b]
+        meta = views.meta
+
+        meta[SEQUENCE] += 1
+        views.ids[:n] = self._idColumn
+        views.typeCodes[:n] = self._typeColumn
+        if self._writtenTypes[b] is not self._typeNames:
+            if len(self._typeNames) > TYPES_BYTES:
+                raise ValueError("Too many entity types to publish")
+            views.types[:len(self._typeNames)] = np.frombuffer(self._typeNames,np.uint8)
+            meta[TYPES_LENGTH] = len(self._typeNames)
+            self._writtenTypes[b] = self._typeNames
+        if len(self._slots):
+            store = world.store
+            slots,stored = self._slots,self._stored
+            position = store.position[slots]
+            views.position[stored] = position
+            views.velocity[stored] = store.velocity[slots]
+            views.rect[stored,:2] = np.trunc(position - store.centerOfMass[slots])
+            views.rect[stored,2:] = self._sizes
+        for i in self._others:
+            entity = entities[i]
+            rect = entity.get_rect()
+            views.position[i] = getattr(entity,'position',(0,0))
+            views.velocity[i] = 0.
+            views.rect[i] = tuple(rect) if rect is not None else (0,0,0,0)
+        meta[TICK] = world.tickCount
+        meta[COUNT] = n
+        meta[SEQUENCE] += 1
+        self.header[LATEST] = b
+
+    def close(self):
+        self.header[STALE] = 1
+        self.header = self.buffers = None
+        self.block.close()
+        self.block.unlink()
+
+class Frame(object):
+    """
+    One published frame: tick, count, typeNames, and the arrays ids,
+    typeCodes, position, velocity (pixels, pixels/s) and rect (x,y,w,h),
+    each count rows long. Unless the reader was asked for a copy these are
+    views into shared memory; check valid() after using them.
+    """
+    def __init__(self,views,sequence,typeNames,copy):
+        count = int(views.meta[COUNT])
+        self.tick = int(views.meta[TICK])
+        self.count = count
+        self.typeNames = typeNames
+        self._meta = views.meta
+        self._sequence = sequence
+        for name in ('ids','typeCodes','position','velocity','rect'):
+            array = getattr(views,name)[:count]
+            setattr(self,name,array.copy() if copy else array)
+
+    def types(self):
+        # Type name of every entity
+        return [self.typeNames[code] for code in self.typeCodes]
+
+    def valid(self):
+        # False once the writer has started reusing this frame's buffer
+        return self._meta is None or self._meta[SEQUENCE] == self._sequence
+
+class StateReader(object):
+    """
+    Reads frames published under `name` by a StatePublisher, in this or
+    any other process.
+    """
+    def __init__(self,name):
+        self.name = name
+        self.block = None
+        self._typeNames = [None,None]
+        self._attach()
+
+    def _attach(self):
+        if self.block is not None:
+            self.block.close()
+        self.block = _Block(self.name)
+        header = np.ndarray((8,),'<u8',self.block.buf,0)
+        if header[0] != MAGIC or header[1] != FORMAT:
+            raise ValueError("%r is not a world state block" % self.name)
+        self.header,self.buffers = _layout(self.block.buf,int(header[CAPACITY]))
+        self._typeNames = [None,None]
+
+    def read(self,copy=False,attempts=1000):
+        """
+        returns:    the latest complete Frame, or None if nothing has been
+                    published yet. With copy=True the arrays are copies
+                    that stay valid for good.
+        """
+        for attempt in range(attempts):
+            if self.header[STALE]:
+                self._attach()
+                continue
+            b = int(self.header[LATEST])
+            views = self.buffers[b]
+            sequence = int(views.meta[SEQUENCE])
+            if sequence == 0:
+                return None
+            if sequence & 1:
+                continue
+            typeNames = self._type_names(b,views)
+            frame = Frame(views,sequence,typeNames,copy)
+            if views.meta[SEQUENCE] == sequence:
+                if copy:
+                    frame._meta = None
+                return frame
+        raise RuntimeError("No consistent frame after %d attempts" % attempts)
+
+    def _type_names(self,b,views):
+        length = int(views.meta[TYPES_LENGTH])
+        raw = views.types[:length].tobytes()
+        cached = self._typeNames[b]
+        if cached is None or cached[0] != raw:
+            cached = self._typeNames[b] = (raw,json.loads(raw.decode('utf-8')))
+        return cached[1]
+
+    def close(self):
+        self.header = self.buffers = None
+        self.block.close()
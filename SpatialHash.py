@@ -0,0 +1,176 @@
+# Uniform grid broadphase for entity rects
+import numpy as np
+import pygame
+
+def overlapping_pairs(low,high):
+    """
+    Sweep and prune over boxes given by their (n,2) low and high corners:
+    sorts them along the axis they are most spread over and pairs each
+    box with the ones starting before it ends.
+
+    returns:    index arrays (first,second) of the pairs of boxes that
+                overlap, each pair once
+    """
+    n = len(low)
+    if n < 2:
+        return np.zeros(0,int),np.zeros(0,int)
+    axis = int(np.ptp(low[:,0]) < np.ptp(low[:,1]))
+    order = np.argsort(low[:,axis],kind='mergesort')
+    starts = low[order,axis]
+    counts = np.searchsorted(starts,high[order,axis]) - np.arange(1,n+1)
+    counts = np.maximum(counts,0)
+    total = counts.sum()
+    i = np.repeat(np.arange(n),counts)
+    # Position of each pair within the run of its box
+    j = i + 1 + np.arange(total) - np.repeat(np.cumsum(counts)-counts,counts)
+    first,second = order[i],order[j]
+    other = 1-axis
+    keep = (low[first,other] < high[second,other]) & (low[second,other] < high[first,other])
+    return first[keep],second[keep]
+
+class SpatialHash(object):
+    """
+    Buckets entities into square grid cells by their rect so that spatial
+    queries only look at entities in nearby cells.
+
+    Arguments:
+    --------------------------------------------------------------------
+    cellSize        | width and height of a grid cell in pixels; works best
+                    | when it is about the size of a typical entity
+    --------------------------------------------------------------------
+    """
+    def __init__(self,cellSize=64):
+        self.cellSize = int(cellSize)
+        self.cells = {}
+        self.ranges = {}
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __contains__(self,entity):
+        return entity in self.ranges
+
+    def cell_range(self,rect):
+        c = self.cellSize
+        return (rect.left//c, rect.top//c,
+                max(rect.right-1,rect.left)//c, max(rect.bottom-1,rect.top)//c)
+
+    def insert(self,entity):
+        cellRange = self.cell_range(entity.rect)
+        self.ranges[entity] = cellRange
+        x0,y0,x1,y1 = cellRange
+        cells = self.cells
+        for i in range(x0,x1+1):
+            for j in range(y0,y1+1):
+                if (i,j) in cells:
+                    cells[i,j].append(entity)
+                else:
+                    cells[i,j] = [entity]
+
+    def remove(self,entity):
+        cellRange = self.ranges.pop(entity,None)
+        if cellRange is None:
+            return
+        x0,y0,x1,y1 = cellRange
+        cells = self.cells
+        for i in range(x0,x1+1):
+            for j in range(y0,y1+1):
+                bucket = cells[i,j]
+                bucket.remove(entity)
+                if not bucket:
+                    del cells[i,j]
+
+    def update(self,entity):
+        """
+        Call after entity.rect has moved or resized. Cheap when the rect is
+        still covering the same cells; ignored for entities not in the hash.
+        """
+        cellRange = self.ranges.get(entity)
+        if cellRange is None or cellRange == self.cell_range(entity.rect):
+            return
+        self.remove(entity)
+        self.insert(entity)
+
+    def query_rect(self,rect):
+        """
+        returns:    list of entities whose rect intersects rect
+        """
+        rect = pygame.Rect(rect)
+        x0,y0,x1,y1 = self.cell_range(rect)
+        cells = self.cells
+        found = []
+        seen = set()
+        for i in range(x0,x1+1):
+            for j in range(y0,y1+1):
+                bucket = cells.get((i,j))
+                if not bucket:
+                    continue
+                for entity in bucket:
+                    if entity not in seen:
+                        seen.add(entity)
+                        if rect.colliderect(entity.rect):
+                            found.append(entity)
+        return found
+
+    def query_point(self,point):
+        """
+        returns:    list of entities whose rect contains point
+        """
+        c = self.cellSize
+        x,y = int(point[0]),int(point[1])
+        bucket = self.cells.get((x//c,y//c),())
+        return [entity for entity in bucket if entity.rect.collidepoint(x,y)]
+
+class StaticGrid(SpatialHash):
+    """
+    SpatialHash for entities that stay put (static bodies). Entities added
+    are bucketed all together when the grid is next queried, and nothing
+    is checked as the world runs: call update() after moving one.
+    """
+    def __init__(self,cellSize=64):
+        SpatialHash.__init__(self,cellSize)
+        # Rect of every entity as it was bucketed
+        self.rects = {}
+        self._pending = []
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __contains__(self,entity):
+        return entity in self.rects
+
+    def insert(self,entity):
+        self.rects[entity] = entity.rect.copy()
+        self._pending.append(entity)
+
+    def build(self):
+        # Buckets the entities inserted since the last query
+        pending,self._pending = self._pending,[]
+        for entity in pending:
+            if entity in self.rects and entity not in self.ranges:
+                SpatialHash.insert(self,entity)
+
+    def remove(self,entity):
+        if self.rects.pop(entity,None) is not None:
+            SpatialHash.remove(self,entity)
+
+    def update(self,entity):
+        """
+        Rebuckets entity after it has been moved or resized.
+        returns:    its rect before, or None if it is not in the grid
+        """
+        old = self.rects.get(entity)
+        if old is not None:
+            self.rects[entity] = entity.rect.copy()
+            SpatialHash.update(self,entity)
+        return old
+
+    def query_rect(self,rect):
+        if self._pending:
+            self.build()
+        return SpatialHash.query_rect(self,rect)
+
+    def query_point(self,point):
+        if self._pending:
+            self.build()
+        return SpatialHash.query_point(self,point)
@@ -0,0 +1,104 @@
+# Cached text rendering for TextEntity
+import pygame
+
+class TextCache(object):
+    """
+    Renders strings in one font and colour, keeping the last `capacity`
+    results. Strings made only of atlas glyphs (digits by default) are
+    composed from glyph surfaces rendered once, so counters and timers
+    never rasterize text again after their first frame.
+
+    Composed strings are laid out glyph by glyph without kerning, which is
+    what digits want (they are usually the same width in any case).
+
+    When the cache fills up the least recently used half is dropped, which
+    keeps lookups to a plain dict access.
+
+    Arguments:
+    --------------------------------------------------------------------
+    font            | pygame.font.Font to render with
+    color           | text colour
+    antialias       | passed on to font.render
+    capacity        | number of rendered strings kept
+    glyphs          | characters composed from the atlas
+    --------------------------------------------------------------------
+    """
+    def __init__(self,font,color,antialias=True,capacity=256,glyphs="0123456789-.:"):
+        self.font = font
+        self.color = color
+        self.antialias = antialias
+        self.capacity = capacity
+        self.glyphs = dict((c,font.render(c,antialias,color)) for c in glyphs)
+        self.height = max(image.get_height() for image in self.glyphs.values()) if glyphs else 0
+        self._strings = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.composed = 0
+
+    def __len__(self):
+        return len(self._strings)
+
+    def get(self,text):
+        """
+        returns:    the rendered surface for text. It is shared by every
+                    caller; do not draw on it
+        """
+        self._clock += 1
+        entry = self._strings.get(text)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = self._clock
+            return entry[0]
+        self.misses += 1
+        if text and all(c in self.glyphs for c in text):
+            image = self.compose(text)
+            self.composed += 1
+        else:
+            image = self.font.render(text,self.antialias,self.color)
+        if len(self._strings) >= self.capacity:
+            self._evict()
+        self._strings[text] = [image,self._clock]
+        return image
+
+    def _evict(self):
+        # Keep the most recently used half
+        entries = sorted(self._strings.items(),key=lambda item: item[1][1])
+        self._strings = dict(entries[len(entries)//2:])
+
+    def compose(self,text):
+        # Lay atlas glyphs out side by side on a transparent surface
+        glyphs = [self.glyphs[c] for c in text]
+        places = []
+        x = 0
+        for glyph in glyphs:
+            places.append((glyph,(x,0)))
+            x += glyph.get_width()
+        image = pygame.Surface((x,self.height),pygame.SRCALPHA)
+        image.blits(places,False)
+        return image
+
+    def clear(self):
+        self._strings.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'strings':len(self),'hits':self.hits,'misses':self.misses,
+                'composed':self.composed,
+                'hitRate':float(self.hits)/lookups if lookups else 0.}
+
+_caches = {}
+
+def text_cache(fontName=None,size=30,color='black',antialias=True):
+    """
+    returns:    the TextCache shared by everything drawing text with this
+                font, size and colour
+    """
+    color = tuple(pygame.Color(color)) if isinstance(color,str) else tuple(color)
+    key = (fontName,size,color,antialias)
+    cache = _caches.get(key)
+    if cache is None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        cache = _caches[key] = TextCache(pygame.font.Font(fontName,size),color,antialias)
+    return cache
@@ -0,0 +1,215 @@
+# Predicted paths of entities, shared by everything that asks for them
+"""
+NewtonWorld.predict(entity,horizon) projects where an entity is going
+over the next horizon seconds: in straight lines at its current
+velocity, reflecting off the edges of the world and off solid colliders
+that are at rest (static bodies and sleeping entities). Forces, fields
+and moving entities are not taken into account.
+
+A Predictor keeps the path of every entity it has been asked about until
+the entity's velocity changes, it strays from the path (it was moved,
+say) or entities come or go. Until then every agent asking gets the same
+path, seen from the present, without tracing it again.
+"""
+import bisect
+
+from PhysicsEngine2D import CollidingEntity,swept_aabb
+
+# Most reflections traced for one path
+MAX_BOUNCES = 64
+
+class Trajectory(object):
+    """
+    A path made of straight segments, each (t,x,y,vx,vy): the time it
+    starts, with the position and velocity then (pixels, pixels/s). Times
+    given to and returned by the methods are in seconds from now.
+    """
+    def __init__(self,segments,end,start=0.):
+        self.segments = segments
+        self._times = [segment[0] for segment in segments]
+        # Times along the path of the end of the horizon and of now
+        self.end = end
+        self.start = start
+
+    def _segment(self,t):
+        return self.segments[max(bisect.bisect_right(self._times,t)-1,0)]
+
+    def position_at(self,t):
+        t0,x,y,vx,vy = self._segment(self.start+t)
+        dt = self.start + t - t0
+        return (x+vx*dt,y+vy*dt)
+
+    def velocity_at(self,t):
+        return self._segment(self.start+t)[3:]
+
+    def bounces(self):
+        # Times of the reflections ahead
+        return [t-self.start for t in self._times[1:] if t > self.start]
+
+    def crossing(self,axis,coordinate):
+        """
+        returns:    (t,position) for the first time within the horizon that
+                    the path crosses coordinate along axis (0: x, 1: y), or
+                    None if it does not
+        """
+        segments,times = self.segments,self._times
+        first = max(bisect.bisect_right(times,self.start)-1,0)
+        for i in range(first,len(segments)):
+            t0,x,y,vx,vy = segments[i]
+            v = (vx,vy)[axis]
+            if v == 0:
+                continue
+            t = t0 + (coordinate - (x,y)[axis])/v
+            t1 = times[i+1] if i+1 < len(segments) else self.end
+            if max(t0,self.start) <= t <= t1:
+                return t-self.start,(x+vx*(t-t0),y+vy*(t-t0))
+        return None
+
+def colliders(world,entity):
+    """
+    returns:    (bounds,restitution) of the solid colliders at rest that
+                entity would bounce off
+    """
+    solid = getattr(entity,'solid',True)
+    restitution = getattr(entity,'restitution',1.)
+    found = []
+    for other in world.get_instances(CollidingEntity):
+        if other is entity or not other.asleep or not (solid or other.solid):
+            continue
+        bounds = other.get_bounds()
+        if bounds is not None:
+            found.append(((bounds.left,bounds.top,bounds.right,bounds.bottom),
+                          max(restitution,other.restitution)))
+    return found
+
+def trace(world,entity,horizon):
+    """
+    Follows entity's rect from where it is for horizon seconds.
+    returns:    the list of segments of its Trajectory
+    """
+    x,y = float(entity.position[0]),float(entity.position[1])
+    vx,vy = float(entity.velocity[0]),float(entity.velocity[1])
+    # Edges of the rect relative to the position
+    lowX,lowY = -float(entity.centerOfMass[0]),-float(entity.centerOfMass[1])
+    highX,highY = lowX + float(entity.size[0]),lowY + float(entity.size[1])
+    width,height = float(world.size[0]),float(world.size[1])
+    obstacles = colliders(world,entity)
+    t = 0.
+    segments = []
+    for i in range(MAX_BOUNCES):
+        segments.append((t,x,y,vx,vy))
+        remaining = horizon - t
+        hit = None
+        # The edges of the world
+        for axis,v,low,high,size in ((0,vx,x+lowX,x+highX,width),(1,vy,y+lowY,y+highY,height)):
+            if v > 0:
+                dt = max((size-high)/v,0.)
+            elif v < 0:
+                dt = max(-low/v,0.)
+            else:
+                continue
+            if hit is None or dt < hit[0]:
+                hit = (dt,axis,1.)
+        # Colliders, in the frame of the whole remaining move
+        if obstacles:
+            box = (x+lowX,y+lowY,x+highX,y+highY)
+            displacement = (vx*remaining,vy*remaining)
+            for bounds,restitution in obstacles:
+                impact = swept_aabb(box,displacement,bounds)
+                if impact is not None and (hit is None or impact[0]*remaining < hit[0]):
+                    hit = (impact[0]*remaining,int(impact[1][1] != 0),restitution)
+        if hit is None or hit[0] >= remaining:
+            break
+        dt,axis,restitution = hit
+        t += dt
+        x += vx*dt
+        y += vy*dt
+        if axis == 0:
+            vx = -vx*restitution
+        else:
+            vy = -vy*restitution
+    return segments
+
+class Predictor(object):
+    """
+    Predicts and caches the paths of a world's entities. Made by
+    NewtonWorld.predict().
+
+    Arguments:
+    --------------------------------------------------------------------
+    world           | the world whose entities are predicted
+    tolerance       | distance (pixels) an entity may stray from its path
+                    | before the path is traced again
+    margin          | seconds traced beyond the horizon asked for, so the
+                    | path still reaches far enough on later ticks (None:
+                    | the horizon again)
+    --------------------------------------------------------------------
+    """
+    def __init__(self,world,tolerance=0.5,margin=None):
+        self.world = world
+        self.tolerance = tolerance
+        self.margin = margin
+        # entity: (vx,vy,segments,end) with times from the first segment
+        self.paths = {}
+        # entity: (x,y,vx,vy,horizon,Trajectory) answered last
+        self._answers = {}
+        self._version = world.version
+        self.traced = 0
+
+    def predict(self,entity,horizon):
+        """
+        returns:    the Trajectory of entity over at least the next horizon
+                    seconds
+        """
+        world = self.world
+        if self._version != world.version:
+            self.paths.clear()
+            self._answers.clear()
+            self._version = world.version
+        x,y = float(entity.position[0]),float(entity.position[1])
+        vx,vy = float(entity.velocity[0]),float(entity.velocity[1])
+        answer = self._answers.get(entity)
+        if answer is not None and answer[:4] == (x,y,vx,vy) and answer[4] >= horizon:
+            return answer[5]
+        elapsed = self._elapsed(entity,x,y,vx,vy,horizon)
+        if elapsed is None:
+            end = horizon + (horizon if self.margin is None else self.margin)
+            self.paths[entity] = (vx,vy,trace(world,entity,end),end)
+            self.traced += 1
+            elapsed = 0.
+        path = self.paths[entity]
+        trajectory = Trajectory(path[2],path[3],elapsed)
+        self._answers[entity] = (x,y,vx,vy,path[3]-elapsed,trajectory)
+        return trajectory
+
+    def _elapsed(self,entity,x,y,vx,vy,horizon):
+        # How far along its cached path entity is, or None if the path no
+        # longer holds or does not reach far enough
+        path = self.paths.get(entity)
+        if path is None or (path[0],path[1]) != (vx,vy):
+            return None
+        segments,end = path[2],path[3]
+        t0,x0,y0 = segments[0][:3]
+        speed2 = vx*vx + vy*vy
+        elapsed = ((x-x0)*vx + (y-y0)*vy)/speed2 if speed2 else 0.
+        if elapsed < 0 or elapsed + horizon > end:
+            return None
+        # Still on the first segment, as the velocity has not changed
+        if len(segments) > 1 and elapsed > segments[1][0]:
+            return None
+        dx,dy = x0 + vx*elapsed - x,y0 + vy*elapsed - y
+        if dx*dx + dy*dy > self.tolerance*self.tolerance:
+            return None
+        return elapsed
+
+    def get_state(self):
+        # The cached paths, by entity index, for World.save_state()
+        index = dict((entity,i) for i,entity in enumerate(self.world.get_entities()))
+        return sorted((index[entity],) + path for entity,path in self.paths.items()
+                      if entity in index)
+
+    def set_state(self,state):
+        entities = self.world.get_entities()
+        self.paths = dict((entities[row[0]],tuple(row[1:])) for row in state)
+        self._answers = {}
+        self._version = self.world.version
@@ -0,0 +1,164 @@
+# Regression checks for the engine; run with python -m unittest test_engine
+import math
+import os
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+
+import numpy as np
+import pygame
+
+import Pong
+from BarnesHut import inverse_square_field,pairwise_field
+from Fields import Friction,MutualGravity,MutualElectricField
+from PhysicsEngine2D import PhysicsWorld,NewtonianEntity,CollidingEntity,elastic_collision
+from Shapes import AABB
+from SpatialHash import overlapping_pairs
+
+class HeadlessTest(unittest.TestCase):
+
+    def test_main_loop(self):
+        # The fixed timestep accumulator drives a headless real-time loop
+        world = Pong.build_world(fixedTimestep=0.01)
+        ball = world.get_group("Ball")[0]
+        start = ball.position.copy()
+        for i in range(5):
+            world.main_loop()
+        self.assertGreater(world.tickCount,0)
+        self.assertFalse(np.array_equal(ball.position,start))
+
+class FieldTest(unittest.TestCase):
+
+    def two_bodies(self,field,**options):
+        # Accelerations (m/s^2) of two bodies 10 m apart along x
+        world = PhysicsWorld("fields",None,size=(1000,1000),scale=10)
+        world.add_field(field(world,**options))
+        bodies = [NewtonianEntity(world,position=(x,10),mass=1e10,charge=1e-3) for x in (10,20)]
+        for body in bodies:
+            world.add(body)
+        world.apply_fields()
+        batched = world.store.fieldForce[:2]/1e10/world.scale
+        single = np.array([world.fields[0].get_vector(body) for body in bodies])/1e10
+        return batched,single
+
+    # Softened by 0.1 m
+    factor = 10/(10**2 + 0.1**2)**1.5
+
+    def test_mutual_gravity(self):
+        expected = 6.67e-11*1e10*self.factor
+        for exactBelow in (256,0):
+            for acceleration in self.two_bodies(MutualGravity,exactBelow=exactBelow):
+                self.assertAlmostEqual(acceleration[0,0]/expected,1.,6)
+                self.assertAlmostEqual(acceleration[1,0]/expected,-1.,6)
+
+    def test_mutual_electric_field(self):
+        # Like charges repel
+        expected = 1e-6/(4*math.pi*8.85e-12)/1e10*self.factor
+        for acceleration in self.two_bodies(MutualElectricField):
+            self.assertAlmostEqual(acceleration[0,0]/expected,-1.,6)
+            self.assertAlmostEqual(acceleration[1,0]/expected,1.,6)
+
+    def test_friction_only_returns_forces(self):
+        world = PhysicsWorld("friction",None,size=(400,400))
+        friction = Friction(world,0.3,0.2)
+        velocities = np.array(((0.001,0.),(5.,0.)))
+        before = velocities.copy()
+        friction.get_forces(np.zeros((2,2)),velocities,np.ones(2),np.full(2,np.nan),np.zeros((2,2)))
+        self.assertTrue(np.array_equal(velocities,before))
+
+    def test_friction_stops_resting_entities(self):
+        world = PhysicsWorld("friction",None,size=(400,400))
+        world.add_field(Friction(world,0.3,0.2))
+        class Rock(NewtonianEntity):
+            static = True
+        resting = NewtonianEntity(world,position=(10,10))
+        rock = Rock(world,position=(20,20))
+        world.add(resting)
+        world.add(rock)
+        resting.velocity[:] = rock.velocity[:] = (0.001,0.)
+        world.apply_fields()
+        self.assertEqual(tuple(resting.velocity),(0.,0.))
+        self.assertEqual(tuple(rock.velocity),(0.001,0.))
+
+class ContactTest(unittest.TestCase):
+
+    def test_elastic_collision(self):
+        world = PhysicsWorld("elastic",None,size=(400,400))
+        class Wall(NewtonianEntity):
+            static = True
+        a = NewtonianEntity(world,position=(10,10),velocity=(2,0))
+        b = NewtonianEntity(world,position=(12,10),velocity=(-1,0))
+        wall = Wall(world,position=(20,20))
+        for entity in (a,b,wall):
+            world.add(entity)
+        # Equal masses swap their normal velocities, however they move
+        elastic_collision(a,b,(1.,0.))
+        self.assertEqual((a.velocity[0],b.velocity[0]),(-10.,20.))
+        elastic_collision(a,b,(1.,0.))
+        self.assertEqual((a.velocity[0],b.velocity[0]),(20.,-10.))
+        elastic_collision(a,wall,(1.,0.))
+        self.assertEqual(a.velocity[0],-20.)
+        self.assertEqual(tuple(wall.velocity),(0.,0.))
+        self.assertTrue(wall.asleep)
+
+    def test_single_pass_against_two_tiles(self):
+        # A ball landing across two tiles bounces once, not once per tile
+        world = PhysicsWorld("tiles",None,size=(400,400))
+        for x in (10,12):
+            world.add(CollidingEntity(world,position=(x,20),shape=AABB((20,20)),static=True))
+        ball = CollidingEntity(world,position=(11,18.1),shape=AABB((20,20)))
+        world.add(ball)
+        ball.set_velocity((0,10))
+        world.collide()
+        self.assertAlmostEqual(ball.velocity[1],-100.)
+        # and is pushed out by its depth past the slop, not twice that
+        self.assertAlmostEqual(ball.position[1],181-0.8*(1-0.5))
+
+    def test_overlapping_pairs(self):
+        generator = np.random.RandomState(2)
+        for spread in ((500,100),(100,500)):
+            low = generator.uniform(0,1,(300,2))*spread
+            high = low + generator.uniform(1,30,(300,2))
+            first,second = overlapping_pairs(low,high)
+            found = set(tuple(sorted(pair)) for pair in zip(first.tolist(),second.tolist()))
+            overlap = ((low[:,None] < high[None,:]) & (low[None,:] < high[:,None])).all(axis=2)
+            expected = set(zip(*np.nonzero(np.triu(overlap,1))))
+            self.assertEqual(len(found),len(first))
+            self.assertEqual(found,expected)
+
+class SleepTest(unittest.TestCase):
+
+    def test_pile_sleeps_until_hit(self):
+        world = PhysicsWorld("pile",None,size=(400,400))
+        pile = [CollidingEntity(world,position=(10+1.98*i,10+1.98*j),shape=AABB((20,20)))
+                for i in range(3) for j in range(3)]
+        for box in pile:
+            world.add(box)
+        world.step(30,0.025)
+        self.assertTrue(all(box.asleep for box in pile))
+        # A box thrown at the middle row wakes it and passes its momentum
+        # along the row; the other rows sleep on
+        ball = CollidingEntity(world,position=(2,12),shape=AABB((20,20)))
+        world.add(ball)
+        ball.set_velocity((20,0))
+        world.step(20,0.025)
+        row = pile[1::3]
+        self.assertFalse(any(box.asleep for box in row))
+        self.assertEqual([box.velocity[0] for box in [ball]+row],[0.,0.,0.,200.])
+        self.assertTrue(pile[0].asleep and pile[2].asleep)
+
+class BarnesHutTest(unittest.TestCase):
+
+    def test_matches_exact_sum(self):
+        generator = np.random.RandomState(1)
+        positions = np.concatenate((generator.uniform(0,1000,(1500,2)),
+                                    generator.normal(300,5,(500,2)),np.zeros((20,2))))
+        for weights in (generator.uniform(1,10,2020),generator.uniform(-1,1,2020)):
+            for softening in (0.,1.):
+                exact = pairwise_field(positions,positions,weights,softening)
+                approx = inverse_square_field(positions,weights,0.5,softening,exactBelow=0)
+                error = np.linalg.norm(approx-exact,axis=1).mean()/np.linalg.norm(exact,axis=1).mean()
+                self.assertLess(error,1e-2)
+
+if __name__ == "__main__":
+    unittest.main()